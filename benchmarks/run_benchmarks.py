@@ -0,0 +1,240 @@
+"""Timing harness of stacpro on synthetic data, no real .pdb files or US-align needed. Every result is
+appended as one JSON line to the results file, with the version of stacpro, so the results of two
+versions can be compared. Example:
+    python benchmarks/run_benchmarks.py --bench align2mat update_mat_nj --sizes 1000 2000
+"""
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_PATH))
+import synthetic
+import get_lists
+import get_alignments
+import clustering.tree_functions as tree_functions
+import clustering.get_clusters as get_clusters
+
+STUB_PATH = os.path.join(BENCH_PATH, 'stub_usalign.py')
+# default sizes of every benchmark, the tree loop is O(n^3) in pure python, so it gets smaller sizes
+DEFAULT_SIZES = {'align2mat': [1000, 5000], 'update_mat_nj': [500, 1000], 'update_mat_upgma': [500, 1000],
+                 'update_mat_nj_parallel': [500, 1000, 5000],
+                 'get_tree_file': [100, 200], 'get_tree_file_rapid': [100, 200, 1000], 'clustering_upward': [100, 200],
+                 'clustering_sparse': [1000, 5000],
+                 'cat_align': [1000, 5000], 'step2': [100, 200]}
+# larger sizes added with large=1 (--large), they need hours and several GB; the pair-wise similarity file and
+# the full matrix grow with n*n, e.g. 50k proteins give 1.25e9 pairs and a matrix of 20 GB, such sizes can be
+# given with 'sizes' on a node with enough memory and disk
+LARGE_SIZES = {'align2mat': [10000, 20000], 'update_mat_nj': [5000, 10000], 'update_mat_upgma': [5000, 10000],
+               'update_mat_nj_parallel': [10000, 20000], 'get_tree_file_rapid': [2000, 5000],
+               'clustering_sparse': [10000, 20000], 'cat_align': [10000, 20000]}
+
+
+def get_version():
+    """Version of the code: the git commit if available, otherwise the version in setup.py."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_PATH,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def time_call(func, repeat):
+    """Smallest wall time of 'repeat' calls of func, and the result of the last call."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - time_start)
+    return min(times), result
+
+
+def alignment_file(work_path, num_pro, ultrametric=0):
+    """Synthetic 'alignment_all.txt' of n proteins, generated once and reused by the benchmarks."""
+    align_all_path = os.path.join(work_path, 'alignment_' + str(num_pro) + '_' + str(ultrametric) + '.txt')
+    if not os.path.exists(align_all_path):
+        synthetic.write_alignment(synthetic.random_tree(num_pro, ultrametric=ultrametric), align_all_path)
+    return align_all_path
+
+
+def bench_align2mat(work_path, num_pro, repeat):
+    align_all_path = alignment_file(work_path, num_pro)
+    seconds, _ = time_call(lambda: tree_functions.align2mat(align_all_path), repeat)
+    return seconds, {'pairs': num_pro * (num_pro - 1) // 2}
+
+
+def bench_update_mat(method):
+    """One merge step of the tree loop on a matrix of n proteins."""
+    def bench(work_path, num_pro, repeat):
+        mat = synthetic.distance_matrix(synthetic.random_tree(num_pro, ultrametric=method == 'upgma'))
+        if method == 'upgma':
+            func = lambda: tree_functions.update_mat_upgma(mat, num_pro - 1)
+        elif method == 'nj_parallel':
+            func = lambda: tree_functions.update_mat_nj_parallel(mat, num_pro - 1)
+        else:
+            func = lambda: tree_functions.update_mat_nj(mat, num_pro - 1)
+        seconds, _ = time_call(func, repeat)
+        return seconds, {'cells': (num_pro - 1) ** 2}
+    return bench
+
+
+def bench_get_tree_file(nj_search):
+    """The whole tree building with the full or the bounded ('rapid') NJ search."""
+    def bench(work_path, num_pro, repeat):
+        align_all_path = alignment_file(work_path, num_pro)
+        tree_path = os.path.join(work_path, 'trees')
+        if not os.path.exists(tree_path):
+            os.makedirs(tree_path)
+        seconds, _ = time_call(lambda: get_clusters.get_tree_file(align_all_path, path_tree_folder=tree_path,
+                                                                  nj_search=nj_search), repeat)
+        return seconds, {'merges': num_pro - 1, 'nj_search': nj_search}
+    return bench
+
+
+def bench_clustering_upward(work_path, num_pro, repeat):
+    align_all_path = alignment_file(work_path, num_pro)
+    tree_path = os.path.join(work_path, 'trees')
+    if not os.path.exists(tree_path):
+        os.makedirs(tree_path)
+    labels, _ = get_clusters.get_tree_file(align_all_path, path_tree_folder=tree_path)
+    # the clusters are marked in the labels, every call gets its own copy, so all repeats do the same work
+    seconds, _ = time_call(lambda: get_clusters.clustering_upward(copy.deepcopy(labels), 3, tree_path), repeat)
+    return seconds, {}
+
+
+def bench_clustering_sparse(work_path, num_pro, repeat):
+    align_all_path = alignment_file(work_path, num_pro)
+    tree_path = os.path.join(work_path, 'trees')
+    if not os.path.exists(tree_path):
+        os.makedirs(tree_path)
+    seconds, _ = time_call(lambda: get_clusters.clustering_sparse(align_all_path, tm_cutoff=0.8,
+                                                                  path_tree_folder=tree_path), repeat)
+    return seconds, {'pairs': num_pro * (num_pro - 1) // 2}
+
+
+def bench_cat_align(work_path, num_pro, repeat):
+    """Concatenation of the row files of step 2, split from a synthetic pair-wise similarity file."""
+    align_folder_path = os.path.join(work_path, 'rows_' + str(num_pro))
+    pdb_list = pd.DataFrame(synthetic.get_names(num_pro)) + '.pdb'
+    if not os.path.exists(align_folder_path):
+        os.makedirs(align_folder_path)
+        df_align = pd.read_csv(alignment_file(work_path, num_pro), sep='\t', dtype={'PDBchain1': str,
+                                                                                   'PDBchain2': str})
+        for pro_id, df_row in df_align.groupby('PDBchain1', sort=False):
+            df_row.to_csv(os.path.join(align_folder_path, 'align_' + pro_id + '.txt'), index=None, sep='\t')
+    seconds, _ = time_call(lambda: get_alignments.cat_align(pdb_list, align_folder_path=align_folder_path), repeat)
+    return seconds, {'pairs': num_pro * (num_pro - 1) // 2}
+
+
+def bench_step2(work_path, num_pro, repeat, latency=0.0, par_num=1, batch_size=1, runner='os'):
+    """Step 2 runner with the stub us-align on synthetic .pdb files, all jobs run one after another."""
+    pdb_path = os.path.join(work_path, 'pdb_' + str(num_pro), 'pdb_files')
+    if not os.path.exists(pdb_path):
+        synthetic.write_pdbs(pdb_path, num_pro)
+    os.environ['STUB_USALIGN_LATENCY'] = str(latency)
+    pdb_list, sublist_path = get_lists.get_lists(pdb_path, parallel=1, par_num=par_num, batch_size=batch_size)
+
+    def run_all():
+        for par_index in range(par_num):
+            get_alignments.compute_similarity(pdb_path, STUB_PATH, parallel=1, par_index=par_index,
+                                              par_num=par_num, pdb_list=pdb_list, sublist_path=sublist_path,
+                                              batch_size=batch_size, runner=runner)
+    seconds, _ = time_call(run_all, repeat)
+    return seconds, {'pairs': num_pro * (num_pro - 1) // 2, 'latency': latency, 'batch_size': batch_size,
+                     'runner': runner}
+
+
+BENCHES = {'align2mat': bench_align2mat, 'update_mat_nj': bench_update_mat('nj'),
+           'update_mat_upgma': bench_update_mat('upgma'),
+           'update_mat_nj_parallel': bench_update_mat('nj_parallel'), 'get_tree_file': bench_get_tree_file('full'),
+           'get_tree_file_rapid': bench_get_tree_file('rapid'),
+           'clustering_upward': bench_clustering_upward, 'clustering_sparse': bench_clustering_sparse,
+           'cat_align': bench_cat_align, 'step2': bench_step2}
+
+
+def run_benchmarks(benches=None, sizes=None, repeat=3, work_path=None, results_path=None, keep=0, large=0):
+    """Run the benchmarks and append the results to 'results_path' (JSON lines).
+    Parameters:
+    ----------
+    benches: list
+        Names of the benchmarks in 'BENCHES', all if not provided.
+    sizes: list
+        Numbers of proteins, the defaults of every benchmark in 'DEFAULT_SIZES' if not provided.
+    large: bool
+        If the sizes of 'LARGE_SIZES' are added to the defaults, not used if 'sizes' is provided.
+    repeat: int
+        Number of repeats, the smallest time is recorded.
+    work_path: string
+        Folder for the synthetic data, removed at the end unless 'keep'.
+    results_path: string
+        File of the results, 'benchmark_results.jsonl' in the benchmark folder if not provided.
+    Returns:
+    ----------
+    results: list
+        One dict for every benchmark and size."""
+    if benches is None:
+        benches = list(BENCHES)
+    if work_path is None:
+        work_path = os.path.join(BENCH_PATH, 'work')
+    if results_path is None:
+        results_path = os.path.join(BENCH_PATH, 'benchmark_results.jsonl')
+    if not os.path.exists(work_path):
+        os.makedirs(work_path)
+    context = {'version': get_version(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': socket.gethostname(),
+               'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__}
+    results = []
+    for bench in benches:
+        if sizes is not None:
+            bench_sizes = sizes
+        else:
+            bench_sizes = DEFAULT_SIZES[bench] + (LARGE_SIZES.get(bench, []) if large else [])
+        for num_pro in bench_sizes:
+            seconds, extra = BENCHES[bench](work_path, num_pro, repeat)
+            result = dict(context, bench=bench, n=num_pro, seconds=seconds, repeat=repeat, **extra)
+            results.append(result)
+            results_file = open(results_path, 'a')
+            results_file.write(json.dumps(result) + '\n')
+            results_file.close()
+            print('Benchmark', bench, 'n =', num_pro, ':', round(seconds, 4), 's')
+    if not keep:
+        shutil.rmtree(work_path)
+    print('The benchmark results are saved in: ', results_path)
+    return results
+
+
+def compare_results(results_path, version_old, version_new):
+    """Ratio of the times of two versions for every benchmark and size, larger than 1 if the new version is
+    slower."""
+    df = pd.read_json(results_path, lines=True)
+    df = df.groupby(['version', 'bench', 'n'])['seconds'].min().unstack('version')
+    df['ratio'] = df[version_new] / df[version_old]
+    return df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of stacpro on synthetic data.')
+    parser.add_argument('--bench', nargs='+', choices=list(BENCHES), help='benchmarks to run (default: all)')
+    parser.add_argument('--sizes', nargs='+', type=int, help='numbers of proteins (default: per benchmark)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--work', help='folder for the synthetic data')
+    parser.add_argument('--results', help='results file (JSON lines)')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic data')
+    parser.add_argument('--large', action='store_true', help='add the large sizes of every benchmark (slow)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two versions in the results')
+    args = parser.parse_args()
+    if args.compare is not None:
+        print(compare_results(args.results or os.path.join(BENCH_PATH, 'benchmark_results.jsonl'),
+                              *args.compare).to_string())
+    else:
+        run_benchmarks(benches=args.bench, sizes=args.sizes, repeat=args.repeat, work_path=args.work,
+                       results_path=args.results, keep=args.keep, large=args.large)
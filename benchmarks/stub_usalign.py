@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Stub of US-align for the benchmarks, with the same command line forms as used by stacpro:
+    stub_usalign.py pdb1 pdb2 -outfmt 2
+    stub_usalign.py pdb1 -dir2 folder list -outfmt 2
+    stub_usalign.py -dir folder list -outfmt 2
+    stub_usalign.py -dir1 folder list1 -dir2 folder list2 -outfmt 2
+It writes one '-outfmt 2' row per pair with a TM-score derived from the names, and waits
+STUB_USALIGN_LATENCY seconds (default 0) per pair to emulate the alignment time."""
+import os
+import sys
+import time
+import zlib
+
+
+def count_ca(pdb_file_path):
+    num_ca = 0
+    pdb_file = open(pdb_file_path, 'r')
+    for line in pdb_file:
+        if line.startswith('ATOM') and line[12:16].strip() == 'CA':
+            num_ca += 1
+    pdb_file.close()
+    return num_ca
+
+
+def read_list(list_path):
+    list_file = open(list_path, 'r')
+    names = [line.strip() for line in list_file if line.strip() != '']
+    list_file.close()
+    return names
+
+
+def get_option(args, key):
+    ind_key = args.index(key)
+    return args[ind_key + 1], args[ind_key + 2]
+
+
+def main(args):
+    latency = float(os.environ.get('STUB_USALIGN_LATENCY', '0'))
+    # every pair: path and printed name of both structures
+    pairs = []
+    if '-dir' in args:
+        folder, list_path = get_option(args, '-dir')
+        names = read_list(list_path)
+        for ind_i in range(len(names)):
+            for ind_j in range(ind_i + 1, len(names)):
+                pairs.append((os.path.join(folder, names[ind_i]), '/' + names[ind_i],
+                              os.path.join(folder, names[ind_j]), '/' + names[ind_j]))
+    elif '-dir1' in args:
+        folder1, list1_path = get_option(args, '-dir1')
+        folder2, list2_path = get_option(args, '-dir2')
+        for name1 in read_list(list1_path):
+            for name2 in read_list(list2_path):
+                pairs.append((os.path.join(folder1, name1), '/' + name1, os.path.join(folder2, name2), '/' + name2))
+    elif '-dir2' in args:
+        folder2, list2_path = get_option(args, '-dir2')
+        for name2 in read_list(list2_path):
+            pairs.append((args[0], args[0], os.path.join(folder2, name2), '/' + name2))
+    else:
+        pairs.append((args[0], args[0], args[1], args[1]))
+    lengths = {}
+    sys.stdout.write('#PDBchain1\tPDBchain2\tTM1\tTM2\tRMSD\tID1\tID2\tIDali\tL1\tL2\tLali\n')
+    for path1, name1, path2, name2 in pairs:
+        if latency > 0:
+            time.sleep(latency)
+        for path in [path1, path2]:
+            if path not in lengths:
+                lengths[path] = count_ca(path)
+        # deterministic TM-scores in [0.2, 1), the same for both orders of the pair
+        key = '|'.join(sorted([os.path.basename(path1), os.path.basename(path2)]))
+        tm = 0.2 + 0.8 * (zlib.crc32(key.encode()) % 10000) / 10000.
+        len1 = lengths[path1]
+        len2 = lengths[path2]
+        sys.stdout.write('%s:A\t%s:A\t%.4f\t%.4f\t1.00\t0.500\t0.500\t0.500\t%d\t%d\t%d\n'
+                         % (name1, name2, tm, tm, len1, len2, min(len1, len2)))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+"""Synthetic data for the benchmarks: distances of random trees and random CA-only .pdb files."""
+import os
+import numpy as np
+import pandas as pd
+
+
+def random_tree(num_pro, ultrametric=0, seed=0):
+    """Random tree with 'num_pro' leaves, given by the leaves in the order of a planar drawing: the depth
+    of every leaf and the depth of the last common ancestor of every two neighbouring leaves. The last
+    common ancestor of leaves a < b is then the shallowest of the ancestors of the neighbours between
+    them, so one row of the distance matrix is a running minimum, and the full matrix is never needed.
+    Parameters:
+    ----------
+    num_pro: int
+        Number of leaves.
+    ultrametric: bool
+        If all leaves have the same depth, as expected by UPGMA, otherwise the tree is additive, as
+        expected by NJ.
+    Returns:
+    ----------
+    tree: dict
+        'depth': depth of the leaves; 'lca': depth of the last common ancestor of leaf k and k+1;
+        'order': position of the leaves in the planar drawing, in the order of the protein list."""
+    rng = np.random.default_rng(seed)
+    lca = rng.random(num_pro - 1)
+    if ultrametric:
+        depth = np.ones(num_pro)
+    else:
+        lca_left = np.append(0, lca)
+        lca_right = np.append(lca, 0)
+        depth = np.maximum(lca_left, lca_right) + rng.exponential(0.2, num_pro)
+    return {'depth': depth, 'lca': lca, 'order': rng.permutation(num_pro)}
+
+
+def distance_row(tree, ind_pro):
+    """Distances between the protein 'ind_pro' of the list and all proteins, in the order of the list."""
+    leaf = tree['order'][ind_pro]
+    num_pro = tree['depth'].size
+    lca_row = np.zeros(num_pro)
+    lca_row[leaf] = tree['depth'][leaf]
+    # running minimum to the right and to the left of the leaf in the planar drawing
+    lca_row[leaf + 1:] = np.minimum.accumulate(tree['lca'][leaf:])
+    lca_row[:leaf] = np.minimum.accumulate(tree['lca'][:leaf][::-1])[::-1]
+    dis_row = tree['depth'][leaf] + tree['depth'] - 2 * lca_row
+    return dis_row[tree['order']]
+
+
+def get_names(num_pro):
+    return np.array(['pro' + str(ind_pro).zfill(6) for ind_pro in range(num_pro)])
+
+
+def distance2tm(dis, max_dis):
+    """TM-scores in the range of (0.2, 1], decreasing with the distance."""
+    return 1 - 0.8 * dis / max_dis
+
+
+def write_alignment(tree, align_all_path, noise=0.0, seed=0):
+    """Write all pairs of the tree as a pair-wise similarity file in the format of 'alignment_all.txt', row
+    by row, so the memory does not depend on n*n. 'noise' is the standard deviation of the difference
+    between TM1 and TM2."""
+    rng = np.random.default_rng(seed)
+    num_pro = tree['depth'].size
+    names = get_names(num_pro)
+    max_dis = 2 * tree['depth'].max()
+    align_file = open(align_all_path, 'w')
+    align_file.write('\t'.join(['PDBchain1', 'PDBchain2', 'TM1', 'TM2', 'RMSD', 'ID1', 'ID2', 'IDali', 'L1', 'L2',
+                                'Lali']) + '\n')
+    for ind_pro in range(num_pro - 1):
+        tm = distance2tm(distance_row(tree, ind_pro)[ind_pro + 1:], max_dis)
+        delta = rng.normal(0, noise, tm.size) if noise > 0 else 0
+        df_row = pd.DataFrame({'PDBchain1': names[ind_pro], 'PDBchain2': names[ind_pro + 1:],
+                               'TM1': np.round(np.clip(tm + delta, 0, 1), 4),
+                               'TM2': np.round(np.clip(tm - delta, 0, 1), 4),
+                               'RMSD': 1.0, 'ID1': 0.5, 'ID2': 0.5, 'IDali': 0.5, 'L1': 100, 'L2': 100, 'Lali': 100})
+        df_row.to_csv(align_file, header=False, index=None, sep='\t')
+    align_file.close()
+    return align_all_path
+
+
+def distance_matrix(tree):
+    """Distance matrix in the format of 'align2mat', with the size of (n-1)*(n-1): the entry [i, j] is the
+    distance between the i-th and the (j+1)-th protein, the lower triangle is 1.0001 as in 'align2mat'.
+    The distances are normalized to [0, 1] with the min-max method, the same as 'align2mat'."""
+    num_pro = tree['depth'].size
+    mat = np.ones([num_pro - 1, num_pro - 1]) + 0.0001
+    for ind_pro in range(num_pro - 1):
+        mat[ind_pro, ind_pro:] = distance_row(tree, ind_pro)[ind_pro + 1:]
+    ind_i, ind_j = np.triu_indices(num_pro - 1)
+    values = mat[ind_i, ind_j]
+    mat[ind_i, ind_j] = (values - values.min()) / max(values.max() - values.min(), 1e-12)
+    return mat
+
+
+def write_pdbs(pdb_path, num_pro, min_length=50, max_length=300, seed=0):
+    """Write random CA-only .pdb files, enough for the stub us-align and for the parsing of the lists."""
+    rng = np.random.default_rng(seed)
+    if not os.path.exists(pdb_path):
+        os.makedirs(pdb_path)
+    for name in get_names(num_pro):
+        length = rng.integers(min_length, max_length + 1)
+        steps = rng.normal(0, 1, [length, 3])
+        xyz = np.cumsum(3.8 * steps / np.linalg.norm(steps, axis=1)[:, None], axis=0)
+        pdb_file = open(os.path.join(pdb_path, name + '.pdb'), 'w')
+        for ind_res in range(length):
+            pdb_file.write('ATOM  %5d  CA  ALA A%4d    %8.3f%8.3f%8.3f  1.00  0.00           C\n'
+                           % (ind_res + 1, ind_res + 1, xyz[ind_res, 0], xyz[ind_res, 1], xyz[ind_res, 2]))
+        pdb_file.write('END\n')
+        pdb_file.close()
+    return pdb_path
@@ -0,0 +1,270 @@
+import heapq
+import numpy as np
+import pandas as pd
+import clustering.tree_functions as tree_functions
+
+
+# number of matrix cells expanded at once, the full n*n distances are never built
+BLOCK_CELLS = 10000000
+
+
+def distance_rows(mat, rows, cols=None):
+    """Distances of the proteins in 'rows' to the proteins in 'cols' (all n proteins if not provided), from
+    the (n-1)*(n-1) matrix of 'align2mat', where the entry [i, j] is the distance between the i-th and the
+    (j+1)-th protein.
+    Returns:
+    ----------
+    dis: ndarray
+        Distances with the size of len(rows)*len(cols), 0 for the protein itself."""
+    len_matrix = mat.shape[0]
+    ind_row = np.asarray(rows)[:, None]
+    ind_col = (np.arange(len_matrix + 1) if cols is None else np.asarray(cols))[None, :]
+    # one gather from the flat matrix, the upper triangle holds the distance of every pair
+    dis = np.asarray(mat).reshape(-1).take(np.where(ind_col > ind_row, ind_row * len_matrix + ind_col - 1,
+                                                    ind_col * len_matrix + ind_row - 1), mode='clip')
+    dis[ind_row == ind_col] = 0
+    return dis
+
+
+def cluster_statistics(mat, df_pro_uni, df_clusters, stats_path=None):
+    """Medoid and similarity summary of every cluster, computed from the distance matrix of the tree in one
+    pass, without reading the pair-wise similarity file again. The proteins are sorted by cluster, and the
+    distances of blocks of whole clusters are reduced per cluster with 'reduceat', so only
+    'BLOCK_CELLS' distances are expanded at once.
+    Parameters:
+    ----------
+    mat: ndarray
+        Distance matrix with the size of (n-1)*(n-1), see 'align2mat', can be memory-mapped.
+    df_pro_uni: ndarray
+        List of all protein IDs with the order of 'mat' rows.
+    df_clusters: pandas dataframe
+        The clusters saved by 'save_cluster_info', proteins not in the matrix (e.g. the duplicates) are only
+        counted in the size of their cluster.
+    stats_path: string
+        If provided, the statistics are saved in this path (e.g. PATH/cluster_stats.txt).
+    Returns:
+    ----------
+    df_stats: pandas dataframe
+        For every cluster: 'size'; 'medoid', the protein with the smallest mean distance to the others, and
+        its 'medoid_similarity' to them; 'mean_similarity' and 'min_similarity' within the cluster;
+        'nearest_cluster' with the smallest mean distance between their proteins, this
+        'nearest_cluster_distance', and 'nearest_protein_distance' to any protein of another cluster. The
+        similarities are 1 - distance, i.e. the min-max normalized TM-scores used by the tree, and are nan
+        for clusters of one protein."""
+    pro_index = pd.Series(np.arange(df_pro_uni.size), index=df_pro_uni)
+    in_mat = df_clusters['protein_ID'].isin(pro_index.index).values
+    clusters, label = np.unique(df_clusters['cluster_number'].values[in_mat], return_inverse=True)
+    ind_pro = pro_index[df_clusters['protein_ID'].values[in_mat]].values
+    order = np.argsort(label, kind='stable')
+    ind_pro = ind_pro[order]
+    label = label[order]
+    num_clusters = clusters.size
+    num_pro = ind_pro.size
+    starts = np.searchsorted(label, np.arange(num_clusters))
+    sizes = np.diff(np.append(starts, num_pro))
+    medoid = np.zeros(num_clusters, dtype=int)
+    medoid_sum = np.zeros(num_clusters)
+    intra_sum = np.zeros(num_clusters)
+    intra_max = np.zeros(num_clusters)
+    nearest = np.zeros(num_clusters, dtype=int)
+    nearest_mean = np.full(num_clusters, np.nan)
+    nearest_min = np.full(num_clusters, np.nan)
+    # blocks of whole clusters with about BLOCK_CELLS distances
+    block_rows = max(int(BLOCK_CELLS // max(num_pro, 1)), 1)
+    cluster_start = 0
+    while cluster_start < num_clusters:
+        cluster_end = min(int(np.searchsorted(starts, starts[cluster_start] + block_rows)), num_clusters)
+        cluster_end = max(cluster_end, cluster_start + 1)
+        row_start = starts[cluster_start]
+        row_end = starts[cluster_end] if cluster_end < num_clusters else num_pro
+        dis = distance_rows(mat, ind_pro[row_start:row_end], ind_pro)
+        block_label = label[row_start:row_end]
+        ind_row = np.arange(row_end - row_start)
+        # sum and largest distance of every protein to every cluster
+        sum_cluster = np.add.reduceat(dis, starts, axis=1)
+        max_cluster = np.maximum.reduceat(dis, starts, axis=1)
+        dis[ind_row, row_start + ind_row] = np.inf
+        min_cluster = np.minimum.reduceat(dis, starts, axis=1)
+        sum_own = sum_cluster[ind_row, block_label]
+        # medoid: first protein of every cluster after sorting by cluster and sum of distances
+        local_starts = starts[cluster_start:cluster_end] - row_start
+        by_sum = np.lexsort((sum_own, block_label))
+        medoid[cluster_start:cluster_end] = ind_pro[row_start + by_sum[local_starts]]
+        medoid_sum[cluster_start:cluster_end] = sum_own[by_sum[local_starts]]
+        # sums and extremes of every cluster of the block to every cluster
+        sum_pair = np.add.reduceat(sum_cluster, local_starts, axis=0)
+        min_pair = np.minimum.reduceat(min_cluster, local_starts, axis=0)
+        ind_block = np.arange(cluster_end - cluster_start)
+        ind_own = cluster_start + ind_block
+        intra_sum[cluster_start:cluster_end] = sum_pair[ind_block, ind_own]
+        intra_max[cluster_start:cluster_end] = np.maximum.reduceat(max_cluster[ind_row, block_label], local_starts)
+        if num_clusters > 1:
+            mean_pair = sum_pair / (sizes[ind_own][:, None] * sizes[None, :])
+            mean_pair[ind_block, ind_own] = np.inf
+            min_pair[ind_block, ind_own] = np.inf
+            nearest[cluster_start:cluster_end] = np.argmin(mean_pair, axis=1)
+            nearest_mean[cluster_start:cluster_end] = mean_pair[ind_block, nearest[cluster_start:cluster_end]]
+            nearest_min[cluster_start:cluster_end] = min_pair.min(axis=1)
+        cluster_start = cluster_end
+    num_pairs = sizes * (sizes - 1.)
+    single = sizes < 2
+    num_pairs[single] = 1
+    mean_similarity = 1 - intra_sum / num_pairs
+    min_similarity = 1 - intra_max
+    medoid_similarity = 1 - medoid_sum / np.maximum(sizes - 1, 1)
+    for values in [mean_similarity, min_similarity, medoid_similarity]:
+        values[single] = np.nan
+    df_stats = pd.DataFrame({'cluster_number': clusters,
+                             'size': df_clusters['cluster_number'].value_counts().reindex(clusters).values,
+                             'medoid': df_pro_uni[medoid], 'medoid_similarity': medoid_similarity,
+                             'mean_similarity': mean_similarity, 'min_similarity': min_similarity,
+                             'nearest_cluster': clusters[nearest] if num_clusters > 1 else np.nan,
+                             'nearest_cluster_distance': nearest_mean,
+                             'nearest_protein_distance': nearest_min})
+    if stats_path is not None:
+        df_stats.to_csv(stats_path, index=None, sep='\t')
+        print('The statistics of clusters are saved in: ', stats_path)
+    return df_stats
+
+
+def leaf_ranges(parent, is_leaf):
+    """Leaves under every node as a range [leaf_start, leaf_end) of the leaves in the order of the tree,
+    the leaves of a subtree are next to each other since the nodes of 'nwk2arrays' are in pre-order."""
+    num_node = parent.size
+    leaf_start = np.full(num_node, num_node)
+    leaf_end = np.zeros(num_node, dtype=int)
+    leaf_start[is_leaf] = np.arange(is_leaf.sum())
+    leaf_end[is_leaf] = leaf_start[is_leaf] + 1
+    for ind_node in range(num_node - 1, 0, -1):
+        ind_parent = parent[ind_node]
+        leaf_start[ind_parent] = min(leaf_start[ind_parent], leaf_start[ind_node])
+        leaf_end[ind_parent] = max(leaf_end[ind_parent], leaf_end[ind_node])
+    return leaf_start, leaf_end
+
+
+def score_cuts(mat, df_pro_uni, tree_nwk, max_clusters=50, sample_size=None, seed=0, scores_path=None):
+    """Score the cuts of a built tree into 2 ... 'max_clusters' clusters, the same top-down cuts as
+    'tree_functions.get_cut_clusters' (e.g. 'clust_num' of the tree plot or 'clustering_cut'), to choose the
+    number of clusters without clustering again for every trial. Every cut splits one cluster of the previous
+    cut, so the sums of distances of the proteins to every cluster are updated incrementally: only the
+    distances to the smaller children of the split node are computed, the largest child gets the rest.
+    Parameters:
+    ----------
+    mat: ndarray
+        Distance matrix with the size of (n-1)*(n-1), see 'align2mat', can be memory-mapped.
+    df_pro_uni: ndarray
+        List of all protein IDs with the order of 'mat' rows.
+    tree_nwk: string
+        Tree in Newick format, leaves not in the matrix (e.g. the duplicates) are only counted in the sizes.
+    max_clusters: int
+        Largest number of clusters scored.
+    sample_size: int
+        If provided, the scores are computed for a random sample of this number of proteins against all
+        proteins, which is much faster for large trees. All proteins are used if not provided.
+    scores_path: string
+        If provided, the scores are saved in this path (e.g. PATH/cut_scores.txt).
+    Returns:
+    ----------
+    df_scores: pandas dataframe
+        For every cut: 'cluster_num'; 'cut_depth', the distance of the split node to the root; the mean
+        'silhouette' (0 for proteins alone in their cluster); the mean distance 'within' and 'between' the
+        clusters and their 'ratio' (smaller is better); the number of 'singletons' and the smallest,
+        median and largest cluster size."""
+    parent, length, names = tree_functions.nwk2arrays(tree_nwk)
+    layout = tree_functions.tree_layout(parent, length)
+    is_leaf = layout['is_leaf']
+    leaf_start, leaf_end = leaf_ranges(parent, is_leaf)
+    children = [[] for _ in range(parent.size)]
+    for ind_node in range(1, parent.size):
+        children[parent[ind_node]].append(ind_node)
+    # matrix row of every leaf in the order of the tree, -1 if it is not in the matrix
+    pro_index = pd.Series(np.arange(df_pro_uni.size), index=df_pro_uni)
+    leaf_mat = pro_index.reindex(np.array(names, dtype=object)[is_leaf]).fillna(-1).values.astype(int)
+    valid_cum = np.append(0, np.cumsum(leaf_mat >= 0))
+    pos_valid = np.where(leaf_mat >= 0)[0]
+    if sample_size is not None and sample_size < pos_valid.size:
+        pos_sample = np.sort(np.random.default_rng(seed).choice(pos_valid, size=sample_size, replace=False))
+    else:
+        pos_sample = pos_valid
+    ind_sample = leaf_mat[pos_sample]
+    num_valid = pos_valid.size
+    num_sample = pos_sample.size
+    block_rows = max(int(BLOCK_CELLS // max(num_sample, 1)), 1)
+
+    def sum_to(ind_node):
+        """Sum of the distances of the sampled proteins to all proteins under the node."""
+        cols = leaf_mat[leaf_start[ind_node]:leaf_end[ind_node]]
+        cols = cols[cols >= 0]
+        dis_sum = np.zeros(num_sample)
+        # by symmetry the distances to the node are read as rows, in blocks of 'BLOCK_CELLS'
+        for ind_start in range(0, cols.size, block_rows):
+            dis_sum += distance_rows(mat, cols[ind_start:ind_start + block_rows], ind_sample).sum(0)
+        return dis_sum
+
+    max_degree = max([len(i_children) for i_children in children] + [1])
+    # sums of the distances of every sampled protein to every cluster, one column (slot) per cluster
+    sum_slot = np.zeros([num_sample, max_clusters + max_degree])
+    count_slot = np.zeros(max_clusters + max_degree)
+    sum_slot[:, 0] = sum_to(0)
+    count_slot[0] = num_valid
+    sum_all = sum_slot[:, 0].copy()
+    slot_sample = np.zeros(num_sample, dtype=int)
+    slot_node = {0: 0}
+    sizes = {0: leaf_end[0] - leaf_start[0]}
+    num_slots = 1
+    heap = [(layout['depth'][0], 0)]
+    num_leaf_roots = 0
+    records = []
+    ind_row = np.arange(num_sample)
+    while len(heap) > 0 and len(heap) + num_leaf_roots < max_clusters:
+        depth, ind_node = heapq.heappop(heap)
+        if len(children[ind_node]) == 0:
+            num_leaf_roots += 1
+            continue
+        slot = slot_node.pop(ind_node)
+        del sizes[ind_node]
+        num_valid_child = [valid_cum[leaf_end[ind_child]] - valid_cum[leaf_start[ind_child]]
+                           for ind_child in children[ind_node]]
+        ind_largest = children[ind_node][int(np.argmax(num_valid_child))]
+        for ind_child in children[ind_node]:
+            heapq.heappush(heap, (layout['depth'][ind_child], ind_child))
+            sizes[ind_child] = leaf_end[ind_child] - leaf_start[ind_child]
+            if ind_child == ind_largest:
+                slot_node[ind_child] = slot
+                continue
+            slot_node[ind_child] = num_slots
+            sum_slot[:, num_slots] = sum_to(ind_child)
+            sum_slot[:, slot] -= sum_slot[:, num_slots]
+            count_slot[num_slots] = valid_cum[leaf_end[ind_child]] - valid_cum[leaf_start[ind_child]]
+            count_slot[slot] -= count_slot[num_slots]
+            in_child = (pos_sample >= leaf_start[ind_child]) & (pos_sample < leaf_end[ind_child])
+            slot_sample[in_child] = num_slots
+            num_slots += 1
+        # scores of the cut, a = mean distance to the own cluster, b = to the nearest other cluster
+        sum_own = sum_slot[ind_row, slot_sample]
+        count_own = count_slot[slot_sample]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_slot = sum_slot[:, :num_slots] / count_slot[:num_slots]
+            mean_slot[:, count_slot[:num_slots] == 0] = np.inf
+            mean_slot[ind_row, slot_sample] = np.inf
+            dis_a = sum_own / (count_own - 1)
+            dis_b = mean_slot.min(1)
+            silhouette = np.where(count_own > 1, (dis_b - dis_a) / np.maximum(dis_a, dis_b), 0.)
+            within = sum_own.sum() / (count_own - 1).sum() if (count_own > 1).any() else np.nan
+            between = (sum_all - sum_own).sum() / (num_valid - count_own).sum()
+        size_all = np.array(list(sizes.values()))
+        records.append({'cluster_num': len(heap) + num_leaf_roots, 'cut_depth': depth,
+                        'silhouette': silhouette.mean(), 'within': within, 'between': between,
+                        'ratio': within / between, 'singletons': int((size_all == 1).sum()),
+                        'size_min': int(size_all.min()), 'size_median': float(np.median(size_all)),
+                        'size_max': int(size_all.max())})
+    df_scores = pd.DataFrame(records, columns=['cluster_num', 'cut_depth', 'silhouette', 'within', 'between',
+                                               'ratio', 'singletons', 'size_min', 'size_median', 'size_max'])
+    if len(df_scores) > 0:
+        best = df_scores.loc[df_scores['silhouette'].idxmax()]
+        print('The best cut by silhouette has', int(best['cluster_num']), 'clusters, silhouette =',
+              round(best['silhouette'], 4))
+    if scores_path is not None:
+        df_scores.to_csv(scores_path, index=None, sep='\t')
+        print('The scores of the cuts are saved in: ', scores_path)
+    return df_scores
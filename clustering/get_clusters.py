@@ -1,57 +1,122 @@
 import clustering.tree_functions as tree_functions
+import clustering.sparse_clusters as sparse_clusters
+import clustering.cluster_stats as cluster_stats
+import clustering.rapid_nj as rapid_nj
 import pandas as pd
+import numpy as np
 import os
+import json
+import time
+import instrumentation
+import progress
 
 
+@instrumentation.timed('get_tree_file')
 def get_tree_file(path_similarity, method='nj', tm_score='average', path_tree_folder=None, tree_name=None, plot=0,
-                  clust_num=3, clust_save_path=None):
+                  clust_num=3, clust_save_path=None, pdb_list=None, duplicates_path=None, checkpoint_path=None,
+                  checkpoint_interval=3600, resume=0, matrix_path=None, n_threads=0, nj_search='full', normalize=1):
     """This is a function to generate a .nwk file, which can be uploaded to "https://itol.embl.de/"
-    to plot and edit the tree plot"""
-    # reform the pair-wise similarity form to a similarity matrix
-    mat, df_pro_uni = tree_functions.align2mat(path_similarity, tm_score=tm_score)
-    # get the nearest proteins and update the similarity matrix
-    if method == 'upgma':
-        mat_new, row, col, min_dis = tree_functions.update_mat_upgma(mat, df_pro_uni.size - 1)
-    elif method == 'nj':
-        mat_new, row, col, min_dis1, min_dis2 = tree_functions.update_mat_nj(mat, df_pro_uni.size - 1)
+    to plot and edit the tree plot. If the pairs were prefiltered, provide 'pdb_list' so the skipped
+    pairs get the largest distance. If the list was deduplicated, provide the 'duplicates.txt' file as
+    'duplicates_path' to add the duplicates back to the tree. If 'checkpoint_path' (a folder) is provided,
+    the state of the tree loop is saved every 'checkpoint_interval' seconds, and with resume=1 the tree
+    building continues from the last checkpoint instead of starting over, see 'save_checkpoint'. With
+    plot=1 the full tree is plotted with 'clust_num' colored clusters; for large trees use plot='overview'
+    (.png) or plot='svg' to collapse every cluster into one wedge, see 'tree_functions.plot_overview'. If
+    'matrix_path' (a .npy file) is provided, the distance matrix is saved before the tree loop, so the
+    statistics of the clusters can be computed later without reading the pair-wise similarity again, see
+    'clustering_upward'. With n_threads > 0, every NJ merge step runs on 'n_threads' threads with
+    'tree_functions.update_mat_nj_parallel', which gives the same tree as the original serial step (n_threads=0).
+    With nj_search='rapid', the NJ merges use the bounded search of 'rapid_nj.RapidNJ', which only scans a
+    part of the matrix in every merge and gives the same tree as the full search (nj_search='full'). With
+    normalize=0, the distances are 1 - TM-score without the min-max normalization of 'align2mat', so the
+    branch lengths of trees of different sets are on the same scale."""
+    if nj_search == 'rapid':
+        def update_mat_nj(mat, len_matrix):
+            # the search keeps its state between the merges and takes the place of the matrix in the loop
+            if not isinstance(mat, rapid_nj.RapidNJ):
+                mat = rapid_nj.RapidNJ(mat)
+            row, col, min_dis1, min_dis2 = mat.update(len_matrix)
+            return mat, row, col, min_dis1, min_dis2
+    elif n_threads:
+        def update_mat_nj(mat, len_matrix):
+            return tree_functions.update_mat_nj_parallel(mat, len_matrix, n_threads=n_threads)
     else:
-        print('Wrong clustering method defined, or the ', method, ' is still not implemented, using '
-                                                                  'NJ method instead')
-        mat_new, row, col, min_dis1, min_dis2 = tree_functions.update_mat_nj(mat, df_pro_uni.size - 1)
-    # get all protein IDs
-    name_all = tree_functions.add_p(df_pro_uni)
-    # initialize the list, which will then saved as the .nwk file
-    name_distances = list(df_pro_uni)
-    # get the nearest two protein IDs
-    pro_pre = name_all[row]
-    pro_post = name_all[col + 1]
-    pro_pre_dis = name_distances[row]
-    pro_post_dis = name_distances[col + 1]
-    # update the list of all protein IDs by combining the two proteins and delet the later one
-    name_all[row] = '(' + pro_pre + ',' + pro_post + ')'
-    labels = [[[pro_pre, pro_post]]]
-    if method == 'upgma':
-        distances = [[min_dis]]
-        name_distances[row] = '(' + pro_pre_dis + ':' + str(min_dis) + ',' + pro_post_dis + ':' \
-                          + str(min_dis) + ')'
+        update_mat_nj = tree_functions.update_mat_nj
+    state = None
+    if resume and checkpoint_path is not None:
+        state = load_checkpoint(checkpoint_path)
+    if state is None:
+        # reform the pair-wise similarity form to a similarity matrix
+        mat, df_pro_uni = tree_functions.align2mat(path_similarity, tm_score=tm_score, pdb_list=pdb_list,
+                                                   normalize=normalize)
+        if matrix_path is not None:
+            save_matrix(matrix_path, mat, df_pro_uni)
+        # get the nearest proteins and update the similarity matrix
+        if method == 'upgma':
+            mat_new, row, col, min_dis = tree_functions.update_mat_upgma(mat, df_pro_uni.size - 1)
+        elif method == 'nj':
+            mat_new, row, col, min_dis1, min_dis2 = update_mat_nj(mat, df_pro_uni.size - 1)
+        else:
+            print('Wrong clustering method defined, or the ', method, ' is still not implemented, using '
+                                                                      'NJ method instead')
+            mat_new, row, col, min_dis1, min_dis2 = update_mat_nj(mat, df_pro_uni.size - 1)
+        # get all protein IDs
+        name_all = tree_functions.add_p(df_pro_uni)
+        # initialize the list, which will then saved as the .nwk file
+        name_distances = list(df_pro_uni)
+        # get the nearest two protein IDs
+        pro_pre = name_all[row]
+        pro_post = name_all[col + 1]
+        pro_pre_dis = name_distances[row]
+        pro_post_dis = name_distances[col + 1]
+        # update the list of all protein IDs by combining the two proteins and delet the later one
+        name_all[row] = '(' + pro_pre + ',' + pro_post + ')'
+        labels = [[[pro_pre, pro_post]]]
+        if method == 'upgma':
+            distances = [[min_dis]]
+            name_distances[row] = '(' + pro_pre_dis + ':' + str(min_dis) + ',' + pro_post_dis + ':' \
+                              + str(min_dis) + ')'
+        else:
+            distances1 = [[min_dis1]]
+            distances2 = [[min_dis2]]
+            name_distances[row] = '(' + pro_pre_dis + ':' + str(min_dis1) + ',' + pro_post_dis + ':' \
+                                  + str(min_dis2) + ')'
+        # remove the later protein
+        name_all.pop(col + 1)
+        name_distances.pop(col + 1)
+        # size of matrix, it was (n-1), and then removed one, thus (n-2)
+        len_mat = df_pro_uni.size - 2
+        start_loop = 0
     else:
-        distances1 = [[min_dis1]]
-        distances2 = [[min_dis2]]
-        name_distances[row] = '(' + pro_pre_dis + ':' + str(min_dis1) + ',' + pro_post_dis + ':' \
-                              + str(min_dis2) + ')'
-    # remove the later protein
-    name_all.pop(col + 1)
-    name_distances.pop(col + 1)
-    # size of matrix, it was (n-1), and then removed one, thus (n-2)
-    len_mat = df_pro_uni.size - 2
+        # continue from the last checkpoint, the pair-wise similarity is not needed again
+        method = state['method']
+        mat_new = state['mat']
+        name_all = state['name_all']
+        name_distances = state['name_distances']
+        labels = state['labels']
+        distances = state.get('distances')
+        distances1 = state.get('distances1')
+        distances2 = state.get('distances2')
+        len_mat = state['len_mat']
+        start_loop = state['next_loop']
+        print('Tree building resumed from the checkpoint at merge ', start_loop, ' of ', len_mat)
+    time_checkpoint = time.time()
     # loop over the similarity matrix, remove one dimension in each step
-    for iloop in range(len_mat):
+    tree_stage = instrumentation.start_stage('tree_loop_' + method)
+    profiler = instrumentation.start_profiler()
+    # the merges before 'start_loop' (e.g. from the checkpoint) are not counted for the rate
+    cost_all = progress.merge_cost(len_mat)
+    tree_progress = progress.Progress('tree_loop_' + method, cost_all, unit='cells',
+                                      done_start=cost_all - progress.merge_cost(len_mat - start_loop))
+    for iloop in range(start_loop, len_mat):
+        time_merge = time.perf_counter()
         mat = mat_new
         # update matrix
         if method == 'upgma':
             mat_new, row, col, min_dis = tree_functions.update_mat_upgma(mat, len_mat - iloop)
         else:
-            mat_new, row, col, min_dis1, min_dis2 = tree_functions.update_mat_nj(mat, len_mat - iloop)
+            mat_new, row, col, min_dis1, min_dis2 = update_mat_nj(mat, len_mat - iloop)
         # first protein ID
         pro_pre = name_all[row]
         pro_pre_dis = name_distances[row]
@@ -111,6 +176,28 @@ def get_tree_file(path_similarity, method='nj', tm_score='average', path_tree_fo
                                                     name_distances, pro_pre_dis, pro_post_dis)
         name_all.pop(col + 1)
         name_distances.pop(col + 1)
+        instrumentation.record_merge(iloop, len_mat - iloop, time.perf_counter() - time_merge)
+        tree_progress.update(tree_progress.total - progress.merge_cost(len_mat - iloop - 1))
+        if checkpoint_path is not None and time.time() - time_checkpoint >= checkpoint_interval:
+            if isinstance(mat_new, rapid_nj.RapidNJ):
+                mat_save = mat_new.matrix()
+            else:
+                mat_save = mat_new
+            state = {'method': method, 'mat': mat_save, 'name_all': name_all, 'name_distances': name_distances,
+                     'labels': labels, 'len_mat': len_mat, 'next_loop': iloop + 1}
+            if method == 'upgma':
+                state['distances'] = distances
+            else:
+                state['distances1'] = distances1
+                state['distances2'] = distances2
+            save_checkpoint(checkpoint_path, state)
+            time_checkpoint = time.time()
+    if profiler is not None:
+        profiler.stop()
+    tree_progress.finish()
+    instrumentation.end_stage(tree_stage)
+    if checkpoint_path is not None:
+        remove_checkpoint(checkpoint_path)
     if tree_name is None:
         tree_name = 'tree_' + method + '.nwk'
     if path_tree_folder is None:
@@ -122,27 +209,126 @@ def get_tree_file(path_similarity, method='nj', tm_score='average', path_tree_fo
             os.makedirs(path_tree_folder)
 
     save_tree_path = os.path.join(path_tree_folder, tree_name)
+    tree_nwk = name_distances[0]
+    if duplicates_path is not None:
+        tree_nwk = tree_functions.expand_duplicates(tree_nwk, load_duplicates(duplicates_path))
     file_tree = open(save_tree_path, 'w')
-    file_tree.write(name_distances[0])
+    file_tree.write(tree_nwk)
     file_tree.close()
     print('The nwk file for tree plot is saved in: ', save_tree_path)
 
-    if plot:
-        if method == 'upgma':
-            fig_save_path = os.path.join(path_tree_folder, 'treeplot.png')
-            fig, ax = tree_functions.plot_tree(clust_num, name_all, labels, distances)
-            fig.savefig(fig_save_path)
-        else:
-            print('Sorry, we only support the printing of simple tree plot using UPGMA method, update'
-                  'will come later, thank you for your understanding!')
+    if plot == 'overview':
+        fig_save_path = os.path.join(path_tree_folder, 'treeplot_overview.png')
+        fig, ax = tree_functions.plot_overview(clust_num, tree_nwk)
+        fig.savefig(fig_save_path, bbox_inches='tight')
+    elif plot == 'svg':
+        tree_functions.write_overview_svg(os.path.join(path_tree_folder, 'treeplot_overview.svg'), clust_num,
+                                          tree_nwk)
+    elif plot:
+        fig_save_path = os.path.join(path_tree_folder, 'treeplot.png')
+        fig, ax = tree_functions.plot_tree(clust_num, tree_nwk)
+        fig.savefig(fig_save_path)
 
     return labels, path_tree_folder
 
 
-def clustering_upward(labels, node_number_upward, path_tree_folder):
+def save_checkpoint(checkpoint_path, state):
+    """Save the state of the tree loop: the current distance matrix as 'mat_<merge>.npy', which can be
+    loaded with memory mapping, and all other values as 'state.json'. The state file is replaced atomically
+    after the matrix is written, and points to its matrix, so a kill during the saving leaves the last
+    complete checkpoint."""
+    if not os.path.exists(checkpoint_path):
+        os.makedirs(checkpoint_path)
+    mat_file = 'mat_' + str(state['next_loop']) + '.npy'
+    np.save(os.path.join(checkpoint_path, mat_file), state['mat'])
+    state_json = dict(state, mat=mat_file)
+    tmp_path = os.path.join(checkpoint_path, 'state.json.tmp')
+    tmp_file = open(tmp_path, 'w')
+    # numpy floats of the branch lengths are saved as python floats
+    json.dump(state_json, tmp_file, default=float)
+    tmp_file.close()
+    os.replace(tmp_path, os.path.join(checkpoint_path, 'state.json'))
+    for old_file in os.listdir(checkpoint_path):
+        if old_file.startswith('mat_') and old_file != mat_file:
+            os.remove(os.path.join(checkpoint_path, old_file))
+    print('Checkpoint of the tree loop saved at merge ', state['next_loop'], ' in: ', checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path):
+    """Load the state saved by 'save_checkpoint', the matrix is memory-mapped, returns None if there is no
+    checkpoint."""
+    state_path = os.path.join(checkpoint_path, 'state.json')
+    if not os.path.exists(state_path):
+        print('No checkpoint found in: ', checkpoint_path, ', starting from the beginning.')
+        return None
+    state_file = open(state_path, 'r')
+    state = json.load(state_file)
+    state_file.close()
+    state['mat'] = np.load(os.path.join(checkpoint_path, state['mat']), mmap_mode='r')
+    return state
+
+
+def remove_checkpoint(checkpoint_path):
+    """Remove the checkpoint after the tree is finished, so it is not resumed by mistake."""
+    for old_file in os.listdir(checkpoint_path) if os.path.exists(checkpoint_path) else []:
+        if old_file.startswith('mat_') or old_file.startswith('state.json'):
+            os.remove(os.path.join(checkpoint_path, old_file))
+
+
+def save_matrix(matrix_path, mat, df_pro_uni):
+    """Save the distance matrix of 'align2mat' as a .npy file, and the protein IDs of its rows in
+    '<matrix_path without .npy>_ids.txt'."""
+    if not os.path.exists(os.path.dirname(os.path.abspath(matrix_path))):
+        os.makedirs(os.path.dirname(os.path.abspath(matrix_path)))
+    np.save(matrix_path, mat)
+    pd.DataFrame(df_pro_uni).to_csv(matrix_path[:-4] + '_ids.txt', header=None, index=None)
+    print('The distance matrix is saved in: ', matrix_path)
+
+
+def load_matrix(matrix_path):
+    """Load the distance matrix saved by 'save_matrix', the matrix is memory-mapped."""
+    mat = np.load(matrix_path, mmap_mode='r')
+    df_pro_uni = pd.read_csv(matrix_path[:-4] + '_ids.txt', header=None, dtype=str, keep_default_na=False)[0].values
+    return mat, df_pro_uni
+
+
+def load_duplicates(duplicates_path):
+    """Load the 'duplicates.txt' file generated by 'get_lists' with dedup=1.
+    Returns:
+    ----------
+    duplicates: dict
+        List of duplicated protein IDs, with the ID of the representative as key."""
+    df_dup = pd.read_csv(duplicates_path, sep='\t', dtype=str)
+    duplicates = {}
+    for rep_id, dup_id in zip(df_dup['representative'], df_dup['duplicate']):
+        if rep_id not in duplicates:
+            duplicates[rep_id] = []
+        duplicates[rep_id].append(dup_id)
+    return duplicates
+
+
+@instrumentation.timed('clustering_upward')
+def clustering_upward(labels, node_number_upward, path_tree_folder, duplicates_path=None, matrix_path=None):
+    """Cluster the proteins from the labels of the tree. If 'matrix_path' is provided (the matrix saved by
+    'get_tree_file'), the medoid and the similarities of every cluster are saved in 'cluster_stats.txt'
+    next to 'cluster_info.txt', see 'cluster_stats.cluster_statistics'."""
     cluster_list = tree_functions.get_clusters(labels, node_number_upward)
     if cluster_list[-1] == []:
         cluster_list = cluster_list[:-1]
+    df_clusters = save_cluster_info(cluster_list, path_tree_folder, duplicates_path=duplicates_path)
+    if matrix_path is not None:
+        mat, df_pro_uni = load_matrix(matrix_path)
+        cluster_stats.cluster_statistics(mat, df_pro_uni, df_clusters,
+                                         stats_path=os.path.join(path_tree_folder, 'cluster_stats.txt'))
+    return df_clusters
+
+
+def save_cluster_info(cluster_list, path_tree_folder, duplicates_path=None):
+    """Save the lists of protein IDs of all clusters in the 'cluster_info.txt' file. If 'duplicates_path'
+    is provided, the duplicates are added to the cluster of their representative."""
+    duplicates = {}
+    if duplicates_path is not None:
+        duplicates = load_duplicates(duplicates_path)
     list_cluster = []
     list_pro = []
     for ind_cluster, i_cluster in enumerate(cluster_list):
@@ -150,6 +336,9 @@ def clustering_upward(labels, node_number_upward, path_tree_folder):
         for pro_id in i_cluster:
             list_cluster.append(num_cluster + 1)
             list_pro.append(pro_id)
+            for dup_id in duplicates.get(pro_id, []):
+                list_cluster.append(num_cluster + 1)
+                list_pro.append(dup_id)
     data_clusters = {'cluster_number': list_cluster, 'protein_ID': list_pro}
     df_clusters = pd.DataFrame(data_clusters)
     clusters_file = 'cluster_info.txt'
@@ -158,10 +347,92 @@ def clustering_upward(labels, node_number_upward, path_tree_folder):
     print('The information of clusters is saved in: ', clusters_save_path)
     return df_clusters
 
-def clustering_downward(labels, node_number_downward, path_tree_folder):
+
+@instrumentation.timed('clustering_sparse')
+def clustering_sparse(path_similarity, tm_cutoff=0.5, method='components', tm_score='average',
+                      path_tree_folder=None, pdb_list=None, duplicates_path=None):
+    """Cluster the proteins using a sparse similarity graph, which only keeps the pairs with a TM-score not
+    smaller than 'tm_cutoff', so the memory scales with the number of similar pairs instead of n*n.
+    The clusters are saved in the same 'cluster_info.txt' format as 'clustering_upward'.
+    Parameters:
+    ----------
+    path_similarity: string
+        Path for the pair-wise similarity file (e.g. PATH/alignment_all.txt)
+    tm_cutoff: float
+        Smallest TM-score of two connected proteins.
+    method: string
+        'components': connected components, i.e. single linkage clustering cut at 'tm_cutoff';
+        'centroid': greedy centroid clustering, every protein is connected to the centroid of its cluster.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names (optional), needed to keep the proteins without any alignment
+        (e.g. skipped by the prefilter) as single clusters.
+    duplicates_path: string
+        Path of the 'duplicates.txt' file (optional), the duplicates are added to the cluster of their
+        representative."""
+    indptr, indices, data, df_pro_uni = sparse_clusters.align2graph(path_similarity, tm_cutoff=tm_cutoff,
+                                                                    tm_score=tm_score, pdb_list=pdb_list)
+    if method == 'centroid':
+        labels, centroids = sparse_clusters.greedy_centroid(indptr, indices)
+    else:
+        if method != 'components':
+            print('Wrong clustering method defined, or the ', method, ' is still not implemented, using '
+                                                                      'connected components instead')
+        labels = sparse_clusters.connected_components(indptr, indices)
+    cluster_list = sparse_clusters.labels2clusters(labels, df_pro_uni)
+    if path_tree_folder is None:
+        alignfolder = os.path.dirname(path_similarity)
+        path_tree_folder = os.path.join(alignfolder, 'trees')
+        if not os.path.exists(path_tree_folder):
+            os.makedirs(path_tree_folder)
+    print('Sparse similarity graph with ', df_pro_uni.size, ' proteins and ', indices.size // 2, ' edges.')
+    df_clusters = save_cluster_info(cluster_list, path_tree_folder, duplicates_path=duplicates_path)
+    return df_clusters
+
+
+@instrumentation.timed('score_tree_cuts')
+def score_tree_cuts(tree_path, matrix_path, max_clusters=50, sample_size=None):
+    """Score the cuts of the tree saved by 'get_tree_file' into 2 ... 'max_clusters' clusters against the distance
+    matrix saved with 'matrix_path', and save the scores as 'cut_scores.txt' next to the tree, see
+    'cluster_stats.score_cuts'. The chosen number of clusters can then be used with 'clustering_cut'."""
+    tree_file = open(tree_path, 'r')
+    tree_nwk = tree_file.read()
+    tree_file.close()
+    mat, df_pro_uni = load_matrix(matrix_path)
+    return cluster_stats.score_cuts(mat, df_pro_uni, tree_nwk, max_clusters=max_clusters, sample_size=sample_size,
+                                    scores_path=os.path.join(os.path.dirname(tree_path), 'cut_scores.txt'))
+
+
+@instrumentation.timed('clustering_cut')
+def clustering_cut(tree_path, cluster_num, path_tree_folder=None, matrix_path=None):
+    """Cluster the proteins by cutting the tree saved by 'get_tree_file' into 'cluster_num' clusters from the
+    top down, the same clusters as the colors of the tree plot with clust_num = cluster_num. The clusters are
+    saved in 'cluster_info.txt' in the folder of the tree (or 'path_tree_folder'), and their statistics if
+    'matrix_path' is provided, see 'clustering_upward'. The duplicates are already in the tree."""
+    tree_file = open(tree_path, 'r')
+    tree_nwk = tree_file.read()
+    tree_file.close()
+    if path_tree_folder is None:
+        path_tree_folder = os.path.dirname(tree_path)
+    parent, length, names = tree_functions.nwk2arrays(tree_nwk)
+    layout = tree_functions.tree_layout(parent, length)
+    cluster = tree_functions.get_cut_clusters(parent, layout, cluster_num)
+    cluster_list = [[] for _ in range(cluster.max() + 1)]
+    for ind_node in np.where(layout['is_leaf'])[0]:
+        cluster_list[cluster[ind_node]].append(names[ind_node])
+    df_clusters = save_cluster_info(cluster_list, path_tree_folder)
+    if matrix_path is not None:
+        mat, df_pro_uni = load_matrix(matrix_path)
+        cluster_stats.cluster_statistics(mat, df_pro_uni, df_clusters,
+                                         stats_path=os.path.join(path_tree_folder, 'cluster_stats.txt'))
+    return df_clusters
+
+
+@instrumentation.timed('clustering_downward')
+def clustering_downward(labels, node_number_downward, path_tree_folder, duplicates_path=None, matrix_path=None):
     if node_number_downward > len(labels):
         print('The defined number of nodes is too large, please provide a number smaller than ', len(labels))
         exit()
     node_number_upward = len(labels) - node_number_downward
-    df = clustering_upward(labels, node_number_upward, path_tree_folder)
+    df = clustering_upward(labels, node_number_upward, path_tree_folder, duplicates_path=duplicates_path,
+                           matrix_path=matrix_path)
     return df
@@ -0,0 +1,195 @@
+import numpy as np
+import clustering.tree_functions as tree_functions
+
+
+# relative error allowed for the running row sums, the candidates within this margin of the smallest Q-value
+# are checked again with the row sums of 'tree_functions.get_r_mat'
+NJ_TOLERANCE = 1e-9
+# number of matrix rows sorted at once when the search starts, bounds the temporary arrays
+SORT_CHUNK_ROWS = 256
+# number of sorted columns of the first block of the scan, doubled for every further block
+SCAN_COLUMNS = 8
+# the sorted rows are rebuilt when the number of nodes drops below this fraction, which removes the entries
+# of the joined nodes and shrinks the arrays
+REBUILD_FRACTION = 0.75
+
+
+class RapidNJ:
+    """Bounded search of the NJ tree loop in the way of RapidNJ (Simonsen et al. 2008): the distances of every
+    row are kept sorted, and with the running row sums r, the Q-value of a pair (i, j) is at least
+    d(i, j) - (r[i] + max(r)) / (n - 2). A row is only scanned if its smallest distance can beat the best
+    Q-value found so far, and only up to the distance where the bound gets larger than the best value. The
+    rows are scanned together in blocks of sorted columns, every block drops the rows that are done.
+    The merges are the same as with 'tree_functions.update_mat_nj', including the branch lengths and the new
+    distances to the last bit: the running row sums only select the candidates, which are then compared
+    with the row sums of the original search, and the distances are updated with the same formula.
+    The matrix is kept between the merges with one slot per node, the joined node takes the slot of the
+    first of the two nodes, so the order of the slots is the order of the rows of the original matrix.
+    Parameters:
+    ----------
+    mat: ndarray
+        (n-1)*(n-1) matrix of 'align2mat' (or of a checkpoint), the entry [i, j] is the distance between
+        the i-th and the (j+1)-th protein."""
+    def __init__(self, mat):
+        self.num_scanned = 0
+        self.build(mat)
+
+    def build(self, mat):
+        """Full distances, row sums and sorted rows of the matrix."""
+        num_pro = mat.shape[0] + 1
+        self.dis = np.zeros([num_pro, num_pro])
+        self.dis[:-1, 1:] = np.triu(mat)
+        self.dis += self.dis.T
+        self.active = np.ones(num_pro, dtype=bool)
+        # node ID in every slot, the joined nodes get new IDs, so the sorted entries of the joined nodes
+        # are recognized as outdated; the last ID is never alive and fills the end of the shorter rows
+        self.node = np.arange(num_pro)
+        self.slot_of = np.zeros(2 * num_pro + 1, dtype=int)
+        self.slot_of[:num_pro] = self.node
+        self.alive = np.zeros(2 * num_pro + 1, dtype=bool)
+        self.alive[:num_pro] = True
+        self.next_id = num_pro
+        self.r = self.dis.sum(axis=1)
+        self.sorted_dis = np.empty([num_pro, max(num_pro - 1, 1)])
+        self.sorted_ids = np.empty([num_pro, max(num_pro - 1, 1)], dtype=np.int32 if num_pro < 2 ** 30 else int)
+        for chunk_start in range(0, num_pro, SORT_CHUNK_ROWS):
+            chunk_end = min(chunk_start + SORT_CHUNK_ROWS, num_pro)
+            chunk = self.dis[chunk_start:chunk_end].copy()
+            # the protein itself is sorted to the end and dropped
+            chunk[np.arange(chunk_end - chunk_start), np.arange(chunk_start, chunk_end)] = np.inf
+            order = np.argsort(chunk, axis=1, kind='stable')[:, :num_pro - 1]
+            self.sorted_dis[chunk_start:chunk_end, :num_pro - 1] = np.take_along_axis(chunk, order, axis=1)
+            self.sorted_ids[chunk_start:chunk_end, :num_pro - 1] = order
+
+    def matrix(self):
+        """Current (n-1)*(n-1) matrix in the form of 'align2mat', the same values as the matrix of the
+        original tree loop, e.g. for the checkpoints."""
+        slots = np.flatnonzero(self.active)
+        mat = self.dis[np.ix_(slots[:-1], slots[1:])]
+        mat[np.tril_indices(slots.size - 1, k=-1)] = tree_functions.LOWER_VALUE
+        return mat
+
+    def exact_r(self, slot, slots):
+        """Row sum of one node in the same order as 'tree_functions.get_r_mat': the nodes after it, then the
+        nodes before it, added one after another."""
+        values = np.concatenate([self.dis[slot, slots[slots > slot]], self.dis[slot, slots[slots < slot]]])
+        return np.cumsum(values)[-1]
+
+    def search(self, slots):
+        """Candidates for the smallest Q-value with the running row sums.
+        Returns:
+        ----------
+        pairs: ndarray
+            Slots of the candidate pairs, the pair with the smallest Q-value of the original search is
+            always one of them."""
+        denom = slots.size - 2
+        rows = slots
+        r_rows = self.r[slots]
+        r_max = r_rows.max()
+        margin = NJ_TOLERANCE * (2 * np.abs(r_rows).max() / denom + 1)
+        # the first pairs of the rows give the first upper bound
+        front_ids = self.sorted_ids[rows, 0]
+        q_front = self.sorted_dis[rows, 0] - (r_rows + self.r[self.slot_of[front_ids]]) / denom
+        best = q_front[self.alive[front_ids]].min()
+        pairs = []
+        start = 0
+        width = SCAN_COLUMNS
+        while start < self.sorted_dis.shape[1]:
+            # largest distance of every row that can still beat the best Q-value, the rows with a larger
+            # next distance are done
+            max_dis = best + 2 * margin + (r_rows + r_max) / denom
+            open_rows = self.sorted_dis[rows, start] <= max_dis
+            rows = rows[open_rows]
+            if rows.size == 0:
+                break
+            r_rows = r_rows[open_rows]
+            max_dis = max_dis[open_rows]
+            block_dis = self.sorted_dis[rows, start:start + width]
+            block_ids = self.sorted_ids[rows, start:start + width]
+            others = self.slot_of[block_ids]
+            q_block = block_dis - (r_rows[:, None] + self.r[others]) / denom
+            q_block[~self.alive[block_ids] | (block_dis > max_dis[:, None])] = np.inf
+            self.num_scanned += block_dis.size
+            best = min(best, q_block.min())
+            ind_rows, ind_cols = np.nonzero(q_block <= best + 2 * margin)
+            pairs.append(np.stack([rows[ind_rows], others[ind_rows, ind_cols]], axis=1))
+            start += width
+            width *= 2
+        pairs = np.sort(np.concatenate(pairs), axis=1)
+        q_pairs = self.dis[pairs[:, 0], pairs[:, 1]] - (self.r[pairs[:, 0]] + self.r[pairs[:, 1]]) / denom
+        return pairs[q_pairs <= best + 2 * margin]
+
+    def update(self, len_matrix):
+        """One merge of the tree loop, the same results as 'tree_functions.update_mat_nj' on the current
+        matrix.
+        Parameters:
+        ----------
+        len_matrix: int
+            Size of the current matrix, the number of nodes - 1.
+        Returns:
+        ----------
+        row, col, min_dis1, min_dis2:
+            Same as 'tree_functions.update_mat_nj'."""
+        slots = np.flatnonzero(self.active)
+        if slots.size != len_matrix + 1:
+            raise ValueError('The matrix has ' + str(slots.size - 1) + ' rows, not ' + str(len_matrix))
+        if slots.size > 2 and slots.size < REBUILD_FRACTION * self.active.size:
+            self.build(self.matrix())
+            slots = np.flatnonzero(self.active)
+        if len_matrix == 1:
+            slot1, slot2 = slots
+            row, col = 0, 0
+            min_dis1 = self.dis[slot1, slot2] / 2
+            min_dis2 = self.dis[slot1, slot2] - min_dis1
+        else:
+            # the candidates are compared with the row sums and Q-values of the original search
+            pairs = self.search(slots)
+            r_exact = {}
+            for slot in np.unique(pairs):
+                r_exact[slot] = self.exact_r(slot, slots)
+            best = None
+            # in the order of the rows and columns, so the first smallest value is kept as with 'argmin'
+            for slot1, slot2 in sorted(set(map(tuple, pairs.tolist()))):
+                q_exact = self.dis[slot1, slot2] - (r_exact[slot1] + r_exact[slot2]) / (len_matrix - 1)
+                if best is None or q_exact < best[0]:
+                    best = (q_exact, slot1, slot2)
+            q_min, slot1, slot2 = best
+            row = int(np.count_nonzero(slots < slot1))
+            col = int(np.count_nonzero(slots < slot2)) - 1
+            # the original search takes the argmin over the full matrix, where the cells below the diagonal
+            # are 1.0001, which only wins if all Q-values are larger, that case is left to 'update_mat_nj'
+            if not q_min < tree_functions.LOWER_VALUE and not (q_min == tree_functions.LOWER_VALUE and row == 0):
+                mat_new, row, col, min_dis1, min_dis2 = tree_functions.update_mat_nj(self.matrix(), len_matrix)
+                self.build(mat_new)
+                return row, col, min_dis1, min_dis2
+            min_dis1 = self.dis[slot1, slot2] / 2 + (r_exact[slot1] - r_exact[slot2]) / (2 * (len_matrix - 1))
+            min_dis2 = self.dis[slot1, slot2] - min_dis1
+        self.join(slots, slot1, slot2)
+        # it is possible for NJ method to allocate negative length for branches, thus reset them to 0.01
+        if min_dis1 < 0:
+            min_dis1 = 0.01
+        if min_dis2 < 0:
+            min_dis2 = 0.01
+        return row, col, min_dis1, min_dis2
+
+    def join(self, slots, slot1, slot2):
+        """Join the nodes in slot1 and slot2 into a new node in slot1, with the distances of the original
+        tree loop, and update the running row sums and the sorted rows."""
+        others = slots[(slots != slot1) & (slots != slot2)]
+        dis_new = (self.dis[slot1, others] + self.dis[slot2, others] - self.dis[slot1, slot2]) / 2
+        self.r[others] += dis_new - self.dis[slot1, others] - self.dis[slot2, others]
+        self.r[slot1] = dis_new.sum()
+        self.dis[slot1, others] = dis_new
+        self.dis[others, slot1] = dis_new
+        self.active[slot2] = False
+        self.alive[self.node[slot1]] = False
+        self.alive[self.node[slot2]] = False
+        self.node[slot1] = self.next_id
+        self.slot_of[self.next_id] = slot1
+        self.alive[self.next_id] = True
+        self.next_id += 1
+        order = np.argsort(dis_new, kind='stable')
+        self.sorted_dis[slot1, :others.size] = dis_new[order]
+        self.sorted_dis[slot1, others.size:] = np.inf
+        self.sorted_ids[slot1, :others.size] = self.node[others[order]]
+        self.sorted_ids[slot1, others.size:] = self.alive.size - 1
@@ -0,0 +1,142 @@
+import pandas as pd
+import numpy as np
+from collections import deque
+
+
+def get_tm(df, tm_score='average'):
+    """Get the TM-score used for clustering from a chunk of the pair-wise similarity file, the options
+    are the same as in 'align2mat'."""
+    if tm_score == 'TM1':
+        return df['TM1'].values
+    elif tm_score == 'TM2':
+        return df['TM2'].values
+    elif tm_score == 'long':
+        return np.minimum(df['TM1'].values, df['TM2'].values)
+    elif tm_score == 'short':
+        return np.maximum(df['TM1'].values, df['TM2'].values)
+    return (df['TM1'].values + df['TM2'].values) / 2
+
+
+def align2graph(pairwise_sim_path, tm_cutoff=0.5, tm_score='average', pdb_list=None, chunksize=1000000):
+    """This is a function to reform the pair-wise similarity to a sparse similarity graph in CSR format,
+    only the pairs with a TM-score not smaller than 'tm_cutoff' are kept. The pair-wise similarity file
+    is read in chunks, so the memory scales with the number of kept pairs instead of n*n.
+    Parameters:
+    ----------
+    pairwise_sim_path: string
+        Path for the pair-wise similarity file (e.g. PATH/alignment_all.txt)
+    tm_cutoff: float
+        Smallest TM-score of the kept pairs.
+    tm_score: string
+        Values of TM-score to use for clustering, same as in 'align2mat'.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names (optional). If provided, it defines the order of the nodes,
+        otherwise the protein IDs are ordered as they appear in the pair-wise similarity file.
+    chunksize: int
+        Number of rows of the pair-wise similarity file to read at once.
+    Returns:
+    ----------
+    indptr: ndarray
+        Row pointers of the CSR graph, the neighbours of node i are indices[indptr[i]:indptr[i+1]].
+    indices: ndarray
+        Neighbour of each edge.
+    data: ndarray
+        TM-score of each edge.
+    df_pro_uni: ndarray
+        List of all protein IDs with the order of the nodes."""
+    name_index = {}
+    if pdb_list is not None:
+        for pro_id in pdb_list[0].str[:-4]:
+            name_index[pro_id] = len(name_index)
+    list_row = []
+    list_col = []
+    list_tm = []
+    for df in pd.read_csv(pairwise_sim_path, index_col=None, sep='\t', chunksize=chunksize,
+                          dtype={'PDBchain1': str, 'PDBchain2': str}):
+        # new protein IDs get the next node numbers
+        for pro_id in pd.unique(np.append(df.PDBchain1.values, df.PDBchain2.values)):
+            if pro_id not in name_index:
+                name_index[pro_id] = len(name_index)
+        tm = get_tm(df, tm_score=tm_score)
+        keep = tm >= tm_cutoff
+        list_row.append(df.PDBchain1.values[keep])
+        list_col.append(df.PDBchain2.values[keep])
+        list_tm.append(tm[keep])
+    pro_index = pd.Series(name_index)
+    num_pro = len(name_index)
+    if len(list_row) > 0:
+        row = pro_index[np.concatenate(list_row)].values
+        col = pro_index[np.concatenate(list_col)].values
+        tm = np.concatenate(list_tm)
+    else:
+        row = col = np.array([], dtype=int)
+        tm = np.array([])
+    # store both directions of each edge
+    row, col = np.append(row, col), np.append(col, row)
+    tm = np.append(tm, tm)
+    order = np.lexsort((col, row))
+    indices = col[order]
+    data = tm[order]
+    indptr = np.append(0, np.cumsum(np.bincount(row, minlength=num_pro)))
+    return indptr, indices, data, pro_index.index.values
+
+
+def connected_components(indptr, indices):
+    """Clusters as the connected components of the graph, which is the same as single linkage clustering
+    cut at the TM-score cutoff of the graph. Linear in the number of nodes and edges.
+    Returns:
+    ----------
+    labels: ndarray
+        Cluster number of each node, starting from 0."""
+    num_pro = indptr.size - 1
+    labels = np.full(num_pro, -1)
+    num_cluster = 0
+    for start in range(num_pro):
+        if labels[start] >= 0:
+            continue
+        labels[start] = num_cluster
+        queue = deque([start])
+        while len(queue) != 0:
+            node = queue.popleft()
+            for neighbour in indices[indptr[node]:indptr[node + 1]]:
+                if labels[neighbour] < 0:
+                    labels[neighbour] = num_cluster
+                    queue.append(neighbour)
+        num_cluster += 1
+    return labels
+
+
+def greedy_centroid(indptr, indices):
+    """Greedy centroid clustering: the node with the most neighbours becomes a centroid and takes all its
+    neighbours that are not clustered yet, then the next one, and so on. Every member is directly
+    connected to its centroid. Linear in the number of nodes and edges.
+    Returns:
+    ----------
+    labels: ndarray
+        Cluster number of each node, starting from 0.
+    centroids: ndarray
+        Node number of the centroid of each cluster."""
+    num_pro = indptr.size - 1
+    degree = np.diff(indptr)
+    labels = np.full(num_pro, -1)
+    centroids = []
+    # stable sort, so nodes with the same degree stay in the order of the list
+    for node in np.argsort(-degree, kind='stable'):
+        if labels[node] >= 0:
+            continue
+        neighbours = indices[indptr[node]:indptr[node + 1]]
+        labels[node] = len(centroids)
+        labels[neighbours[labels[neighbours] < 0]] = len(centroids)
+        centroids.append(node)
+    return labels, np.array(centroids)
+
+
+def labels2clusters(labels, df_pro_uni):
+    """Reform the cluster number of each node to lists of protein IDs, ordered by cluster size."""
+    cluster_size = np.bincount(labels)
+    # group the protein IDs by cluster number in one sort
+    pro_grouped = np.split(df_pro_uni[np.argsort(labels, kind='stable')], np.cumsum(cluster_size)[:-1])
+    cluster_list = []
+    for i_cluster in np.argsort(-cluster_size, kind='stable'):
+        cluster_list.append(list(pro_grouped[i_cluster]))
+    return cluster_list
@@ -1,11 +1,22 @@
+import os
 import pandas as pd
 import numpy as np
-import copy
+import heapq
 import random
-import matplotlib.pyplot as plt
+import re
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
 
 
-def align2mat(pairwise_sim_path, tm_score='average'):
+# number of matrix rows processed at once by every thread of the parallel NJ search, bounds the temporary arrays
+NJ_CHUNK_ROWS = 64
+# value of the cells below the diagonal of the matrices, the same as in 'align2mat'
+LOWER_VALUE = (np.ones(1) + 0.0001)[0]
+_POOLS = {}
+
+
+@instrumentation.timed('align2mat')
+def align2mat(pairwise_sim_path, tm_score='average', pdb_list=None, normalize=1):
     """This is a function to reform the pair-wise similarity to similarity matrix with the size of
     (n-1)*(n-1), with n the number of proteins.
     Parameters:
@@ -18,6 +29,13 @@ def align2mat(pairwise_sim_path, tm_score='average'):
               'TM2': TM-score normalized using the second sequence;
               'long': TM-score normalized using the longer sequence;
               'short': TM-score normalized using the shorter sequence.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names (optional). If provided, it defines the order of the matrix rows,
+        and the pairs missing in the pair-wise similarity file (e.g. skipped by the prefilter) get the
+        largest distance.
+    normalize: bool
+        If the TM-scores are normalized with the min-max method before they are turned into distances
+        (1 - TM-score), which depends on the set; set it to 0 to compare the distances of different sets.
     Returns:
     ----------
     mat: ndarray
@@ -25,7 +43,9 @@ def align2mat(pairwise_sim_path, tm_score='average'):
     df_pro_uni: ndarray
         List of all protein IDs with the order of 'mat' rows."""
     # import the pairwise similarity and compute the two TM-scores according to the option.
-    df = pd.read_csv(pairwise_sim_path, index_col=None, sep='\t')
+    df = pd.read_csv(pairwise_sim_path, index_col=None, sep='\t', dtype={'PDBchain1': str, 'PDBchain2': str})
+    instrumentation.add_pairs(len(df))
+    instrumentation.add_bytes(read=os.path.getsize(pairwise_sim_path))
     if tm_score == 'TM1':
         df_ave = df['TM1']
     elif tm_score == 'TM2':
@@ -44,23 +64,33 @@ def align2mat(pairwise_sim_path, tm_score='average'):
         df_ave = pd.Series(list_short)
     else:
         df_ave = (df['TM1'] + df['TM2']) / 2
-    # normalize all TM-scores using min-max method
-    df_normal = 1 - (df_ave - df_ave.min()) / (df_ave.max() - df_ave.min())
+    if normalize:
+        # normalize all TM-scores using min-max method
+        tm_range = df_ave.max() - df_ave.min()
+        # e.g. only one pair, all pairs get the same distance
+        if tm_range == 0:
+            tm_range = 1
+        df_normal = 1 - (df_ave - df_ave.min()) / tm_range
+    else:
+        df_normal = 1 - df_ave
     # get all protein IDs according to the order of the similarity matrix rows
-    df_pro_uni1 = df.PDBchain1.unique()
-    df_pro_uni2 = df.PDBchain2.unique()
-    df_pro_uni = np.append(df_pro_uni1, df_pro_uni2[-1])
+    if pdb_list is None:
+        df_pro_uni1 = df.PDBchain1.unique()
+        df_pro_uni2 = df.PDBchain2.unique()
+        df_pro_uni = np.append(df_pro_uni1, df_pro_uni2[-1])
+    else:
+        df_pro_uni = pdb_list[0].str[:-4].values
     # length of similarity matrix (n-1 with n the number of all protein IDs)
-    len_matrix = df_pro_uni1.size
-    # initialize the matrix
+    len_matrix = df_pro_uni.size - 1
+    # initialize the matrix, pairs without alignment get the largest distance
     mat = np.ones([len_matrix, len_matrix]) + 0.0001
-    count = 0
-    # loop over all similarity values and enter them in the initialized matrix
-    for i in range(len_matrix):
-        for j in range(i, len_matrix):
-            # print(df_normal[count])
-            mat[i, j] = df_normal[count]
-            count = count + 1
+    mat[np.triu_indices(len_matrix)] = 1
+    # enter all similarity values in the initialized matrix according to the protein IDs,
+    # the entry [i, j] is the similarity between the i-th and the (j+1)-th protein
+    pro_index = pd.Series(np.arange(df_pro_uni.size), index=df_pro_uni)
+    ind_pro1 = pro_index[df.PDBchain1].values
+    ind_pro2 = pro_index[df.PDBchain2].values
+    mat[np.minimum(ind_pro1, ind_pro2), np.maximum(ind_pro1, ind_pro2) - 1] = df_normal.values
     return mat, df_pro_uni
 
 
@@ -201,6 +231,143 @@ def get_m_mat(mat, r_mat, len_matrix):
     return m_mat
 
 
+def get_pool(n_threads):
+    """Thread pool of the parallel NJ search, created once per number of threads and reused by every merge."""
+    if n_threads not in _POOLS:
+        _POOLS[n_threads] = ThreadPoolExecutor(max_workers=n_threads)
+    return _POOLS[n_threads]
+
+
+def run_blocks(func, blocks, n_threads):
+    """Run func(start, end) for every block, on the thread pool if n_threads > 1. NumPy releases the GIL in
+    the array operations, so the blocks run on several cores."""
+    if n_threads <= 1 or len(blocks) <= 1:
+        return [func(start, end) for start, end in blocks]
+    return list(get_pool(n_threads).map(lambda block: func(*block), blocks))
+
+
+def row_blocks(len_matrix, num_blocks, upper=1):
+    """Split the rows of the matrix into blocks with about the same number of cells of the upper triangle
+    (row i has len_matrix - i cells), or the same number of rows if not 'upper'."""
+    num_blocks = max(min(num_blocks, len_matrix), 1)
+    if upper:
+        # the cells of the rows 0 ... k-1 are proportional to 1 - (1 - k/len_matrix)^2
+        bounds = len_matrix - np.sqrt(1 - np.arange(num_blocks + 1) / float(num_blocks)) * len_matrix
+    else:
+        bounds = np.arange(num_blocks + 1) * len_matrix / float(num_blocks)
+    bounds = np.unique(np.round(bounds).astype(int))
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def get_r_parallel(mat, len_matrix, n_threads):
+    """Total distances of all proteins, the same values as 'get_r_mat' to the last bit: the row part and then
+    the column part are summed in the same order, with 'cumsum', which adds the values one after another.
+    The zeros below the diagonal do not change the sums."""
+    r_row = np.zeros(len_matrix + 1)
+
+    def sum_rows(start, end):
+        for chunk_start in range(start, end, NJ_CHUNK_ROWS):
+            chunk_end = min(chunk_start + NJ_CHUNK_ROWS, end)
+            chunk = np.triu(mat[chunk_start:chunk_end], k=chunk_start)
+            r_row[chunk_start:chunk_end] = np.cumsum(chunk, axis=1)[:, -1]
+
+    run_blocks(sum_rows, row_blocks(len_matrix, 4 * n_threads), n_threads)
+    r_mat = r_row.copy()
+
+    def sum_cols(start, end):
+        # r_mat[j + 1] adds mat[i, j] for i = 0 ... j, the rows below the block are all zeros
+        total = r_row[start + 1:end + 1].copy()
+        for chunk_start in range(0, end, NJ_CHUNK_ROWS):
+            chunk_end = min(chunk_start + NJ_CHUNK_ROWS, end)
+            chunk = np.triu(mat[chunk_start:chunk_end, start:end], k=chunk_start - start)
+            total = np.cumsum(np.concatenate([total[None, :], chunk]), axis=0)[-1]
+        r_mat[start + 1:end + 1] = total
+
+    run_blocks(sum_cols, row_blocks(len_matrix, 4 * n_threads, upper=0), n_threads)
+    return r_mat
+
+
+def update_mat_nj_parallel(mat, len_matrix, n_threads=None):
+    """Update the similarity matrix using NJ method, the same results as 'update_mat_nj', but the total
+    distances, the scan of the Q-matrix and the new matrix are computed with NumPy over blocks of rows, which
+    run on a pool of 'n_threads' threads (all cores if not provided). The Q-matrix is never stored, every
+    block only keeps its smallest value and its position.
+    Parameters:
+    ----------
+    Same as 'update_mat_nj', and
+    n_threads: int
+        Number of threads.
+    Returns:
+    ----------
+    Same as 'update_mat_nj'."""
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    if len_matrix <= 1:
+        return update_mat_nj(mat, len_matrix)
+    r_mat = get_r_parallel(mat, len_matrix, n_threads)
+    r_cols = r_mat[None, 1:]
+
+    def scan_rows(start, end):
+        best = (np.inf, -1)
+        for chunk_start in range(start, end, NJ_CHUNK_ROWS):
+            chunk_end = min(chunk_start + NJ_CHUNK_ROWS, end)
+            q_chunk = mat[chunk_start:chunk_end] - (r_mat[chunk_start:chunk_end, None] + r_cols) / (len_matrix - 1)
+            q_chunk[np.tril_indices(chunk_end - chunk_start, k=chunk_start - 1, m=len_matrix)] = np.inf
+            ind_min = int(q_chunk.argmin())
+            if q_chunk.flat[ind_min] < best[0]:
+                best = (q_chunk.flat[ind_min], chunk_start * len_matrix + ind_min)
+        return best
+
+    blocks = row_blocks(len_matrix, 4 * n_threads)
+    q_min = np.inf
+    ind_all = -1
+    # blocks are in the order of the rows, so the first smallest value is kept as with 'argmin'
+    for q_block, ind_block in run_blocks(scan_rows, blocks, n_threads):
+        if q_block < q_min:
+            q_min = q_block
+            ind_all = ind_block
+    # 'update_mat_nj' takes the argmin over the full Q-matrix, where the cells below the diagonal are 1.0001,
+    # the first of them is [1, 0]
+    if not q_min < LOWER_VALUE and not (q_min == LOWER_VALUE and ind_all < len_matrix):
+        ind_all = len_matrix
+    row = ind_all // len_matrix
+    col = ind_all % len_matrix
+    if row > col:
+        # a pair below the diagonal, only if all Q-values are larger than 1.0001, left to 'update_mat_nj'
+        return update_mat_nj(mat, len_matrix)
+    min_dis1 = mat[row, col] / 2 + (r_mat[row] - r_mat[col + 1]) / (2 * (len_matrix - 1))
+    min_dis2 = mat[row, col] - min_dis1
+    dis_pair = mat[row, col]
+    mat_new = np.empty([len_matrix - 1, len_matrix - 1])
+
+    def fill_rows(start, end):
+        for chunk_start in range(start, end, NJ_CHUNK_ROWS):
+            chunk_end = min(chunk_start + NJ_CHUNK_ROWS, end)
+            # old row of every new row, the protein col+1 is removed
+            ind_old = np.arange(chunk_start, chunk_end)
+            ind_old[ind_old > col] += 1
+            chunk = np.delete(mat[ind_old], col, axis=1)
+            # new distances to the joined node, kept at 'row'
+            ind_before = np.arange(chunk_start, min(chunk_end, row))
+            chunk[ind_before - chunk_start, row - 1] = (mat[ind_before, row - 1] + mat[ind_before, col] - dis_pair) / 2
+            if chunk_start <= row < chunk_end:
+                ind_other = np.arange(row + 1, len_matrix)
+                ind_other[ind_other > col] += 1
+                dis_other = np.where(ind_other > col + 1, mat[min(col + 1, len_matrix - 1), ind_other - 1],
+                                     mat[np.minimum(ind_other, len_matrix - 1), col])
+                chunk[row - chunk_start, row:] = (mat[row, ind_other - 1] + dis_other - dis_pair) / 2
+            chunk[np.tril_indices(chunk_end - chunk_start, k=chunk_start - 1, m=len_matrix - 1)] = LOWER_VALUE
+            mat_new[chunk_start:chunk_end] = chunk
+
+    run_blocks(fill_rows, row_blocks(len_matrix - 1, 4 * n_threads), n_threads)
+    # it is possible for NJ method to allocate negative length for branches, thus reset them to 0.01
+    if min_dis1 < 0:
+        min_dis1 = 0.01
+    if min_dis2 < 0:
+        min_dis2 = 0.01
+    return mat_new, row, col, min_dis1, min_dis2
+
+
 def single_single_upgma(row, pro_pre, pro_post, labels, name_all, min_dis, distances,
                         name_distances, pro_pre_dis, pro_post_dis):
     """This is a function using UPGMA method to update the itol file input if the minimum distance is
@@ -491,145 +658,122 @@ def comp_comp_nj(row, pro_pre, pro_post, labels, name_all, min_dis1, min_dis2, d
     return name_all, labels, distances1, distances2, name_distances
 
 
-def not_in_last_layer(k_labels, labels, ind_i, ind_j, ind_k):
-    """Compute the x value of the branch according to the previous layer,
-    if the branch is not in the last layer."""
-    labels_pop = copy.deepcopy(labels)
-    for ind_pop in range(ind_i - 1, len(labels)):
-        labels_pop.pop(-1)
-    for ind_i_pop, i_labels_pop in enumerate(labels_pop):
-        for ind_j_pop, j_labels_pop in enumerate(i_labels_pop):
-            for ind_k_pop, k_labels_pop in enumerate(j_labels_pop):
-                if k_labels_pop[0] != 'p':
-                    k_labels_ind_get = get_pro_name_no_num(k_labels_pop)
-                    k_labels_pop = k_labels_pop[k_labels_ind_get:]
-                if k_labels == k_labels_pop:
-                    i_out = ind_i_pop
-                    j_out = ind_j_pop
-    return i_out, j_out
-
-
-def align_name_num(name_all, labels, distances):
-    """This is a function to assign x and y values for generating a simple tree plot.
+def nwk2arrays(tree_nwk):
+    """Read a tree in Newick format into arrays, in one pass over the string. The nodes are numbered in the
+    order of the string (pre-order), so the parent of a node always has a smaller index, and the leaves are
+    in the order of the tree plot.
     Returns:
     ----------
-    labels_num: list
-        x values of all branches with the same layer structure as the 'labels' list.
-    labels_y1: list
-        Lower y values of all branches with the same layer structure as the 'labels' list.
-    labels_y2: list
-        Upper y values of all branches with the same layer structure as the 'labels' list."""
-    labels_num = copy.deepcopy(labels)
-    labels_y1 = copy.deepcopy(labels)
-    labels_y2 = copy.deepcopy(labels)
-    pro_all = name_all[0]
-    pro_all_nobra = pro_all.replace('(', '')
-    pro_all_nobra = pro_all_nobra.replace(')', '')
-    pro_all_nobra = pro_all_nobra + ','
-    count_p = 0
-    pro_single = ''
-    for pro_str in pro_all_nobra:
-        if pro_str == ',':
-            count_p += 1
-            for ind_i, i_labels in enumerate(labels_num):
-                for ind_j, j_labels in enumerate(i_labels):
-                    for ind_k, k_labels in enumerate(j_labels):
-                        if pro_single == k_labels:
-                            labels_num[ind_i][ind_j][ind_k] = count_p - 1
-                            labels_y1[ind_i][ind_j][ind_k] = 0
-                            labels_y2[ind_i][ind_j][ind_k] = distances[ind_i][ind_j]
-            pro_single = ''
+    parent: ndarray
+        Index of the parent of every node, -1 for the root.
+    length: ndarray
+        Branch length between every node and its parent.
+    names: list
+        Name of every node, empty for internal nodes without name."""
+    parent = []
+    length = []
+    names = []
+    stack = []
+    ind_closed = -1
+    for token in re.findall(r'[(),;]|[^(),;]+', tree_nwk):
+        if token == '(':
+            parent.append(stack[-1] if len(stack) > 0 else -1)
+            length.append(0.)
+            names.append('')
+            stack.append(len(parent) - 1)
+            ind_closed = -1
+        elif token == ')':
+            ind_closed = stack.pop()
+        elif token == ',' or token == ';':
+            ind_closed = -1
         else:
-            pro_single = pro_single + pro_str
-
-    for ind_i, i_labels in enumerate(labels_num):
-        for ind_j, j_labels in enumerate(i_labels):
-            for ind_k, k_labels in enumerate(j_labels):
-                if isinstance(k_labels, str):
-                    label_num_get_ind = get_pro_name_no_num(k_labels)
-                    ind_j_num = int(k_labels[:label_num_get_ind])
-                    if ind_j_num >= len(labels[ind_i - 1]):
-                        ind_i_ref, ind_j_ref = not_in_last_layer(k_labels[label_num_get_ind:], labels, ind_i, ind_j,
-                                                                 ind_k)
-                    else:
-                        labels_ind_comp = labels[ind_i - 1][ind_j_num][0]
-                        if labels_ind_comp[0] != 'p':
-                            label_comp_get_ind = get_pro_name_no_num(labels_ind_comp)
-                            labels_ind_comp = labels[ind_i - 1][ind_j_num][0][label_comp_get_ind:]
-                        if k_labels[label_num_get_ind:] == labels_ind_comp:
-                            ind_i_ref = ind_i - 1
-                            ind_j_ref = ind_j_num
-                        else:
-                            ind_i_ref, ind_j_ref = not_in_last_layer(k_labels[label_num_get_ind:], labels, ind_i, ind_j,
-                                                                     ind_k)
-
-                    num_pre = labels_num[ind_i_ref][ind_j_ref][0]
-                    num_post = labels_num[ind_i_ref][ind_j_ref][1]
-                    labels_num[ind_i][ind_j][ind_k] = (num_pre + num_post) / 2
-                    labels_y1[ind_i][ind_j][ind_k] = labels_y2[ind_i_ref][ind_j_ref][0]
-                    labels_y2[ind_i][ind_j][0] = distances[ind_i][ind_j]
-                    labels_y2[ind_i][ind_j][1] = distances[ind_i][ind_j]
-    return labels_num, labels_y1, labels_y2
-
-
-def get_similarity_clust(cluster_num, distances):
-    """Get the similarity threshold to divide the proteins into the corresponding number of clusters.
-    Parameters:
+            name, _, branch = token.strip().partition(':')
+            # the name and length after ')' belong to the closed node, otherwise it is a new leaf
+            if ind_closed < 0:
+                parent.append(stack[-1] if len(stack) > 0 else -1)
+                length.append(0.)
+                names.append('')
+                ind_closed = len(parent) - 1
+            names[ind_closed] = name
+            length[ind_closed] = float(branch) if branch != '' else 0.
+    return np.array(parent, dtype=int), np.array(length), names
+
+
+def tree_layout(parent, length):
+    """Coordinates of all nodes for the tree plot, O(n) from the arrays of 'nwk2arrays'. The leaves are
+    placed at x = 0, 1, 2 ... in the order of the tree, an internal node in the middle of its outer
+    children. y is the height above the deepest leaf, computed from the branch lengths, so the leaves of
+    a NJ tree are drawn at their own distance to the root.
+    Returns:
     ----------
-    cluster_num: int
-        Defined number of clusters.
-    distances: list
-        List of all branch lengths."""
-    dis_squeez = []
-    for i_dis in distances:
-        for j_dis in i_dis:
-            dis_squeez.append(j_dis)
-    dis_squeez.sort()
-    dis_sublim = dis_squeez[- cluster_num]
-    dis_uplim = dis_squeez[- cluster_num + 1]
-    similarity = (dis_sublim + dis_uplim) / 2
-    return similarity
-
-
-def get_xcut(labels_num, labels_y1, labels_y2, cluster_num, distances):
-    """Get the x values in order to divide the plot into the corresponding number of clusters."""
-    similarity = get_similarity_clust(cluster_num, distances)
-    count_clust = 0
-    labels_num_squeez = []
-    labels_y1_squeez = []
-    labels_y2_squeez = []
-    x_cut = []
-    for i_labels_num in range(len(labels_num)):
-        for j_labels_num in range(len(labels_num[i_labels_num])):
-            labels_num_squeez.append(labels_num[i_labels_num][j_labels_num])
-            labels_y1_squeez.append(labels_y1[i_labels_num][j_labels_num])
-            labels_y2_squeez.append(labels_y2[i_labels_num][j_labels_num])
-    for i_all_num in range(len(labels_num_squeez)):
-        for j_all_num in range(len(labels_num_squeez[i_all_num])):
-            if labels_y1_squeez[i_all_num][j_all_num] < similarity < \
-                    labels_y2_squeez[i_all_num][j_all_num]:
-                count_clust += 1
-                if labels_y1_squeez[i_all_num][j_all_num] == 0:
-                    x_mid = labels_num_squeez[i_all_num][j_all_num]
-                else:
-                    mid_ind = labels_y2_squeez.index([labels_y1_squeez[i_all_num][j_all_num],
-                                                      labels_y1_squeez[i_all_num][j_all_num]])
-                    y1_pair = labels_y1_squeez[mid_ind]
-                    x_mid_pair = labels_num_squeez[mid_ind]
-                    x_mid = x_mid_pair[1]
-                    count_while = 0
-                    while y1_pair[1] != 0:
-                        count_while += 1
-                        mid_ind_new = labels_y2_squeez.index([y1_pair[1], y1_pair[1]])
-                        y1_pair_new = labels_y1_squeez[mid_ind_new]
-                        x_mid_pair_new = labels_num_squeez[mid_ind_new]
-                        x_mid = x_mid_pair_new[1]
-                        y1_pair = y1_pair_new
-                        x_mid_pair = x_mid_pair_new
-                        count_while = 0
-                x_cut.append(x_mid)
-                x_cut.sort()
-    return x_cut, similarity
+    layout: dict
+        'x', 'y', 'depth' (distance to the root) of every node, 'x_min' and 'x_max' of the children of every
+        internal node, and 'is_leaf'."""
+    num_node = parent.size
+    depth = np.zeros(num_node)
+    for ind_node in range(1, num_node):
+        depth[ind_node] = depth[parent[ind_node]] + length[ind_node]
+    is_leaf = np.ones(num_node, dtype=bool)
+    is_leaf[parent[1:]] = False
+    x = np.zeros(num_node)
+    x[is_leaf] = np.arange(is_leaf.sum())
+    x_min = np.full(num_node, np.inf)
+    x_max = np.full(num_node, -np.inf)
+    # children have larger indices than their parent, so a backward loop sees all children first
+    for ind_node in range(num_node - 1, -1, -1):
+        if not is_leaf[ind_node]:
+            x[ind_node] = (x_min[ind_node] + x_max[ind_node]) / 2
+        if ind_node > 0:
+            ind_parent = parent[ind_node]
+            x_min[ind_parent] = min(x_min[ind_parent], x[ind_node])
+            x_max[ind_parent] = max(x_max[ind_parent], x[ind_node])
+    return {'x': x, 'y': depth.max() - depth, 'depth': depth, 'x_min': x_min, 'x_max': x_max, 'is_leaf': is_leaf}
+
+
+def get_cut_clusters(parent, layout, cluster_num):
+    """Cut the tree into 'cluster_num' clusters from the top down: the node closest to the root is split
+    until there are enough subtrees. Works for NJ trees too, where the heights of the leaves differ.
+    Returns:
+    ----------
+    cluster: ndarray
+        Cluster of every node, numbered from left to right, -1 for the nodes above the cut."""
+    num_node = parent.size
+    children = [[] for _ in range(num_node)]
+    for ind_node in range(1, num_node):
+        children[parent[ind_node]].append(ind_node)
+    heap = [(layout['depth'][0], 0)]
+    roots = []
+    while len(heap) > 0 and len(heap) + len(roots) < cluster_num:
+        _, ind_node = heapq.heappop(heap)
+        if len(children[ind_node]) == 0:
+            roots.append(ind_node)
+        for ind_child in children[ind_node]:
+            heapq.heappush(heap, (layout['depth'][ind_child], ind_child))
+    roots = roots + [ind_node for _, ind_node in heap]
+    roots.sort(key=lambda ind_node: layout['x'][ind_node])
+    cluster = np.full(num_node, -1)
+    cluster[roots] = np.arange(len(roots))
+    for ind_node in range(1, num_node):
+        if cluster[ind_node] < 0:
+            cluster[ind_node] = cluster[parent[ind_node]]
+    return cluster
+
+
+def tree_segments(parent, layout, cluster):
+    """All lines of the tree plot as an array of segments with the size of (m, 2, 2): one vertical line
+    from every node up to the height of its parent, and one horizontal line over the children of every
+    internal node. Returns the segments and the cluster of every segment."""
+    x = layout['x']
+    y = layout['y']
+    ind_child = np.arange(1, parent.size)
+    ind_internal = np.where(~layout['is_leaf'])[0]
+    vertical = np.stack([np.stack([x[ind_child], y[ind_child]], axis=1),
+                         np.stack([x[ind_child], y[parent[ind_child]]], axis=1)], axis=1)
+    horizontal = np.stack([np.stack([layout['x_min'][ind_internal], y[ind_internal]], axis=1),
+                           np.stack([layout['x_max'][ind_internal], y[ind_internal]], axis=1)], axis=1)
+    segments = np.concatenate([vertical, horizontal])
+    seg_cluster = np.concatenate([cluster[ind_child], cluster[ind_internal]])
+    return segments, seg_cluster
 
 
 def get_random_colors(cluster_num):
@@ -640,52 +784,20 @@ def get_random_colors(cluster_num):
     return color_list
 
 
-def get_plot_color(x_plot3, y_plot1, y_plot2, y_plot3, similarity, x_cut, color_list):
-    """Assign colors to each branch according to the cluster."""
-    if y_plot3[0] < similarity:
-        for ind_x_cut, value_x_cut in enumerate(x_cut):
-            if x_plot3[1] <= value_x_cut:
-                color_plot3 = color_list[ind_x_cut]
-                color_plot1 = color_list[ind_x_cut]
-                color_plot2 = color_list[ind_x_cut]
-                break
-    else:
-        color_plot3 = 'k'
-        if y_plot2[0] > similarity:
-            color_plot2 = 'k'
-        elif y_plot2[0] < similarity and y_plot2[1] > similarity:
-            color_plot2 = 'k'
-        else:
-            for ind_x_cut, value_x_cut in enumerate(x_cut):
-                if x_plot3[1] <= value_x_cut:
-                    color_plot2 = color_list[ind_x_cut]
-                    break
-        if y_plot1[0] > similarity:
-            color_plot1 = 'k'
-        elif y_plot1[0] < similarity and y_plot1[1] > similarity:
-            color_plot1 = 'k'
-        else:
-            for ind_x_cut, value_x_cut in enumerate(x_cut):
-                if x_plot3[0] <= value_x_cut:
-                    color_plot1 = color_list[ind_x_cut]
-                    break
-    return color_plot1, color_plot2, color_plot3
-
-
-def get_xticklabel(name_all):
-    """Get the x tick labels for the tree plot."""
-    name_nobra = name_all.replace('(', '')
-    name_nobra = name_nobra.replace(')', '')
-    xticklabels_list = []
-    name_single = ''
-    for name_single_str in name_nobra:
-        if name_single_str == ',':
-            xticklabels_list.append(name_single)
-            name_single = ''
-        else:
-            name_single = name_single + name_single_str
-    xticklabels_list.append(name_single)
-    return xticklabels_list
+def expand_duplicates(tree_nwk, duplicates):
+    """Add the duplicated structures back to the tree, each representative leaf is replaced by the
+    representative and its duplicates as sibling leaves with zero branch length.
+    Parameters:
+    ----------
+    tree_nwk: string
+        Tree in Newick format.
+    duplicates: dict
+        List of duplicated protein IDs, with the ID of the representative as key."""
+    for rep_id, dup_ids in duplicates.items():
+        leaves = '(' + rep_id + ':0,' + ':0,'.join(dup_ids) + ':0)'
+        # a leaf name always follows '(' or ',' and is followed by its branch length
+        tree_nwk = re.sub('(?<=[(,])' + re.escape(rep_id) + '(?=:)', lambda match: leaves, tree_nwk, count=1)
+    return tree_nwk
 
 
 def add_p(pro_list):
@@ -697,33 +809,174 @@ def add_p(pro_list):
     return ppro_list
 
 
-def plot_tree(cluster_num, name_all, labels, distances, figsize=None):
-    """Plot the simple tree plot"""
-    if figsize is None:
-        figsize = [85, 10]
-    labels_num, labels_y1, labels_y2 = align_name_num(name_all, labels, distances)
-    xticklabels = get_xticklabel(name_all[0])
-    x_cut, similarity = get_xcut(labels_num, labels_y1, labels_y2, cluster_num, distances)
+def plot_tree(cluster_num, tree_nwk, figsize=None, max_labels=500, linewidth=1):
+    """Plot the simple tree plot of a UPGMA or NJ tree, with the branches of every cluster in one color.
+    All branches of a color are drawn as one LineCollection, so large trees are plotted in seconds.
+    Parameters:
+    ----------
+    cluster_num: int
+        Number of colored clusters.
+    tree_nwk: string
+        Tree in Newick format.
+    max_labels: int
+        The protein IDs are only shown as x tick labels up to this number of proteins."""
+    # matplotlib is only imported for the plots, so the alignment jobs start faster
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    parent, length, names = nwk2arrays(tree_nwk)
+    layout = tree_layout(parent, length)
+    cluster = get_cut_clusters(parent, layout, cluster_num)
+    segments, seg_cluster = tree_segments(parent, layout, cluster)
     color_list = get_random_colors(cluster_num)
+    num_leaves = int(layout['is_leaf'].sum())
+    if figsize is None:
+        figsize = [min(85, max(10, 0.15 * num_leaves)), 10]
     fig, ax = plt.subplots(figsize=figsize)
-    for i_plot in range(len(labels_y1)):
-        for j_plot in range(len(labels_y1[i_plot])):
-            x_plot1 = [labels_num[i_plot][j_plot][0], labels_num[i_plot][j_plot][0]]
-            x_plot2 = [labels_num[i_plot][j_plot][1], labels_num[i_plot][j_plot][1]]
-            x_plot3 = labels_num[i_plot][j_plot]
-            y_plot1 = [labels_y1[i_plot][j_plot][0], labels_y2[i_plot][j_plot][0]]
-            y_plot2 = [labels_y1[i_plot][j_plot][1], labels_y2[i_plot][j_plot][1]]
-            y_plot3 = [labels_y2[i_plot][j_plot][0], labels_y2[i_plot][j_plot][1]]
-            color_plot1, color_plot2, color_plot3 = get_plot_color(x_plot3, y_plot1, y_plot2, y_plot3,
-                                                                   similarity, x_cut, color_list)
-            ax.plot(x_plot1, y_plot1, color=color_plot1, linewidth=1)
-            ax.plot(x_plot2, y_plot2, color=color_plot2, linewidth=1)
-            ax.plot(x_plot3, y_plot3, color=color_plot3, linewidth=1)
-
-    ax.set_xticks(range(len(xticklabels)))
-    ax.set_xticklabels(xticklabels, rotation=60, fontsize=12)
+    for ind_clust in range(-1, cluster_num):
+        seg_clust = segments[seg_cluster == ind_clust]
+        if seg_clust.shape[0] > 0:
+            color = 'k' if ind_clust < 0 else color_list[ind_clust]
+            ax.add_collection(LineCollection(seg_clust, colors=[color], linewidths=linewidth))
+    ax.autoscale_view()
+    if num_leaves <= max_labels:
+        ax.set_xticks(range(num_leaves))
+        ax.set_xticklabels([name for name, leaf in zip(names, layout['is_leaf']) if leaf], rotation=60,
+                           fontsize=12)
+    else:
+        ax.set_xticks([])
     return fig, ax
 
+
+def overview_geometry(cluster_num, tree_nwk, representatives=None, wedge_width=0.8):
+    """Geometry of the collapsed overview plot: only the branches above the cut are kept, and every cluster
+    below the cut is collapsed into one wedge, so the size of the plot depends on the number of clusters
+    instead of the number of proteins.
+    Parameters:
+    ----------
+    cluster_num: int
+        Number of clusters, see 'get_cut_clusters'.
+    tree_nwk: string
+        Tree in Newick format.
+    representatives: list
+        ID of the representative of every cluster, from left to right. If not provided, the protein closest
+        to the root of the cluster is used.
+    Returns:
+    ----------
+    segments: ndarray
+        Branches above the cut, with the size of (m, 2, 2).
+    wedges: ndarray
+        Corners of the wedge of every cluster, with the size of (cluster_num, 3, 2).
+    df_clusters: pandas dataframe
+        Size, representative and position of the label of every cluster."""
+    parent, length, names = nwk2arrays(tree_nwk)
+    layout = tree_layout(parent, length)
+    cluster = get_cut_clusters(parent, layout, cluster_num)
+    is_root = (cluster >= 0) & ((parent < 0) | (cluster[np.maximum(parent, 0)] < 0))
+    keep = (cluster < 0) | is_root
+    ind_roots = np.where(is_root)[0]
+    ind_roots = ind_roots[np.argsort(cluster[ind_roots])]
+    # x of the collapsed tree: one slot for every cluster, internal nodes above the cut in the middle
+    x = np.zeros(parent.size)
+    x[ind_roots] = np.arange(ind_roots.size)
+    x_min = np.full(parent.size, np.inf)
+    x_max = np.full(parent.size, -np.inf)
+    for ind_node in np.where(keep)[0][::-1]:
+        if not is_root[ind_node]:
+            x[ind_node] = (x_min[ind_node] + x_max[ind_node]) / 2
+        if ind_node > 0:
+            ind_parent = parent[ind_node]
+            x_min[ind_parent] = min(x_min[ind_parent], x[ind_node])
+            x_max[ind_parent] = max(x_max[ind_parent], x[ind_node])
+    y = layout['y']
+    ind_child = np.where(keep & (parent >= 0))[0]
+    ind_internal = np.where(keep & ~is_root)[0]
+    segments = np.concatenate([
+        np.stack([np.stack([x[ind_child], y[ind_child]], axis=1),
+                  np.stack([x[ind_child], y[parent[ind_child]]], axis=1)], axis=1),
+        np.stack([np.stack([x_min[ind_internal], y[ind_internal]], axis=1),
+                  np.stack([x_max[ind_internal], y[ind_internal]], axis=1)], axis=1)])
+    # size, lowest leaf and the leaf closest to the cluster root of every cluster
+    ind_leaves = np.where(layout['is_leaf'])[0]
+    leaf_cluster = cluster[ind_leaves]
+    sizes = np.bincount(leaf_cluster, minlength=ind_roots.size)
+    y_bottom = np.full(ind_roots.size, np.inf)
+    np.minimum.at(y_bottom, leaf_cluster, y[ind_leaves])
+    if representatives is None:
+        order = np.lexsort((layout['depth'][ind_leaves], leaf_cluster))
+        first = np.ones(order.size, dtype=bool)
+        first[1:] = leaf_cluster[order[1:]] != leaf_cluster[order[:-1]]
+        representatives = [names[ind_leaf] for ind_leaf in ind_leaves[order[first]]]
+    x_roots = x[ind_roots]
+    y_roots = y[ind_roots]
+    half_width = wedge_width / 2
+    wedges = np.stack([np.stack([x_roots, y_roots], axis=1),
+                       np.stack([x_roots - half_width, y_bottom], axis=1),
+                       np.stack([x_roots + half_width, y_bottom], axis=1)], axis=1)
+    df_clusters = pd.DataFrame({'cluster': np.arange(ind_roots.size), 'size': sizes,
+                                'representative': representatives, 'x': x_roots, 'y': y_bottom})
+    return segments, wedges, df_clusters
+
+
+def plot_overview(cluster_num, tree_nwk, representatives=None, figsize=None, fontsize=10):
+    """Collapsed overview plot of a large tree: the top of the tree down to the cut, and one wedge for every
+    cluster, labeled with its size and representative, see 'overview_geometry'."""
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection, PolyCollection
+    segments, wedges, df_clusters = overview_geometry(cluster_num, tree_nwk, representatives=representatives)
+    color_list = get_random_colors(df_clusters.shape[0])
+    if figsize is None:
+        figsize = [min(85, max(10, 0.3 * df_clusters.shape[0])), 10]
+    fig, ax = plt.subplots(figsize=figsize)
+    ax.add_collection(LineCollection(segments, colors='k', linewidths=1))
+    ax.add_collection(PolyCollection(wedges, facecolors=color_list, edgecolors='k', linewidths=0.5))
+    ax.autoscale_view()
+    ax.set_xticks(df_clusters['x'])
+    ax.set_xticklabels([rep + ' (' + str(size) + ')' for rep, size in zip(df_clusters['representative'],
+                                                                           df_clusters['size'])],
+                       rotation=60, fontsize=fontsize)
+    return fig, ax
+
+
+def write_overview_svg(svg_path, cluster_num, tree_nwk, representatives=None, width=None, height=600):
+    """Write the collapsed overview plot directly as a .svg file, element by element, without building a
+    figure in memory, see 'overview_geometry'."""
+    segments, wedges, df_clusters = overview_geometry(cluster_num, tree_nwk, representatives=representatives)
+    color_list = get_random_colors(df_clusters.shape[0])
+    if width is None:
+        width = max(600, 30 * df_clusters.shape[0])
+    margin_x = 40
+    margin_top = 20
+    margin_bottom = 200
+    x_low = wedges[:, :, 0].min()
+    x_range = max(wedges[:, :, 0].max() - x_low, 1e-12)
+    y_max = max(segments[:, :, 1].max() if segments.shape[0] > 0 else 0, wedges[:, :, 1].max())
+    y_low = wedges[:, :, 1].min()
+    y_range = max(y_max - y_low, 1e-12)
+
+    def to_px(x, y):
+        return (margin_x + (x - x_low) / x_range * (width - 2 * margin_x),
+                margin_top + (y_max - y) / y_range * (height - margin_top - margin_bottom))
+
+    svg_file = open(svg_path, 'w')
+    svg_file.write('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">\n' % (width, height))
+    for segment in segments:
+        x1, y1 = to_px(segment[0, 0], segment[0, 1])
+        x2, y2 = to_px(segment[1, 0], segment[1, 1])
+        svg_file.write('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="black"/>\n' % (x1, y1, x2, y2))
+    for wedge, color, rep, size in zip(wedges, color_list, df_clusters['representative'], df_clusters['size']):
+        points = ' '.join('%.1f,%.1f' % to_px(corner[0], corner[1]) for corner in wedge)
+        fill = '#%02x%02x%02x' % tuple(int(255 * value) for value in color)
+        svg_file.write('<polygon points="%s" fill="%s" stroke="black" stroke-width="0.5"/>\n' % (points, fill))
+        x_text, y_text = to_px(wedge[0, 0], wedge[1, 1])
+        label = (rep + ' (' + str(size) + ')').replace('&', '&amp;').replace('<', '&lt;')
+        svg_file.write('<text x="%.1f" y="%.1f" font-size="10" transform="rotate(60 %.1f %.1f)">%s</text>\n'
+                       % (x_text, y_text + 12, x_text, y_text + 12, label))
+    svg_file.write('</svg>\n')
+    svg_file.close()
+    print('The overview of the tree is saved in: ', svg_path)
+    return df_clusters
+
+
 def get_num_before_pro(pro):
     num = ''
     for i_str in pro:
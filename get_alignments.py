@@ -1,9 +1,21 @@
 import os
 import sys
+import glob
 import get_lists
+import structure_files
+import usalign_runner
+import instrumentation
+import progress
 import pandas as pd
 
 
+# columns of the us-align output with '-outfmt 2', after cleaning by 'clean_pro_name_in_align'
+ALIGN_COLUMNS = ['PDBchain1', 'PDBchain2', 'TM1', 'TM2', 'RMSD', 'ID1', 'ID2', 'IDali', 'L1', 'L2', 'Lali']
+# a row only joins a batch if the batch still aligns at most this many times the pairs of its sub-lists
+# (rows * size of the union of the sub-lists / pairs in the sub-lists), see 'get_batches'
+MAX_BATCH_OVERHEAD = 1.5
+
+
 def sanitycheck(df, size, alignment_title):
     """Sanity check of the size of alignment files, number of rows should be same as
     the corresponding sub-list file.
@@ -52,9 +64,216 @@ def clean_pro_name_in_align(align_file_path, size_align, pdb_file=None, parallel
     df_align.to_csv(align_file_path, index=None, sep='\t')
 
 
+def align_lists(pdb_path, usalign_path, query_list, align_file_path, target_list=None):
+    """Run us-align once for all structures in 'query_list' against all structures in 'target_list',
+    or for all pairs within 'query_list' if 'target_list' is not provided.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    usalign_path: string
+        Path of the US-align tool (e.g. PATH/USalign).
+    query_list: list
+        .pdb file names of the query structures.
+    align_file_path: string
+        Path of the alignment file, the lists of structures are saved next to it.
+    target_list: list
+        .pdb file names of the target structures.
+    Returns:
+    ----------
+    df_align: pandas dataframe
+        The alignments with protein IDs in the first two columns."""
+    pdb_path = structure_files.stage_structures(pdb_path, list(query_list) +
+                                                (list(target_list) if target_list is not None else []))
+    query_list_path = align_file_path[:-4] + '_list1.txt'
+    pd.DataFrame(query_list).to_csv(query_list_path, header=None, index=None)
+    if target_list is None:
+        usalign_cmd = usalign_path + ' -dir ' + pdb_path + ' ' + query_list_path
+    else:
+        target_list_path = align_file_path[:-4] + '_list2.txt'
+        pd.DataFrame(target_list).to_csv(target_list_path, header=None, index=None)
+        usalign_cmd = usalign_path + ' -dir1 ' + pdb_path + ' ' + query_list_path + \
+                      ' -dir2 ' + pdb_path + ' ' + target_list_path
+    if os.path.exists(align_file_path):
+        os.remove(align_file_path)
+    os.system(usalign_cmd + ' -outfmt 2 > ' + align_file_path)
+    return read_dir_align(align_file_path)
+
+
+def read_dir_align(align_file_path):
+    """Read the output of us-align with '-dir' or '-dir1', where both protein names are given relative to
+    the folder, and keep the protein IDs only."""
+    df_align = pd.read_csv(align_file_path, sep='\t', dtype={'#PDBchain1': str, 'PDBchain2': str})
+    df_align.rename(columns={'#PDBchain1': 'PDBchain1'}, inplace=True)
+    for chain in ['PDBchain1', 'PDBchain2']:
+        df_align[chain] = df_align[chain].str.replace('/', '').str[:-6]
+    return df_align
+
+
+def get_batches(df_sub_par, pdb_list, batch_size, sublist_path=None, max_overhead=MAX_BATCH_OVERHEAD):
+    """Group the rows of one job into batches of at most 'batch_size' rows, which are next to each other
+    in the list of all .pdb files, so their sub-lists are almost the same. If 'sublist_path' is provided, a
+    row only joins a batch if aligning the batch against the union of the sub-lists computes at most
+    'max_overhead' times the pairs of the sub-lists, e.g. after the prefilter the sub-lists of neighbouring
+    rows hardly overlap and most rows are computed alone."""
+    position = dict(zip(pdb_list[0], range(pdb_list[0].size)))
+    batches = []
+    for pdb_file in df_sub_par[0]:
+        if sublist_path is not None:
+            targets = set(get_batch_pairs([pdb_file], sublist_path)[1])
+        if len(batches) > 0 and len(batches[-1]) < batch_size and \
+                position[pdb_file] == position[batches[-1][-1]] + 1:
+            if sublist_path is None:
+                batches[-1].append(pdb_file)
+                continue
+            union_new = union | targets
+            num_pairs_new = num_pairs + len(targets)
+            if len(union_new) * (len(batches[-1]) + 1) <= max_overhead * num_pairs_new:
+                batches[-1].append(pdb_file)
+                union, num_pairs = union_new, num_pairs_new
+                continue
+        batches.append([pdb_file])
+        if sublist_path is not None:
+            union, num_pairs = targets, len(targets)
+    return batches
+
+
+def get_batch_pairs(batch, sublist_path):
+    """Get all pairs of a batch of rows from their sub-lists.
+    Returns:
+    ----------
+    list_pro1: list
+        .pdb file name of the first protein of each pair.
+    list_pro2: list
+        .pdb file name of the second protein of each pair."""
+    list_pro1 = []
+    list_pro2 = []
+    for pdb_file in batch:
+        sub_list_list_path = os.path.join(sublist_path, 'list_' + pdb_file[:-3] + 'txt')
+        if os.path.getsize(sub_list_list_path) == 0:
+            continue
+        df_sub_list = pd.read_csv(sub_list_list_path, sep='\t', header=None)
+        list_pro1 += [pdb_file] * df_sub_list[0].size
+        list_pro2 += list(df_sub_list[0])
+    return list_pro1, list_pro2
+
+
+def clean_batch_align(df_align, list_pro1, list_pro2, align_file_path):
+    """Keep only the pairs of the sub-lists in their order and save the alignment file of a batch."""
+    df_wanted = pd.DataFrame({'PDBchain1': [pdb_file[:-4] for pdb_file in list_pro1],
+                              'PDBchain2': [pdb_file[:-4] for pdb_file in list_pro2]})
+    df_align = df_wanted.merge(df_align, on=['PDBchain1', 'PDBchain2'], how='inner')
+    sanitycheck(df_align, len(df_wanted), align_file_path)
+    df_align[ALIGN_COLUMNS].to_csv(align_file_path, index=None, sep='\t')
+
+
+def run_usalign_batch(pdb_path, usalign_path, batch, sublist_path, align_folder_path):
+    """Run us-align once for a batch of rows: all proteins of the batch against the union of their
+    sub-lists, then keep only the pairs in the sub-lists. For rows next to each other in the list, the
+    extra pairs are only the ones within the batch, while the process startup and the file writing are
+    shared by the whole batch. The extra pairs cost as much as the wanted ones, so this only pays off if the
+    sub-lists overlap; with the sub-lists of the prefilter, the union can be many times larger than a row,
+    thus 'get_batches' with 'sublist_path' splits such batches, down to single rows if needed.
+    Returns:
+    ----------
+    align_file_path: string
+        Path of the alignment file of the batch, named after the first protein of the batch."""
+    list_pro1, list_pro2 = get_batch_pairs(batch, sublist_path)
+    align_file_path = os.path.join(align_folder_path, 'align_batch_' + batch[0][:-3] + 'txt')
+    if len(list_pro2) == 0:
+        pd.DataFrame(columns=ALIGN_COLUMNS).to_csv(align_file_path, index=None, sep='\t')
+        return align_file_path
+    target_list = list(pd.unique(pd.Series(list_pro2)))
+    df_align = align_lists(pdb_path, usalign_path, batch, align_file_path, target_list=target_list)
+    for list_file in ['_list1.txt', '_list2.txt']:
+        os.remove(align_file_path[:-4] + list_file)
+    clean_batch_align(df_align, list_pro1, list_pro2, align_file_path)
+    instrumentation.add_pairs(len(list_pro1))
+    return align_file_path
+
+
+def count_pairs(sublist_path, pdb_files):
+    """Number of pairs in the sub-lists of 'pdb_files', used as the total cost of a job."""
+    num_pairs = 0
+    for pdb_file in pdb_files:
+        sub_list_list_path = os.path.join(sublist_path, 'list_' + pdb_file[:-3] + 'txt')
+        if os.path.getsize(sub_list_list_path) > 0:
+            sub_list_file = open(sub_list_list_path, 'r')
+            num_pairs += sum(1 for line in sub_list_file if line.strip() != '')
+            sub_list_file.close()
+    return num_pairs
+
+
+def run_usalign_rows(pdb_path, usalign_path, df_sub_par, pdb_list, sublist_path, align_folder_path, batch_size=1,
+                     runner='os', n_workers=4, timeout=60, retries=2, job_name='0'):
+    """Compute the rows in 'df_sub_par', every row is one protein against its sub-list, and save them as
+    'align_<protein ID>.txt' (or 'align_batch_<protein ID>.txt' if batch_size > 1) in 'align_folder_path'.
+    The options are the same as in 'run_usalign', 'job_name' is used to name the files of the 'async' runner.
+    Returns:
+    ----------
+    align_file_path: string
+        Path of the last alignment file, None for the 'async' runner."""
+    align_file_path = None
+    # every row is aligned with the proteins after it in the list, so the job needs the structures from its
+    # first row to the end of the list, staged on this node if they are compressed or mmCIF
+    position = dict(zip(pdb_list[0], range(pdb_list[0].size)))
+    first_row = min(position.get(pdb_file, 0) for pdb_file in df_sub_par[0])
+    pdb_path = structure_files.stage_structures(pdb_path, list(pdb_list[0].iloc[first_row:]))
+    job_progress = progress.Progress('alignment_job_' + job_name, count_pairs(sublist_path, df_sub_par[0]))
+    if runner == 'async':
+        usalign_runner.run_job(pdb_path, usalign_path, df_sub_par, pdb_list, sublist_path, align_folder_path,
+                               job_name=job_name, batch_size=batch_size, n_workers=n_workers, timeout=timeout,
+                               retries=retries, job_progress=job_progress)
+        job_progress.finish()
+        return None
+    if batch_size > 1:
+        for batch in get_batches(df_sub_par, pdb_list, batch_size, sublist_path=sublist_path):
+            align_file_path = run_usalign_batch(pdb_path, usalign_path, batch, sublist_path, align_folder_path)
+            instrumentation.add_bytes(written=os.path.getsize(align_file_path))
+            job_progress.update(job_progress.done + count_pairs(sublist_path, batch))
+        job_progress.finish()
+        return align_file_path
+    # for every pdb file, run similarity computation according to each pdb files in the pdb folder
+    for pdb_file in df_sub_par[0]:
+        # sub-list file name
+        list_file = 'list_' + pdb_file[:-3] + 'txt'
+        sub_list_list_path = os.path.join(sublist_path, list_file)
+        # sub-alignment file name
+        align_file = 'align_' + pdb_file[:-3] + 'txt'
+        align_file_path = os.path.join(align_folder_path, align_file)
+        # the sub-list can be empty if all pairs of this protein are removed by the prefilter,
+        # then only the header is written
+        if os.path.getsize(sub_list_list_path) == 0:
+            pd.DataFrame(columns=ALIGN_COLUMNS).to_csv(align_file_path, index=None, sep='\t')
+            continue
+        df_sub_list = pd.read_csv(sub_list_list_path, sep='\t', header=None)
+        size_align = df_sub_list.size
+        # if the alignment file exit already, remove it before write into it. TODO: if it exists, one can check it
+        #  first, then decide if it should be removed or skip it to reduce computation time
+        if os.path.exists(align_file_path):
+            rm_cmd = 'rm ' + align_file_path
+            os.system(rm_cmd)
+        # do us-align
+        usalign_cmd = usalign_path + ' ' + os.path.join(pdb_path, pdb_file) + \
+                      ' -dir2 ' + pdb_path + ' ' + \
+                      sub_list_list_path + ' -outfmt 2 >> ' + \
+                      align_file_path
+        os.system(usalign_cmd)
+        # clean protein names and do sanity check of the alignment size
+        clean_pro_name_in_align(align_file_path, size_align, pdb_file=pdb_file)
+        instrumentation.add_pairs(size_align)
+        instrumentation.add_bytes(written=os.path.getsize(align_file_path))
+        job_progress.update(job_progress.done + size_align)
+        size_align -= 1
+    job_progress.finish()
+    return align_file_path
+
+
+@instrumentation.timed('run_usalign')
 def run_usalign(pdb_path, usalign_path, parallel, par_index=None,
                 par_num=5, align_folder_path=None, align_file=None, pdb_list=None,
-                sublist_path=None, pdb_list_path=None):
+                sublist_path=None, pdb_list_path=None, batch_size=1, runner='os', n_workers=4, timeout=60,
+                retries=2):
     """Run us-align to compute the pair-wise similarity of structures.
     Parameters:
     ----------
@@ -64,6 +283,14 @@ def run_usalign(pdb_path, usalign_path, parallel, par_index=None,
         Path of the US-align tool (e.g. PATH/USalign), which should be installed before computing the similarity matrix.
     parallel: bool
         If the alignment is computed in parallel.
+    batch_size: int
+        If larger than 1 and parallel, up to this number of rows next to each other in the list are computed
+        with one us-align call and saved in one 'align_batch_*.txt' file, see 'run_usalign_batch'.
+    runner: string
+        'os': the rows are computed one after another with os.system;
+        'async': (parallel only) the rows are computed by 'usalign_runner' with 'n_workers' us-align processes
+        at the same time, calls running longer than 'timeout' seconds (plus 10 seconds per pair) are killed and
+        retried 'retries' times, the pairs which still fail are saved in 'quarantine_<par_index>.txt'.
     Returns:
     ----------
     pdb_list: pandas dataframe
@@ -87,36 +314,19 @@ def run_usalign(pdb_path, usalign_path, parallel, par_index=None,
         # then create it.
         os.makedirs(align_folder_path)
         print('Folder for alignments does not exist, created!')
+    # if not parallel, the list of all .pdb files can be provided directly
+    if not parallel and pdb_list is not None and pdb_list_path is not None:
+        sublist_path = pdb_list_path
     if pdb_list is None or sublist_path is None:
         pdb_list, sublist_path = get_lists.get_lists(pdb_path, parallel=parallel, par_num=par_num)
     if parallel:
         sub_par_list_file = 'pdb_list' + str(par_index) + '.txt'
         sub_par_list_path = os.path.join(sublist_path, sub_par_list_file)
         df_sub_par = pd.read_csv(sub_par_list_path, sep='\t', header=None)
-        # for every pdb file, run similarity computation according to each pdb files in the pdb folder
-        for pdb_file in df_sub_par[0]:
-            # sub-list file name
-            list_file = 'list_' + pdb_file[:-3] + 'txt'
-            sub_list_list_path = os.path.join(sublist_path, list_file)
-            df_sub_list = pd.read_csv(sub_list_list_path, sep='\t', header=None)
-            size_align = df_sub_list.size
-            # sub-alignment file name
-            align_file = 'align_' + pdb_file[:-3] + 'txt'
-            align_file_path = os.path.join(align_folder_path, align_file)
-            # if the alignment file exit already, remove it before write into it. TODO: if it exists, one can check it
-            #  first, then decide if it should be removed or skip it to reduce computation time
-            if os.path.exists(align_file_path):
-                rm_cmd = 'rm ' + align_file_path
-                os.system(rm_cmd)
-            # do us-align
-            usalign_cmd = usalign_path + ' ' + os.path.join(pdb_path, pdb_file) + \
-                          ' -dir2 ' + pdb_path + ' ' + \
-                          sub_list_list_path + ' -outfmt 2 >> ' + \
-                          align_file_path
-            os.system(usalign_cmd)
-            # clean protein names and do sanity check of the alignment size
-            clean_pro_name_in_align(align_file_path, size_align, pdb_file=pdb_file)
-            size_align -= 1
+        align_file_path = run_usalign_rows(pdb_path, usalign_path, df_sub_par, pdb_list, sublist_path,
+                                           align_folder_path, batch_size=batch_size, runner=runner,
+                                           n_workers=n_workers, timeout=timeout, retries=retries,
+                                           job_name=str(par_index))
     # if not parallel
     else:
         size_align = pdb_list.size * (pdb_list.size - 1) / 2
@@ -126,15 +336,19 @@ def run_usalign(pdb_path, usalign_path, parallel, par_index=None,
         if os.path.exists(align_file_path):
             rm_cmd = 'rm ' + align_file_path
             os.system(rm_cmd)
+        pdb_path = structure_files.stage_structures(pdb_path, list(pdb_list[0]))
         usalign_cmd = usalign_path + ' -dir ' + pdb_path + ' ' + sublist_path + \
                       ' -outfmt 2 >> ' + align_file_path
         os.system(usalign_cmd)
         # clean protein names and do sanity check of the alignment size
         clean_pro_name_in_align(align_file_path, size_align, parallel=parallel)
+        instrumentation.add_pairs(size_align)
+        instrumentation.add_bytes(written=os.path.getsize(align_file_path))
     return align_folder_path, align_file_path
 
 
-def cat_align(pdb_list, align_folder_path=None, align_file=None):
+@instrumentation.timed('cat_align')
+def cat_align(pdb_list, align_folder_path=None, align_file=None, batch=0):
     """If the alignments are computed parallelly, concatenate them.
     Parameters:
     ----------
@@ -142,34 +356,61 @@ def cat_align(pdb_list, align_folder_path=None, align_file=None):
         Path of the file containg all .pdb files used for alignment.
     usalign_path: string
         Path of the US-align tool (e.g. PATH/USalign), which should be installed before computing the similarity matrix.
+    batch: bool
+        If the alignments are computed in batches (batch_size > 1), then all 'align_batch_*.txt' files are
+        concatenated and sorted in the order of the list.
     Returns:
     ----------
     align_all_path: string
         Path of the final pair-wise similarity matrix.
     """
-    # for each sub-alignments, concatenate it to the full alignments
-    for pdb_file in pdb_list[0][:-1]:
-        try:
-            alignment2 = 'align_' + pdb_file[:-3] + 'txt'
-            path2 = os.path.join(align_folder_path, alignment2)
-            df_2 = pd.read_csv(path2, sep='\t', dtype=str)
-            df_align_all = pd.concat([df_align_all, df_2])
-        # initialize the full alignment dataframe
-        except NameError:
-            alignment1 = 'align_' + pdb_file[:-3] + 'txt'
-            path1 = os.path.join(align_folder_path, alignment1)
-            df_align_all = pd.read_csv(path1, sep='\t', dtype=str)
+    if batch:
+        list_df = []
+        for path_batch in glob.glob(os.path.join(align_folder_path, 'align_batch_*.txt')):
+            # the protein lists of a running or killed batch, see 'align_lists'
+            if path_batch.endswith('_list1.txt') or path_batch.endswith('_list2.txt'):
+                continue
+            list_df.append(pd.read_csv(path_batch, sep='\t', dtype=str))
+        if len(list_df) == 0:
+            print('Error: no "align_batch_*.txt" files in ' + align_folder_path + ', please check that step 2 ran '
+                  'with batch_size > 1 and this folder. Program will stop here.')
+            sys.exit()
+        df_align_all = pd.concat(list_df)
+        # sort the rows in the order of the list, as if the alignments were computed row by row
+        position = dict(zip(pdb_list[0].str[:-4], range(pdb_list[0].size)))
+        df_align_all['position1'] = df_align_all['PDBchain1'].map(position)
+        df_align_all['position2'] = df_align_all['PDBchain2'].map(position)
+        df_align_all = df_align_all.sort_values(['position1', 'position2'], kind='stable')
+        df_align_all = df_align_all.drop(columns=['position1', 'position2'])
+    else:
+        # for each sub-alignments, concatenate it to the full alignments, the rows of killed or missing jobs
+        # are skipped, so 'verify_pairs' can report their pairs and write the lists for a rerun
+        list_df = []
+        missing_rows = []
+        for pdb_file in pdb_list[0][:-1]:
+            path_row = os.path.join(align_folder_path, 'align_' + pdb_file[:-3] + 'txt')
+            if not os.path.exists(path_row):
+                missing_rows.append(pdb_file[:-4])
+                continue
+            list_df.append(pd.read_csv(path_row, sep='\t', dtype=str))
+        if len(missing_rows) > 0:
+            print('Warning:', len(missing_rows), 'alignment files are missing in', align_folder_path, ', e.g.',
+                  ', '.join(missing_rows[:5]), ', their pairs are missing in the concatenated alignments.')
+        df_align_all = pd.concat(list_df + [pd.DataFrame(columns=ALIGN_COLUMNS)], ignore_index=True)
     if align_file is None:
         align_file = 'alignment_all.txt'
     align_all_path = os.path.join(align_folder_path, align_file)
     # save it
     df_align_all.to_csv(align_all_path, index=None, sep='\t')
+    instrumentation.add_pairs(len(df_align_all))
+    instrumentation.add_bytes(written=os.path.getsize(align_all_path))
     return align_all_path
 
 
 def compute_similarity(pdb_path, usalign_path, parallel=0, par_index=None,
                 par_num=5, align_folder_path=None, align_file=None, pdb_list=None,
-                       sublist_path=None, pdb_list_path=None):
+                       sublist_path=None, pdb_list_path=None, batch_size=1, runner='os', n_workers=4, timeout=60,
+                       retries=2):
     """This is a function to generate the pair-wise similarity matrix.
     Parameters:
     ----------
@@ -179,6 +420,12 @@ def compute_similarity(pdb_path, usalign_path, parallel=0, par_index=None,
         Path of the US-align tool (e.g. PATH/USalign), which should be installed before computing the similarity matrix.
     parallel: bool
         If the alignment is computed in parallel.
+    batch_size: int
+        Number of rows computed with one us-align call in parallel, see 'run_usalign'.
+    runner: string
+        'os' or 'async', how the rows of a parallel job are run, see 'run_usalign'.
+    n_workers, timeout, retries:
+        Options of the 'async' runner, see 'run_usalign'.
     Returns:
     ----------
     align_all_path: string
@@ -193,7 +440,9 @@ def compute_similarity(pdb_path, usalign_path, parallel=0, par_index=None,
         # get pdb_list and folder path of sub-alignments
         align_all_path, _ = run_usalign(pdb_path, usalign_path, 1, par_index=par_index,
                                                      par_num=par_num, align_folder_path=align_folder_path,
-                                                     pdb_list=pdb_list, sublist_path=sublist_path)
+                                                     pdb_list=pdb_list, sublist_path=sublist_path,
+                                                     batch_size=batch_size, runner=runner, n_workers=n_workers,
+                                                     timeout=timeout, retries=retries)
     # in the similarity is not computed in parallel, simplly do us-align
     else:
         _, align_all_path = run_usalign(pdb_path, usalign_path, 0, par_index=None,
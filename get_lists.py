@@ -1,21 +1,71 @@
 import copy
+import heapq
+import hashlib
 import numpy as np
 import pandas as pd
 import os
+import structure_store
+import structure_files
+import instrumentation
 
 
+@instrumentation.timed('get_lists')
 def get_lists(path,
               pdb_list_path=None,
               list_folder_path=None,
-              parallel=0, par_num=5):
+              parallel=0, par_num=5, dedup=0, store_path=None, schedule=0, batch_size=1):
     if parallel:
-        pdb_list, pdb_list_path = generate_sub_lists(path, list_folder_path=list_folder_path, par_num=par_num)
+        pdb_list, pdb_list_path = generate_sub_lists(path, list_folder_path=list_folder_path, par_num=par_num,
+                                                     dedup=dedup, store_path=store_path, schedule=schedule,
+                                                     batch_size=batch_size, pdb_list_path=pdb_list_path)
     else:
-        pdb_list, pdb_list_path = get_pdblist_all(path, pdb_list_path=pdb_list_path)
+        pdb_list, pdb_list_path = get_pdblist_all(path, pdb_list_path=pdb_list_path, dedup=dedup,
+                                                  store_path=store_path)
     return pdb_list, pdb_list_path
 
-def get_pdblist_all(path, pdb_list_path = None):
-    """get a list of all .pdb files in the provided folder.
+
+def get_duplicates(path, pdb_files, decimals=1, store=None):
+    """Group the identical structures, two structures are identical if they have the same sequence and the
+    same CA coordinates after centering and rounding, e.g. the same sequence predicted twice or a
+    re-exported file.
+    Parameters:
+    ----------
+    path: string
+        Path of the folder containing all .pdb files.
+    pdb_files: list
+        .pdb file names.
+    decimals: int
+        Number of decimals the coordinates are rounded to before they are compared. Rounding gives no
+        tolerance: two coordinates closer than 0.1 angstrom (decimals=1) can still fall on different sides
+        of a rounding boundary.
+    store: dict
+        The structure store loaded by 'structure_store.load_store' (optional), used instead of the .pdb files.
+    Returns:
+    ----------
+    groups: list
+        Lists of .pdb file names of identical structures, in the order of 'pdb_files'."""
+    groups = {}
+    for pdb_file in pdb_files:
+        xyz, seq = structure_store.read_structure(path, pdb_file, store=store)
+        if len(xyz) == 0:
+            # no CA atoms, only byte-identical files are identical
+            pdb_bytes = open(structure_files.get_source_path(path, pdb_file), 'rb')
+            key = hashlib.sha1(pdb_bytes.read()).hexdigest()
+            pdb_bytes.close()
+        else:
+            # adding 0 removes the sign of -0.0
+            xyz_norm = np.round(xyz - xyz.mean(0), decimals) + 0.
+            key = hashlib.sha1(seq.encode() + xyz_norm.tobytes()).hexdigest()
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(pdb_file)
+    return list(groups.values())
+
+
+def get_pdblist_all(path, pdb_list_path = None, dedup=0, store_path=None):
+    """get a list of all .pdb files in the provided folder. Compressed (.pdb.gz) and mmCIF (.cif, .cif.gz)
+    files are listed as '<protein ID>.pdb' too, they are staged as .pdb files for us-align, see
+    'structure_files.stage_structures'.
     Parameters:
     ----------
     path: string
@@ -23,6 +73,11 @@ def get_pdblist_all(path, pdb_list_path = None):
     pdb_list_path: sting
         Path where to save the generated list of all .pdb files. If provided, it should be end with
         a name of .txt file (e.g. PATH/list_pdb.txt)
+    dedup: bool
+        If only one representative of identical structures is kept in the list, the duplicates are saved in
+        'duplicates.txt' in the same path as the list, so they can be added back to the tree and clusters.
+    store_path: string
+        Folder of the structure store (optional), used instead of the .pdb files to find the duplicates.
     Returns:
     ----------
     pdb_list: pandas dataframe
@@ -30,21 +85,35 @@ def get_pdblist_all(path, pdb_list_path = None):
     pdb_list_path: string
         Path of the generated .txt file containing all .pdb file names"""
     # initialization of pdb list
-    pdb_list = []
-    # loop over all files in the folder, if it is .pdb file, then add it to the list
-    for file in os.listdir(path):
-        if file.endswith(".pdb"):
-            pdb_list.append(file)
-    pdb_list = pd.DataFrame(pdb_list)
+    # all structure files in the folder
+    pdb_list = structure_files.list_structures(path)
     # save the list in the same path as the file contains all .pdb files
     prj_path = os.path.dirname(path)
     if pdb_list_path is None:
         pdb_list_path = os.path.join(prj_path, 'pdb_list.txt')
+    if dedup:
+        store = None
+        if store_path is not None:
+            store = structure_store.load_store(store_path)
+        groups = get_duplicates(path, pdb_list, store=store)
+        pdb_list = [group[0] for group in groups]
+        list_rep = []
+        list_dup = []
+        for group in groups:
+            for pdb_file in group[1:]:
+                list_rep.append(group[0][:-4])
+                list_dup.append(pdb_file[:-4])
+        df_dup = pd.DataFrame({'representative': list_rep, 'duplicate': list_dup})
+        duplicates_path = os.path.join(os.path.dirname(pdb_list_path), 'duplicates.txt')
+        df_dup.to_csv(duplicates_path, index=None, sep='\t')
+        print(len(list_dup), 'duplicated structures removed from the list, saved in: ', duplicates_path)
+    pdb_list = pd.DataFrame(pdb_list)
     pdb_list.to_csv(pdb_list_path, header=None, index=None)
     return pdb_list, pdb_list_path
 
 
-def generate_sub_lists(path, list_folder_path=None, par_num=None):
+def generate_sub_lists(path, list_folder_path=None, par_num=None, dedup=0, store_path=None, schedule=0,
+                       batch_size=1, pdb_list_path=None):
     """generate sub-lists of .pdb files for running structure alignment in parallel.
     Parameters:
     ----------
@@ -53,6 +122,15 @@ def generate_sub_lists(path, list_folder_path=None, par_num=None):
     list_folder_path: sting
         Folder path where to save the generated sub-lists for computing protein similarity
         in parallel.
+    dedup: bool
+        If only one representative of identical structures is kept, see 'get_pdblist_all'.
+    schedule: bool
+        If the rows are distributed to the jobs according to their estimated cost, see 'schedule_sub_lists',
+        otherwise each job gets the same number of rows in the order of the list.
+    batch_size: int
+        If scheduled, blocks of this number of rows are kept together, see 'schedule_sub_lists'.
+    pdb_list_path: string
+        Path of the list of all .pdb files, see 'get_pdblist_all'.
     Returns:
     ----------
     df_all: pandas dataframe
@@ -71,7 +149,7 @@ def generate_sub_lists(path, list_folder_path=None, par_num=None):
         os.makedirs(list_folder_path)
         print('Folder for sub-lists of pdb files does not exist, created!')
     # get the list of all .pdb files, this is one of the outputs
-    df_all, _ = get_pdblist_all(path)
+    df_all, _ = get_pdblist_all(path, pdb_list_path=pdb_list_path, dedup=dedup, store_path=store_path)
     # copy of the overall list
     df4loop = copy.deepcopy(df_all)
     # save the list, then pop one file name out, save again, get all sub-lists in the end
@@ -80,6 +158,15 @@ def generate_sub_lists(path, list_folder_path=None, par_num=None):
         txt_path = os.path.join(list_folder_path, txt_name)
         df4loop[0].pop(i_file)
         df4loop[0].to_csv(txt_path, header=None, index=None)
+    if schedule:
+        store = None
+        if store_path is not None:
+            store = structure_store.load_store(store_path)
+        lengths = structure_store.get_lengths(path, df_all, store=store)
+        # the sub-list of each protein contains all proteins after it
+        len_after = np.cumsum(lengths[::-1])[::-1] - lengths
+        schedule_sub_lists(list_folder_path, df_all, lengths * len_after, par_num, batch_size=batch_size)
+        return df_all, list_folder_path
     sub_pdb_list_size = int(np.floor(df_all.size/par_num))
     for ind_par_num in range(par_num):
         if ind_par_num == par_num - 1:
@@ -90,3 +177,63 @@ def generate_sub_lists(path, list_folder_path=None, par_num=None):
         parlist_file_path = os.path.join(list_folder_path, par_list)
         sub_df_all.to_csv(parlist_file_path, header=None, index=None)
     return df_all, list_folder_path
+
+
+def assign_jobs(row_costs, par_num, batch_size=1):
+    """Longest-processing-time-first assignment of the rows to the jobs, see 'schedule_sub_lists'.
+    Returns:
+    ----------
+    job_rows: list
+        Row indices of every job, in the order they are computed.
+    job_costs: ndarray
+        Estimated total cost of each job."""
+    # the last protein has nothing to align with
+    block_starts = np.arange(0, row_costs.size - 1, batch_size)
+    block_costs = np.add.reduceat(row_costs[:-1], block_starts)
+    order = np.argsort(-block_costs, kind='stable')
+    job_rows = [[] for i_job in range(par_num)]
+    # the job with the smallest cost so far, the smallest index if several jobs have the same cost
+    heap = [(0., ind_job) for ind_job in range(par_num)]
+    for ind_block in order:
+        job_cost, ind_job = heapq.heappop(heap)
+        heapq.heappush(heap, (job_cost + block_costs[ind_block], ind_job))
+        job_rows[ind_job] += list(range(block_starts[ind_block],
+                                        min(block_starts[ind_block] + batch_size, row_costs.size - 1)))
+    job_costs = np.zeros(par_num)
+    for job_cost, ind_job in heap:
+        job_costs[ind_job] = job_cost
+    return job_rows, job_costs
+
+
+def schedule_sub_lists(list_folder_path, pdb_list, row_costs, par_num, batch_size=1):
+    """Distribute the rows of the alignment to the jobs with the longest-processing-time-first rule, so the
+    jobs finish at about the same time. The us-align runtime scales with the product of the two chain
+    lengths, so the cost of a row is the length of its protein times the total length of its sub-list.
+    The rows are given to the job with the smallest total cost so far, from the most to the least costly
+    one, and each job list is saved in this order, so the costly rows are computed first.
+    Parameters:
+    ----------
+    list_folder_path: string
+        Folder path of the sub-lists.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names.
+    row_costs: ndarray
+        Estimated cost of each row of the alignment, in the order of 'pdb_list'.
+    par_num: int
+        Number of jobs.
+    batch_size: int
+        If larger than 1, blocks of this number of rows next to each other in the list are distributed
+        together, so they can be computed in batches by 'run_usalign'.
+    Returns:
+    ----------
+    job_costs: ndarray
+        Estimated total cost of each job."""
+    job_rows, job_costs = assign_jobs(row_costs, par_num, batch_size=batch_size)
+    for ind_par_num in range(par_num):
+        par_list = 'pdb_list' + str(ind_par_num) + '.txt'
+        parlist_file_path = os.path.join(list_folder_path, par_list)
+        pdb_list.iloc[job_rows[ind_par_num]].to_csv(parlist_file_path, header=None, index=None)
+    if job_costs.mean() > 0:
+        print('Rows distributed to', par_num, 'jobs, the estimated cost of the slowest job is',
+              round(job_costs.max() / job_costs.mean(), 3), 'times the mean.')
+    return job_costs
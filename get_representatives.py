@@ -0,0 +1,96 @@
+import os
+import numpy as np
+import get_lists
+import get_alignments
+import structure_store
+import clustering.get_clusters
+import clustering.sparse_clusters as sparse_clusters
+
+
+def greedy_clustering(pdb_path, usalign_path, tm_cutoff=0.5, tm_score='average', batch_size=50,
+                      pdb_list=None, work_folder_path=None, store_path=None):
+    """Greedy representative clustering without all-vs-all alignment. The structures are ordered from the
+    longest to the shortest, each structure is aligned only against the current representatives and
+    joins the first representative with a TM-score not smaller than 'tm_cutoff', otherwise it becomes a
+    new representative. The number of alignments grows with n*(number of clusters) instead of n*n/2.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    usalign_path: string
+        Path of the US-align tool (e.g. PATH/USalign).
+    tm_cutoff: float
+        Smallest TM-score between a structure and the representative of its cluster.
+    tm_score: string
+        Values of TM-score to use, same as in 'align2mat', the query is the first structure.
+    batch_size: int
+        Number of structures aligned against the representatives in one us-align call.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names, if not provided, all .pdb files in the folder are used.
+    work_folder_path: string
+        Folder to save the alignments and the 'cluster_info.txt' file, if not provided, it is the
+        'greedy' folder in the same path as the pdb folder.
+    store_path: string
+        Folder of the structure store (optional), used to get the lengths instead of the .pdb files.
+    Returns:
+    ----------
+    df_clusters: pandas dataframe
+        Cluster number and protein IDs, the first protein of each cluster is its representative."""
+    if pdb_list is None:
+        pdb_list, _ = get_lists.get_pdblist_all(pdb_path)
+    if work_folder_path is None:
+        work_folder_path = os.path.join(os.path.dirname(pdb_path), 'greedy')
+    if not os.path.exists(work_folder_path):
+        os.makedirs(work_folder_path)
+        print('Folder for greedy clustering does not exist, created!')
+    store = None
+    if store_path is not None:
+        store = structure_store.load_store(store_path)
+    lengths = structure_store.get_lengths(pdb_path, pdb_list, store=store)
+    pdb_files = pdb_list[0].values[np.argsort(-lengths, kind='stable')]
+    rep_list = []
+    cluster_list = []
+    num_align = 0
+    for ind_batch, start in enumerate(range(0, pdb_files.size, batch_size)):
+        batch = list(pdb_files[start:start + batch_size])
+        rep_rank = {}
+        # align the batch against all current representatives, take the first similar representative
+        if len(rep_list) > 0:
+            align_file_path = os.path.join(work_folder_path, 'align_batch' + str(ind_batch) + '.txt')
+            df_align = get_alignments.align_lists(pdb_path, usalign_path, batch, align_file_path,
+                                                  target_list=rep_list)
+            num_align += len(df_align)
+            df_align['rank'] = df_align['PDBchain2'].map({rep[:-4]: i for i, rep in enumerate(rep_list)})
+            df_hit = df_align[sparse_clusters.get_tm(df_align, tm_score=tm_score) >= tm_cutoff]
+            df_hit = df_hit.sort_values('rank', kind='stable').drop_duplicates('PDBchain1')
+            rep_rank = dict(zip(df_hit['PDBchain1'], df_hit['rank']))
+        # the structures without representative are aligned within the batch, since the earlier ones
+        # can become representatives of the later ones
+        unassigned = [pdb_file for pdb_file in batch if pdb_file[:-4] not in rep_rank]
+        similar_pairs = set()
+        if len(unassigned) > 1:
+            align_file_path = os.path.join(work_folder_path, 'align_batch' + str(ind_batch) + '_self.txt')
+            df_self = get_alignments.align_lists(pdb_path, usalign_path, unassigned, align_file_path)
+            num_align += len(df_self)
+            # the later structure in the batch is the query, so swap the TM-scores
+            df_self = df_self.rename(columns={'PDBchain1': 'PDBchain2', 'PDBchain2': 'PDBchain1',
+                                              'TM1': 'TM2', 'TM2': 'TM1'})
+            df_self = df_self[sparse_clusters.get_tm(df_self, tm_score=tm_score) >= tm_cutoff]
+            similar_pairs = set(zip(df_self['PDBchain2'], df_self['PDBchain1']))
+        num_rep_old = len(rep_list)
+        for pdb_file in batch:
+            pro_id = pdb_file[:-4]
+            if pro_id not in rep_rank:
+                for ind_rep in range(num_rep_old, len(rep_list)):
+                    if (rep_list[ind_rep][:-4], pro_id) in similar_pairs:
+                        rep_rank[pro_id] = ind_rep
+                        break
+            if pro_id in rep_rank:
+                cluster_list[rep_rank[pro_id]].append(pro_id)
+            else:
+                rep_list.append(pdb_file)
+                cluster_list.append([pro_id])
+    print('Greedy clustering finished with ', len(cluster_list), ' clusters using ', num_align,
+          ' alignments, all-vs-all needs ', pdb_files.size * (pdb_files.size - 1) // 2, ' alignments.')
+    df_clusters = clustering.get_clusters.save_cluster_info(cluster_list, work_folder_path)
+    return df_clusters
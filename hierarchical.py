@@ -0,0 +1,149 @@
+import os
+import re
+import multiprocessing
+import numpy as np
+import pandas as pd
+import get_lists
+import get_alignments
+import get_representatives
+import prefilter
+import structure_store
+import clustering.get_clusters
+
+
+def descriptor_partition(descriptors, min_similarity=0.7):
+    """Coarse partition using the prefilter descriptors only, no alignment is needed. The structures are
+    ordered from the longest to the shortest, each one joins the first leader with a descriptor similarity
+    not smaller than 'min_similarity', otherwise it becomes a new leader.
+    Returns:
+    ----------
+    cluster_list: list
+        Lists of protein IDs of all partitions, the first protein of each partition is its leader."""
+    order = np.argsort(-descriptors['length'], kind='stable')
+    leaders = []
+    cluster_list = []
+    for ind_pro in order:
+        if len(leaders) > 0:
+            sim = prefilter.descriptor_similarity(descriptors, ind_pro, np.array(leaders))
+            hit = np.flatnonzero(sim >= min_similarity)
+            if hit.size > 0:
+                cluster_list[hit[0]].append(descriptors['name'][ind_pro])
+                continue
+        leaders.append(ind_pro)
+        cluster_list.append([descriptors['name'][ind_pro]])
+    return cluster_list
+
+
+def tree_in_partition(pdb_path, usalign_path, part_folder_path, pro_ids, method='nj', tm_score='average'):
+    """Compute all alignments and the tree of one partition, returns the tree in Newick format."""
+    if len(pro_ids) == 1:
+        return pro_ids[0]
+    if not os.path.exists(part_folder_path):
+        os.makedirs(part_folder_path)
+    pdb_list = pd.DataFrame([pro_id + '.pdb' for pro_id in pro_ids])
+    pdb_list_path = os.path.join(part_folder_path, 'pdb_list.txt')
+    pdb_list.to_csv(pdb_list_path, header=None, index=None)
+    align_folder_path = os.path.join(part_folder_path, 'alignments')
+    align_all_path = get_alignments.compute_similarity(pdb_path, usalign_path, align_folder_path=align_folder_path,
+                                                       pdb_list=pdb_list, pdb_list_path=pdb_list_path)
+    # the same distance 1 - TM-score in all partitions and the top-level tree, so the grafted branches fit
+    _, path_tree_folder = clustering.get_clusters.get_tree_file(align_all_path, method=method, tm_score=tm_score,
+                                                                pdb_list=pdb_list, normalize=0)
+    tree_file = open(os.path.join(path_tree_folder, 'tree_' + method + '.nwk'), 'r')
+    tree_nwk = tree_file.read()
+    tree_file.close()
+    return tree_nwk
+
+
+def graft_trees(top_nwk, sub_nwks):
+    """Replace each leaf of the top-level tree by the tree of the partition it represents.
+    Parameters:
+    ----------
+    top_nwk: string
+        Tree of the partition representatives in Newick format.
+    sub_nwks: dict
+        Tree of each partition in Newick format, with the ID of the representative as key."""
+    for rep_id, sub_nwk in sub_nwks.items():
+        # a leaf name always follows '(' or ',' and is followed by its branch length
+        top_nwk = re.sub('(?<=[(,])' + re.escape(rep_id) + '(?=:)', lambda match: sub_nwk, top_nwk, count=1)
+    return top_nwk
+
+
+def hierarchical_tree(pdb_path, usalign_path, partition='greedy', tm_cutoff=0.3, min_similarity=0.7,
+                      method='nj', tm_score='average', n_jobs=4, prj_folder_path=None, store_path=None):
+    """Two-level tree building for large sets: first a coarse partition, then the exact tree of each
+    partition, computed in parallel, and at last a top-level tree of the partition representatives, into
+    which the trees of the partitions are grafted. The cost is the sum of n_i*n_i of the partitions instead
+    of n*n. All trees use the distance 1 - TM-score without the min-max normalization of each set, so the
+    branch lengths of the partitions and the top-level tree are on the same scale.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    usalign_path: string
+        Path of the US-align tool (e.g. PATH/USalign).
+    partition: string
+        'greedy': greedy representative clustering with us-align at 'tm_cutoff';
+        'descriptors': leader clustering of the prefilter descriptors at 'min_similarity', no alignment.
+    method: string
+        'nj' or 'upgma', the method to build the trees.
+    n_jobs: int
+        Number of partitions computed at the same time.
+    prj_folder_path: string
+        Folder to save the partitions and the final tree, if not provided, it is the 'partitions' folder
+        in the same path as the pdb folder.
+    store_path: string
+        Folder of the structure store (optional), used instead of the .pdb files for the partition.
+    Returns:
+    ----------
+    save_tree_path: string
+        Path of the final .nwk file."""
+    if prj_folder_path is None:
+        prj_folder_path = os.path.join(os.path.dirname(pdb_path), 'partitions')
+    if not os.path.exists(prj_folder_path):
+        os.makedirs(prj_folder_path)
+    pdb_list, _ = get_lists.get_pdblist_all(pdb_path, pdb_list_path=os.path.join(prj_folder_path, 'pdb_list.txt'))
+    # coarse partition
+    if partition == 'descriptors':
+        store = None
+        if store_path is not None:
+            store = structure_store.load_store(store_path)
+        descriptors = prefilter.get_descriptors(pdb_path, pdb_list,
+                                                descriptor_path=os.path.join(prj_folder_path, 'descriptors.npz'),
+                                                store=store)
+        cluster_list = descriptor_partition(descriptors, min_similarity=min_similarity)
+        clustering.get_clusters.save_cluster_info(cluster_list, prj_folder_path)
+    else:
+        df_clusters = get_representatives.greedy_clustering(pdb_path, usalign_path, tm_cutoff=tm_cutoff,
+                                                            tm_score=tm_score, pdb_list=pdb_list,
+                                                            work_folder_path=prj_folder_path,
+                                                            store_path=store_path)
+        cluster_list = list(df_clusters.groupby('cluster_number', sort=True)['protein_ID'].apply(list))
+    print('Coarse partition finished with ', len(cluster_list), ' partitions, the largest one has ',
+          max([len(i_cluster) for i_cluster in cluster_list]), ' proteins.')
+    # exact trees within the partitions, the largest partitions first
+    order = np.argsort([-len(i_cluster) for i_cluster in cluster_list], kind='stable')
+    args = []
+    for ind_part in order:
+        part_folder_path = os.path.join(prj_folder_path, 'part' + str(ind_part + 1))
+        args.append((pdb_path, usalign_path, part_folder_path, cluster_list[ind_part], method, tm_score))
+    pool = multiprocessing.Pool(n_jobs)
+    sub_trees = pool.starmap(tree_in_partition, args)
+    pool.close()
+    pool.join()
+    sub_nwks = {}
+    for ind_part, sub_nwk in zip(order, sub_trees):
+        sub_nwks[cluster_list[ind_part][0]] = sub_nwk
+    # top-level tree of the representatives
+    if len(cluster_list) == 1:
+        tree_nwk = sub_nwks[cluster_list[0][0]]
+    else:
+        top_nwk = tree_in_partition(pdb_path, usalign_path, os.path.join(prj_folder_path, 'top'),
+                                    [i_cluster[0] for i_cluster in cluster_list], method=method, tm_score=tm_score)
+        tree_nwk = graft_trees(top_nwk, sub_nwks)
+    save_tree_path = os.path.join(prj_folder_path, 'tree_' + method + '_hierarchical.nwk')
+    file_tree = open(save_tree_path, 'w')
+    file_tree.write(tree_nwk)
+    file_tree.close()
+    print('The nwk file for tree plot is saved in: ', save_tree_path)
+    return save_tree_path
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+from collections import Counter
+try:
+    import resource
+except ImportError:
+    # not available on Windows, then CPU time of the children and peak memory are not recorded
+    resource = None
+
+
+# options of the recorder, the stages are always recorded since it costs a few microseconds per stage
+OPTIONS = {'merges': 0, 'merge_every': 1, 'profile': 0, 'profile_interval': 0.005}
+STAGES = []
+MERGES = []
+PROFILE = Counter()
+_STACK = []
+
+
+def enable(merges=1, merge_every=1, profile=0, profile_interval=0.005):
+    """Switch on the detailed recording of the tree loop.
+    Parameters:
+    ----------
+    merges: bool
+        If the time and matrix size of the merges are recorded.
+    merge_every: int
+        Only every 'merge_every'-th merge is recorded.
+    profile: bool
+        If the tree loop is sampled by 'SamplingProfiler'.
+    profile_interval: float
+        Seconds between two samples of the profiler."""
+    OPTIONS.update({'merges': merges, 'merge_every': merge_every, 'profile': profile,
+                    'profile_interval': profile_interval})
+
+
+def reset():
+    """Remove all records, e.g. between two runs in the same process."""
+    del STAGES[:]
+    del MERGES[:]
+    PROFILE.clear()
+
+
+def snapshot():
+    """Current wall time, CPU time of this process and of its finished children (e.g. us-align), peak
+    memory in MB and bytes read/written by this process."""
+    snap = {'wall': time.perf_counter(), 'cpu': time.process_time(), 'cpu_children': 0., 'rss_peak_mb': 0.,
+            'rss_peak_children_mb': 0., 'bytes_read': 0, 'bytes_written': 0}
+    if resource is not None:
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        snap['cpu_children'] = usage_children.ru_utime + usage_children.ru_stime
+        # kilobytes on Linux, bytes on macOS
+        scale = 1024. * 1024. if sys.platform == 'darwin' else 1024.
+        snap['rss_peak_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        snap['rss_peak_children_mb'] = usage_children.ru_maxrss / scale
+    if os.path.exists('/proc/self/io'):
+        io_file = open('/proc/self/io', 'r')
+        for line in io_file:
+            key, value = line.split(':')
+            if key == 'rchar':
+                snap['bytes_read'] = int(value)
+            elif key == 'wchar':
+                snap['bytes_written'] = int(value)
+        io_file.close()
+    return snap
+
+
+def start_stage(name):
+    """Start recording a stage, stages can be nested. Returns the record, to be passed to 'end_stage'."""
+    record = {'stage': name, 'parent': _STACK[-1]['stage'] if len(_STACK) > 0 else '', 'pairs': 0,
+              'bytes_read_files': 0, 'bytes_written_files': 0, '_start': snapshot()}
+    _STACK.append(record)
+    return record
+
+
+def end_stage(record):
+    """Finish the record of a stage and add it to the report."""
+    end = snapshot()
+    start = record.pop('_start')
+    if record in _STACK:
+        _STACK.remove(record)
+    record['wall_s'] = end['wall'] - start['wall']
+    record['cpu_s'] = end['cpu'] - start['cpu']
+    record['cpu_children_s'] = end['cpu_children'] - start['cpu_children']
+    record['rss_peak_mb'] = end['rss_peak_mb']
+    record['rss_peak_children_mb'] = end['rss_peak_children_mb']
+    record['bytes_read'] = end['bytes_read'] - start['bytes_read']
+    record['bytes_written'] = end['bytes_written'] - start['bytes_written']
+    record['pairs_per_s'] = record['pairs'] / record['wall_s'] if record['wall_s'] > 0 else 0.
+    STAGES.append(record)
+    return record
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Record a block of code as a stage."""
+    record = start_stage(name)
+    try:
+        yield record
+    finally:
+        end_stage(record)
+
+
+def timed(name):
+    """Decorator to record every call of a function as a stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_pairs(num_pairs):
+    """Add a number of aligned or read pairs to the current stage."""
+    if len(_STACK) > 0:
+        _STACK[-1]['pairs'] += int(num_pairs)
+
+
+def add_bytes(read=0, written=0):
+    """Add the size of files read or written to the current stage, e.g. files written by us-align, which
+    are not counted in the bytes of this process."""
+    if len(_STACK) > 0:
+        _STACK[-1]['bytes_read_files'] += int(read)
+        _STACK[-1]['bytes_written_files'] += int(written)
+
+
+def record_merge(ind_merge, len_matrix, seconds):
+    """Record one merge of the tree loop, the matrix has len_matrix*len_matrix cells."""
+    if OPTIONS['merges'] and ind_merge % OPTIONS['merge_every'] == 0:
+        MERGES.append({'merge': ind_merge, 'len_matrix': len_matrix, 'seconds': seconds,
+                       'cells_per_s': len_matrix * len_matrix / seconds if seconds > 0 else 0.})
+
+
+class SamplingProfiler:
+    """Sampling profiler for a block of code running in the current thread: a second thread looks at the
+    stack of the current thread every 'interval' seconds and counts the function and line on top of it.
+    The overhead is independent of the number of function calls, unlike cProfile."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = Counter()
+        self.thread_id = threading.get_ident()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                code = frame.f_code
+                self.counts[os.path.basename(code.co_filename) + ':' + code.co_name + ':' +
+                            str(frame.f_lineno)] += 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        PROFILE.update(self.counts)
+        return self.counts
+
+
+def start_profiler():
+    """Start the sampling profiler if it is enabled, returns None otherwise."""
+    if OPTIONS['profile']:
+        return SamplingProfiler(interval=OPTIONS['profile_interval']).start()
+    return None
+
+
+def write_report(report_path, top=50):
+    """Save all records as a JSON file (stages, merges and the 'top' profile entries) and the stages as a
+    .csv file next to it.
+    Returns:
+    ----------
+    df_stages: pandas dataframe
+        One row for every recorded stage."""
+    if not report_path.endswith('.json'):
+        report_path = report_path + '.json'
+    total = sum(PROFILE.values())
+    profile = [{'location': location, 'samples': count, 'fraction': count / float(total)}
+               for location, count in PROFILE.most_common(top)]
+    report = {'stages': STAGES, 'merges': MERGES, 'profile': profile}
+    report_file = open(report_path, 'w')
+    json.dump(report, report_file, indent=1)
+    report_file.close()
+    # pandas is only needed for the report, not for recording the stages
+    import pandas as pd
+    df_stages = pd.DataFrame(STAGES)
+    df_stages.to_csv(report_path[:-5] + '_stages.csv', index=None)
+    print('The run report is saved in: ', report_path)
+    return df_stages
@@ -0,0 +1,15 @@
+"""this is an example to run on 192.168.66.203"""
+"""note: the protein IDs should not contain '(' or ')'"""
+"""this scrip clusters the proteins at a TM-score cutoff without all-vs-all alignment, e.g. for redundancy reduction"""
+import get_representatives
+######### this are parameters to be modified
+pdb_folder_path = '/dellfsqd2/ST_OCEAN/USER/wangdantong/python_toolbox_test/stacpro/pdb_files'
+usalign_path = '/dellfsqd2/ST_OCEAN/USER/wangdantong/toolboxes/usalign/USalign/USalign'
+# smallest TM-score between a protein and the representative of its cluster
+tm_cutoff = 0.5
+# number of proteins aligned against the representatives in one us-align call
+batch_size = 50
+
+######### this lines you do not need to touch
+df = get_representatives.greedy_clustering(pdb_folder_path, usalign_path, tm_cutoff=tm_cutoff,
+                                           batch_size=batch_size)
@@ -0,0 +1,17 @@
+"""this is an example to run on 192.168.66.203"""
+"""note: the protein IDs should not contain '(' or ')'"""
+"""this scrip builds the tree of a large set in two levels: a coarse partition, then exact trees per partition"""
+import hierarchical
+######### this are parameters to be modified
+pdb_folder_path = '/dellfsqd2/ST_OCEAN/USER/wangdantong/python_toolbox_test/stacpro/pdb_files'
+usalign_path = '/dellfsqd2/ST_OCEAN/USER/wangdantong/toolboxes/usalign/USalign/USalign'
+# 'greedy': partition with us-align at tm_cutoff; 'descriptors': partition with the prefilter descriptors
+partition = 'greedy'
+tm_cutoff = 0.3
+min_similarity = 0.7
+# number of partitions computed at the same time
+n_jobs = 8
+
+######### this lines you do not need to touch
+save_tree_path = hierarchical.hierarchical_tree(pdb_folder_path, usalign_path, partition=partition,
+                                                tm_cutoff=tm_cutoff, min_similarity=min_similarity, n_jobs=n_jobs)
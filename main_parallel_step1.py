@@ -2,17 +2,52 @@
 """note: the protein IDs should not contain '(' or ')'"""
 import os
 import get_lists
+import prefilter
+import structure_store
+import work_queue
 ######### this are parameters to be modified
 pdb_folder_path = '/dellfsqd2/ST_OCEAN/USER/wangdantong/python_toolbox_test/stacpro/pdb_files'
 # define how many jobs you want to divide the alignment computation into.
 par_num = 30
+# if the rows are distributed to the jobs by their estimated cost (longest first), instead of in equal numbers
+schedule = 1
+# number of rows computed with one us-align call in step2, should be the same in step2 and step3
+batch_size = 1
+# if all structures are parsed once into a compact store, which is then used by dedup and the prefilter
+ingest = 0
+# if only one of identical structures is aligned, the others are saved in duplicates.txt next to pdb_list.txt
+dedup = 0
+# optional prefilter, pairs with a descriptor similarity lower than this value are not aligned (None: no prefilter)
+min_similarity = None
+# optional, used to estimate the recall of the prefilter on a sample of pairs
+usalign_path = None
+# if the rows are put into a work queue, then any number of 'main_parallel_worker.py' jobs can compute them instead
+# of step2, the number of tiles should be a few times the number of workers (None: no work queue)
+num_tiles = None
 
 ######### this lines you do not need to touch
 parallel = 1
-pdb_list, pdb_list_path = get_lists.get_lists(pdb_folder_path, parallel=parallel, par_num=par_num)
+store_path = None
+if ingest:
+    pdb_list_all, _ = get_lists.get_pdblist_all(pdb_folder_path)
+    store_path = structure_store.ingest_structures(pdb_folder_path, pdb_list_all)
+pdb_list, pdb_list_path = get_lists.get_lists(pdb_folder_path, parallel=parallel, par_num=par_num, dedup=dedup,
+                                              store_path=store_path, schedule=schedule,
+                                              batch_size=batch_size)
+if min_similarity is not None:
+    prefilter.prefilter_sub_lists(pdb_folder_path, pdb_list_path, pdb_list, min_similarity=min_similarity,
+                                  usalign_path=usalign_path, store_path=store_path,
+                                  par_num=par_num if schedule else None, batch_size=batch_size)
+if num_tiles is not None:
+    queue_path = work_queue.init_queue(pdb_list_path, pdb_list, num_tiles=num_tiles)
+    print('Please use this path as the "queue_path" input for main_parallel_worker.py:')
+    print(queue_path)
 print('Please use this path as the "sublist_path" input for the next step:')
 print(pdb_list_path)
 prjfoler = os.path.dirname(pdb_folder_path)
 pdb_txt_path = os.path.join(prjfoler, 'pdb_list.txt')
 print('Please use this path as the "pdb_list_path" input for step2 and step3:')
 print(pdb_txt_path)
+if dedup:
+    print('Please use this path as the "duplicates_path" input for step4:')
+    print(os.path.join(prjfoler, 'duplicates.txt'))
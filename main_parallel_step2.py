@@ -1,23 +1,45 @@
 """this is an example to run on 27.18.114.42"""
 """note: the protein IDs should not contain '(' or ')'"""
 """this scrip is to be submitted in parallel to compute the similarity between all proteins"""
+import os
 import sys
 import get_alignments
 import pandas as pd
+import instrumentation
+import progress
 ######### this are parameters to be modified
 pdb_folder_path='/dellfsqd2/ST_OCEAN/USER/wangdantong/python_toolbox_test/stacpro/pdb_files'
 usalign_path='/dellfsqd2/ST_OCEAN/USER/wangdantong/toolboxes/usalign/USalign/USalign'
 # this inputs depend on the output of step 1
 sublist_path = '/home/share/huadjyin/home/fanguangyi/wangdantong/projects/PETs/predictions_2928/sublists'
 pdb_list_path = '/home/share/huadjyin/home/fanguangyi/wangdantong/projects/PETs/predictions_2928/pdb_list.txt'
+# folder of the alignments, None for the 'alignments' folder next to the pdb folder, use a separate folder to
+# compute the missing pairs of step3 (e.g. rerun/alignments), so the existing alignment files are kept
+align_folder_path = None
 # par_num should be the same as in step1
 par_num = 30
+# number of rows computed with one us-align call, larger values are faster for small proteins (e.g. domains)
+batch_size = 1
+# 'async' runs n_workers us-align processes at the same time in one job, kills the calls running longer than
+# timeout seconds (plus 10 seconds per pair), and saves the pairs which still fail after the retries in a quarantine
+# report instead of stopping the job
+runner = 'os'
+n_workers = 4
+timeout = 60
+retries = 2
 
 ######### this lines you do not need to touch
+# the latest progress and ETA of this job, updated at most every minute, can be polled by the scheduler
+progress.configure(progress_path=os.path.join(os.path.dirname(sublist_path), 'progress_' + sys.argv[1] + '.json'),
+                   interval=60)
 pdb_list = pd.read_csv(pdb_list_path, sep='\t', header=None)
 parallel = 1
 # use for loop over "par_index" to submit the computation in parallel, with par_index = 0 ~ par_num
 align_all_path = get_alignments.compute_similarity(pdb_folder_path, usalign_path, parallel=parallel,
-                                                   par_index=int(sys.argv[1]), par_num=par_num, pdb_list=pdb_list, sublist_path=sublist_path)
+                                                   par_index=int(sys.argv[1]), par_num=par_num, pdb_list=pdb_list, sublist_path=sublist_path,
+                                                   align_folder_path=align_folder_path,
+                                                   batch_size=batch_size, runner=runner, n_workers=n_workers,
+                                                   timeout=timeout, retries=retries)
+instrumentation.write_report(os.path.join(align_all_path, 'run_report_' + sys.argv[1] + '.json'))
 print('Please use this path as the "align_folder_path" input for the next step:')
 print(align_all_path)
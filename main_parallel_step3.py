@@ -1,16 +1,31 @@
 """this is an example to run on 27.18.114.42"""
 """note: the protein IDs should not contain '(' or ')'"""
 """this scrip generates the nwk file for tree plot on itol website"""
+import os
 import pandas as pd
 import get_alignments
+import verify_pairs
 ######### this are parameters to be modified
 # this inputs depend on the output of step 1
 pdb_list_path = '/home/share/huadjyin/home/fanguangyi/wangdantong/projects/PETs/predictions_2928/pdb_list.txt'
 align_folder_path = '/home/share/huadjyin/home/fanguangyi/wangdantong/projects/PETs/predictions_2928/alignments'
+# batch_size in step2 (1 or larger)
+batch_size = 1
+# folder of the sub-lists, only needed if the prefilter was used in step1, so not all pairs are expected
+sublist_path = None
 
 ######### this lines you do not need to touch
 pdb_list = pd.read_csv(pdb_list_path, sep='\t', header=None)
-align_all_path = get_alignments.cat_align(pdb_list, align_folder_path=align_folder_path)
+align_all_path = get_alignments.cat_align(pdb_list, align_folder_path=align_folder_path, batch=batch_size > 1)
+# check that every pair is there exactly once, the missing pairs are saved as sub-lists in the 'rerun' folder
+rerun_path = os.path.join(os.path.dirname(pdb_list_path), 'rerun')
+report = verify_pairs.verify_pairs(align_all_path, pdb_list, sublist_path=sublist_path, rerun_path=rerun_path)
+if len(report['missing']) > 0:
+    # the rerun has its own alignment folder, otherwise it would overwrite the alignment files of the full rows
+    rerun_align_path = os.path.join(rerun_path, 'alignments')
+    print('Please compute the missing pairs with step2 using par_index=0, sublist_path=', rerun_path,
+          'and align_folder_path=', rerun_align_path, ', then add them with verify_pairs.repair_alignment(',
+          align_all_path, ',', rerun_align_path, ', pdb_list).')
 print('Please use this path as the "align_all_path" input for the next step:')
 print(align_all_path)
 
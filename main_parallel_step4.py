@@ -1,4 +1,8 @@
+import os
+import pandas as pd
 import clustering.get_clusters
+import instrumentation
+import progress
 """this is an example to run on 27.18.114.42"""
 """note: the protein IDs should not contain '(' or ')'"""
 """this scrip generates the nwk file for tree plot on itol website"""
@@ -7,9 +11,37 @@ import clustering.get_clusters
 align_all_path = 'D:\\python_toolbox_test\\stacpro\\alignments\\alignment_all.txt'
 # this is to define how many node you want to have in one cluster
 node_number_upward = 3
+# path of duplicates.txt from step 1 if dedup=1, otherwise None
+duplicates_path = None
+# path of pdb_list.txt from step 1 if the pairs were prefiltered (min_similarity is not None), otherwise None,
+# the pairs skipped by the prefilter are missing in alignment_all.txt and get the largest distance
+pdb_list_path = None
+# folder of the checkpoints of the tree building, saved every checkpoint_interval seconds, set resume = 1
+# to continue after the job was killed, e.g. by the walltime of the cluster
+checkpoint_path = os.path.join(os.path.dirname(align_all_path), 'checkpoint')
+checkpoint_interval = 3600
+resume = 0
+# the distance matrix is saved for the medoids and similarities of the clusters (cluster_stats.txt), None to skip
+matrix_path = os.path.join(os.path.dirname(align_all_path), 'trees', 'distance_matrix.npy')
+# threads of every NJ merge step, 0 for the original serial step, the tree is the same
+n_threads = 0
+# 'rapid' for the bounded NJ search, which scans only a part of the matrix in every merge, the tree is the same
+nj_search = 'full'
 
 # ######## this lines you do not need to touch
-labels, path_tree_folder = clustering.get_clusters.get_tree_file(align_all_path)
-df = clustering.get_clusters.clustering_upward(labels, node_number_upward, path_tree_folder)
+instrumentation.enable(merges=1, profile=0)
+progress.configure(progress_path=os.path.join(os.path.dirname(align_all_path), 'progress.json'), interval=60)
+pdb_list = pd.read_csv(pdb_list_path, sep='\t', header=None) if pdb_list_path is not None else None
+labels, path_tree_folder = clustering.get_clusters.get_tree_file(align_all_path, pdb_list=pdb_list,
+                                                                 duplicates_path=duplicates_path,
+                                                                 checkpoint_path=checkpoint_path,
+                                                                 checkpoint_interval=checkpoint_interval, resume=resume,
+                                                                 matrix_path=matrix_path, n_threads=n_threads,
+                                                                 nj_search=nj_search)
+df = clustering.get_clusters.clustering_upward(labels, node_number_upward, path_tree_folder,
+                                               duplicates_path=duplicates_path, matrix_path=matrix_path)
 # you can define the number of points from the top down as well,
 # df = clustering.get_clusters.clustering_downward(labels, node_number_downward, path_tree_folder)
+# for large sets, you can cluster a sparse similarity graph without building the tree and the full matrix,
+# df = clustering.get_clusters.clustering_sparse(align_all_path, tm_cutoff=0.5, method='components')
+instrumentation.write_report(os.path.join(path_tree_folder, 'run_report.json'))
@@ -0,0 +1,27 @@
+"""this is an example to run on 27.18.114.42"""
+"""note: the protein IDs should not contain '(' or ')'"""
+"""this scrip replaces step2 if the work queue is used in step1, submit as many copies as you want on any nodes,
+each one computes the next unfinished tile until all tiles are done, then run step3"""
+import pandas as pd
+import work_queue
+######### this are parameters to be modified
+pdb_folder_path='/dellfsqd2/ST_OCEAN/USER/wangdantong/python_toolbox_test/stacpro/pdb_files'
+usalign_path='/dellfsqd2/ST_OCEAN/USER/wangdantong/toolboxes/usalign/USalign/USalign'
+# this inputs depend on the output of step 1
+sublist_path = '/home/share/huadjyin/home/fanguangyi/wangdantong/projects/PETs/predictions_2928/sublists'
+pdb_list_path = '/home/share/huadjyin/home/fanguangyi/wangdantong/projects/PETs/predictions_2928/pdb_list.txt'
+queue_path = '/home/share/huadjyin/home/fanguangyi/wangdantong/projects/PETs/predictions_2928/sublists/queue'
+align_folder_path = '/home/share/huadjyin/home/fanguangyi/wangdantong/projects/PETs/predictions_2928/alignments'
+# a tile of a killed worker is computed again by another worker after this number of seconds
+lease_time = 3600
+# same as in step2
+batch_size = 1
+runner = 'os'
+
+######### this lines you do not need to touch
+pdb_list = pd.read_csv(pdb_list_path, sep='\t', header=None)
+work_queue.run_worker(pdb_folder_path, usalign_path, queue_path, pdb_list, sublist_path, align_folder_path,
+                      lease_time=lease_time, batch_size=batch_size, runner=runner)
+if work_queue.queue_status(queue_path):
+    print('All tiles are done, please use this path as the "align_folder_path" input for step3:')
+    print(align_folder_path)
@@ -1,10 +1,25 @@
 """this is an example to run on 192.168.66.203"""
 """note: the protein IDs should not contain '(' or ')'"""
+import os
 import get_lists
 import get_alignments
 import clustering.get_clusters
+import instrumentation
+import progress
 pdb_folder_path = '/dellfsqd2/ST_OCEAN/USER/wangdantong/python_toolbox_test/stacpro/pdb_files'
 usalign_path = '/dellfsqd2/ST_OCEAN/USER/wangdantong/toolboxes/usalign/USalign/USalign'
-pdb_list, pdb_list_path = get_lists.get_lists(pdb_folder_path)
-align_all_path = get_alignments.compute_similarity(pdb_folder_path, usalign_path)
+# record the time of every merge of the tree loop, set profile=1 to also sample where the tree loop spends its time
+instrumentation.enable(merges=1, profile=0)
+# print the progress and ETA of the tree loop every minute, and keep the latest one in progress.json
+progress.configure(progress_path=os.path.join(os.path.dirname(pdb_folder_path), 'progress.json'), interval=60)
+# with dedup=1, identical structures are aligned only once and added back to the tree
+pdb_list, pdb_list_path = get_lists.get_lists(pdb_folder_path, dedup=0)
+align_all_path = get_alignments.compute_similarity(pdb_folder_path, usalign_path, pdb_list=pdb_list,
+                                                   pdb_list_path=pdb_list_path)
 clustering.get_clusters.get_tree_file(align_all_path, plot=1)
+# if dedup=1, use the duplicates file saved next to the list,
+# clustering.get_clusters.get_tree_file(align_all_path, plot=1,
+#                                       duplicates_path=os.path.join(os.path.dirname(pdb_list_path), 'duplicates.txt'))
+
+# wall/CPU time, peak memory, pairs per second and bytes of every stage
+instrumentation.write_report(os.path.join(os.path.dirname(pdb_folder_path), 'run_report.json'))
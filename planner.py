@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import socket
+import subprocess
+import numpy as np
+import pandas as pd
+import get_lists
+import structure_store
+import structure_files
+
+# default cost model of one us-align call: seconds = SECONDS_PER_RESIDUE2 * L1 * L2 + SECONDS_PER_PAIR, a rough
+# value for a current CPU core, please calibrate it on the cluster with 'calibrate_cost'
+DEFAULT_COST = {'seconds_per_residue2': 2e-6, 'seconds_per_pair': 0.01}
+# approximate memory of one pair in the pandas dataframe read by 'align2mat' (IDs, scores and their index)
+BYTES_PER_PAIR = 250
+# number of n*n matrices at the same time in the tree loop: the matrix and the new matrix, plus the
+# Q-matrix for NJ
+MATRICES_TREE = {'upgma': 2, 'nj': 3}
+
+
+def get_pdb_list(pdb_path):
+    """All structures of the folder, in the same order as 'get_lists', without saving the list."""
+    return pd.DataFrame(structure_files.list_structures(pdb_path))
+
+
+def calibrate_cost(pdb_path, usalign_path, pdb_list=None, num_pairs=30, seed=0, calibration_path=None):
+    """Fit the cost model of us-align on this machine: a sample of pairs with different lengths is aligned
+    one by one, and the wall times are fitted with seconds = a * L1 * L2 + b by least squares.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    usalign_path: string
+        Path of the US-align tool.
+    num_pairs: int
+        Number of aligned pairs, the pairs are spread over the range of the length products.
+    calibration_path: string
+        If provided, the fitted model is saved as a JSON file, which can be used by 'plan_run'.
+    Returns:
+    ----------
+    cost: dict
+        'seconds_per_residue2' (a) and 'seconds_per_pair' (b)."""
+    if pdb_list is None:
+        pdb_list = get_pdb_list(pdb_path)
+    lengths = structure_store.get_lengths(pdb_path, pdb_list)
+    rng = np.random.default_rng(seed)
+    # many random pairs, then the sample is taken evenly over their sorted length products
+    ind_pro1 = rng.integers(0, lengths.size, 100 * num_pairs)
+    ind_pro2 = rng.integers(0, lengths.size, 100 * num_pairs)
+    keep = ind_pro1 != ind_pro2
+    ind_pro1 = ind_pro1[keep]
+    ind_pro2 = ind_pro2[keep]
+    order = np.argsort(lengths[ind_pro1] * lengths[ind_pro2])
+    sample = order[np.linspace(0, order.size - 1, min(num_pairs, order.size)).astype(int)]
+    products = []
+    seconds = []
+    usalign_pdb_path = structure_files.stage_structures(
+        pdb_path, list(pdb_list[0].iloc[np.union1d(ind_pro1[sample], ind_pro2[sample])]))
+    for ind_pair in sample:
+        pdb1 = os.path.join(usalign_pdb_path, pdb_list[0].iloc[ind_pro1[ind_pair]])
+        pdb2 = os.path.join(usalign_pdb_path, pdb_list[0].iloc[ind_pro2[ind_pair]])
+        time_start = time.perf_counter()
+        subprocess.run([usalign_path, pdb1, pdb2, '-outfmt', '2'], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - time_start)
+        products.append(float(lengths[ind_pro1[ind_pair]]) * lengths[ind_pro2[ind_pair]])
+    design = np.stack([np.array(products), np.ones(len(products))], axis=1)
+    coef, _, _, _ = np.linalg.lstsq(design, np.array(seconds), rcond=None)
+    cost = {'seconds_per_residue2': max(float(coef[0]), 0.), 'seconds_per_pair': max(float(coef[1]), 0.),
+            'num_pairs': len(products), 'host': socket.gethostname(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    print('Cost of us-align on this machine:', cost['seconds_per_residue2'], 's * L1 * L2 +',
+          cost['seconds_per_pair'], 's per pair')
+    if calibration_path is not None:
+        calibration_file = open(calibration_path, 'w')
+        json.dump(cost, calibration_file, indent=1)
+        calibration_file.close()
+    return cost
+
+
+def load_cost(calibration_path=None):
+    """Load the cost model saved by 'calibrate_cost', 'DEFAULT_COST' if not provided."""
+    if calibration_path is None:
+        return dict(DEFAULT_COST)
+    calibration_file = open(calibration_path, 'r')
+    cost = json.load(calibration_file)
+    calibration_file.close()
+    return cost
+
+
+def row_seconds(lengths, cost):
+    """Estimated us-align CPU seconds of every row of the alignment, a row aligns its protein with all
+    proteins after it in the list."""
+    len_after = np.cumsum(lengths[::-1])[::-1] - lengths
+    num_after = np.arange(lengths.size)[::-1]
+    return cost['seconds_per_residue2'] * lengths.astype(float) * len_after + cost['seconds_per_pair'] * num_after
+
+
+def tree_memory(num_pro, method='nj', dtype='float64'):
+    """Estimated peak memory in GB of the tree stage: the pair-wise similarity read by 'align2mat' together
+    with the matrix, or the matrices of the tree loop, whichever is larger."""
+    num_pairs = num_pro * (num_pro - 1) / 2.
+    bytes_matrix = float(num_pro - 1) ** 2 * np.dtype(dtype).itemsize
+    bytes_read = num_pairs * BYTES_PER_PAIR + bytes_matrix
+    bytes_loop = MATRICES_TREE.get(method, 3) * bytes_matrix
+    return max(bytes_read, bytes_loop) / 1024. ** 3
+
+
+def seconds2walltime(seconds):
+    """Walltime in the format of the schedulers, HH:MM:SS, rounded up to full minutes."""
+    minutes = int(np.ceil(seconds / 60.))
+    return '%02d:%02d:00' % (minutes // 60, minutes % 60)
+
+
+def plan_run(pdb_path, target_hours=24, n_workers=1, batch_size=1, safety=1.5, method='nj', dtype='float64',
+             calibration_path=None, pdb_list=None, plan_path=None):
+    """Estimate the cost of the all-vs-all alignment before step 2, and recommend the number of jobs and their
+    walltime for a target makespan.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    target_hours: float
+        Wanted wall time of step 2 if all jobs run at the same time.
+    n_workers: int
+        Cores of every job, i.e. us-align processes at the same time ('async' runner), 1 for the 'os' runner.
+    batch_size: int
+        Same as in step 1, the rows are distributed to the jobs in blocks of this size.
+    safety: float
+        Factor on the estimated times, for the error of the cost model and slower nodes.
+    method, dtype:
+        Tree method and data type of the distance matrix, for the memory of the tree stage.
+    calibration_path: string
+        Cost model saved by 'calibrate_cost', the rough 'DEFAULT_COST' if not provided.
+    plan_path: string
+        If provided, the plan is saved as a JSON file.
+    Returns:
+    ----------
+    plan: dict
+        Total CPU hours, recommended 'par_num' and walltime per job, and the memory of the tree stage."""
+    if pdb_list is None:
+        pdb_list = get_pdb_list(pdb_path)
+    lengths = structure_store.get_lengths(pdb_path, pdb_list)
+    cost = load_cost(calibration_path)
+    seconds = row_seconds(lengths, cost)
+    cpu_seconds = seconds.sum()
+    num_blocks = int(np.ceil((lengths.size - 1) / float(batch_size)))
+    target_seconds = target_hours * 3600. / safety
+
+    def makespan(par_num):
+        _, job_costs = get_lists.assign_jobs(seconds, par_num, batch_size=batch_size)
+        return job_costs.max() / n_workers
+
+    # smallest number of jobs reaching the target, the makespan of the LPT schedule is close to the mean
+    # job time, so the search starts from the lower bound
+    par_low = int(min(max(np.ceil(cpu_seconds / n_workers / target_seconds), 1), num_blocks))
+    par_high = num_blocks
+    if makespan(par_low) <= target_seconds:
+        par_high = par_low
+    else:
+        while par_high - par_low > 1:
+            par_mid = (par_low + par_high) // 2
+            if makespan(par_mid) <= target_seconds:
+                par_high = par_mid
+            else:
+                par_low = par_mid
+    par_num = par_high
+    job_seconds = makespan(par_num)
+    plan = {'num_pro': int(lengths.size), 'num_pairs': int(lengths.size * (lengths.size - 1) // 2),
+            'mean_length': float(lengths.mean()), 'max_length': int(lengths.max()),
+            'cpu_hours': cpu_seconds / 3600., 'par_num': par_num, 'n_workers': n_workers,
+            'job_hours': job_seconds / 3600., 'walltime': seconds2walltime(job_seconds * safety),
+            'target_reached': bool(job_seconds <= target_seconds), 'tree_method': method, 'tree_dtype': dtype,
+            'tree_memory_gb': tree_memory(lengths.size, method=method, dtype=dtype), 'cost': cost}
+    print('Estimated us-align CPU time of all', plan['num_pairs'], 'pairs:', round(plan['cpu_hours'], 2), 'hours')
+    print('Recommended par_num =', par_num, 'with', n_workers, 'core(s) per job, walltime per job', plan['walltime'])
+    if not plan['target_reached']:
+        print('The target of', target_hours, 'hours can not be reached, the most costly rows take longer, please use '
+              'more cores per job (n_workers) or a smaller batch_size.')
+    print('Estimated memory of the tree stage (', method, ',', dtype, '):', round(plan['tree_memory_gb'], 2), 'GB')
+    if plan_path is not None:
+        plan_file = open(plan_path, 'w')
+        json.dump(plan, plan_file, indent=1)
+        plan_file.close()
+    return plan
@@ -0,0 +1,265 @@
+import os
+import numpy as np
+import pandas as pd
+import get_lists
+import structure_store
+import structure_files
+
+
+# edges of the CA-CA distance histogram used as a cheap sketch of the contact map (angstrom)
+HIST_EDGES = np.array([0, 4.5, 6, 8, 10, 12, 15, 20, 25, 30, 40, 60, np.inf])
+
+
+def get_ss_composition(xyz):
+    """Estimate the fraction of helix, strand and coil residues from the CA trace only, using the
+    distances between residue i and i+2, i+3 and i+4."""
+    if len(xyz) < 5:
+        return np.array([0., 0., 1.])
+    d2 = np.linalg.norm(xyz[2:] - xyz[:-2], axis=1)[:-2]
+    d3 = np.linalg.norm(xyz[3:] - xyz[:-3], axis=1)[:-1]
+    d4 = np.linalg.norm(xyz[4:] - xyz[:-4], axis=1)
+    helix = (np.abs(d2 - 5.45) < 0.6) & (np.abs(d3 - 5.2) < 0.8) & (np.abs(d4 - 6.2) < 0.9)
+    strand = (d2 > 6.1) & (d3 > 9.0) & (d4 > 11.5)
+    n_res = float(len(d4))
+    frac_helix = helix.sum() / n_res
+    frac_strand = strand.sum() / n_res
+    return np.array([frac_helix, frac_strand, 1 - frac_helix - frac_strand])
+
+
+def get_distance_histogram(xyz):
+    """Normalized histogram of all CA-CA distances (|i-j|>2), a cheap sketch of the contact map."""
+    if len(xyz) < 4:
+        hist = np.zeros(HIST_EDGES.size - 1)
+        hist[-1] = 1.
+        return hist
+    sq = (xyz ** 2).sum(1)
+    dis2 = sq[:, None] + sq[None, :] - 2 * xyz.dot(xyz.T)
+    ind_i, ind_j = np.triu_indices(len(xyz), k=3)
+    dis = np.sqrt(np.maximum(dis2[ind_i, ind_j], 0))
+    hist, _ = np.histogram(dis, bins=HIST_EDGES)
+    return hist / float(hist.sum())
+
+
+def get_descriptors(pdb_path, pdb_list, descriptor_path=None, store=None):
+    """Compute cheap descriptors of every structure in the list.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names.
+    descriptor_path: string
+        If provided, the descriptors are saved as a .npz file in this path (e.g. PATH/descriptors.npz).
+    store: dict
+        The structure store loaded by 'structure_store.load_store' (optional), used instead of the .pdb files.
+    Returns:
+    ----------
+    descriptors: dict
+        'name': protein IDs, 'length': number of residues, 'rg': radius of gyration,
+        'ss': fraction of helix/strand/coil, 'hist': CA-CA distance histogram."""
+    names = []
+    xyz_all = []
+    for pdb_file in pdb_list[0]:
+        xyz, _ = structure_store.read_structure(pdb_path, pdb_file, store=store)
+        names.append(pdb_file[:-4])
+        xyz_all.append(xyz)
+    descriptors = describe_structures(names, xyz_all)
+    if descriptor_path is not None:
+        save_descriptors(descriptors, descriptor_path)
+    return descriptors
+
+
+def describe_structures(names, xyz_all):
+    """Descriptors of structures given by their CA coordinates, in the same format as 'get_descriptors'."""
+    length = []
+    rg = []
+    ss = []
+    hist = []
+    for xyz in xyz_all:
+        length.append(len(xyz))
+        if len(xyz) == 0:
+            rg.append(0.)
+        else:
+            rg.append(np.sqrt(((xyz - xyz.mean(0)) ** 2).sum(1).mean()))
+        ss.append(get_ss_composition(xyz))
+        hist.append(get_distance_histogram(xyz))
+    return {'name': np.array(names), 'length': np.array(length), 'rg': np.array(rg),
+            'ss': np.array(ss).reshape(-1, 3), 'hist': np.array(hist).reshape(-1, HIST_EDGES.size - 1)}
+
+
+def join_descriptors(descriptors1, descriptors2):
+    """Descriptors of the structures of both sets, the second set after the first one, so that
+    'descriptor_similarity' can compare the structures of one set with the other."""
+    return {key: np.concatenate([descriptors1[key], descriptors2[key]]) for key in descriptors1}
+
+
+def save_descriptors(descriptors, descriptor_path):
+    """Save the descriptors as a .npz file, so they can be reused as a prefilter index."""
+    np.savez(descriptor_path, **descriptors)
+
+
+def load_descriptors(descriptor_path):
+    """Load the descriptors saved by 'save_descriptors'."""
+    npz = np.load(descriptor_path)
+    descriptors = {}
+    for key in npz.files:
+        descriptors[key] = npz[key]
+    return descriptors
+
+
+def descriptor_similarity(descriptors, ind_query, ind_targets):
+    """Similarity between one structure and a set of other structures, in the range of [0, 1].
+    It is the mean of the length ratio, radius of gyration ratio, overlap of secondary structure
+    composition and overlap of distance histograms. The length ratio is an upper bound of the TM-score
+    normalized by the longer structure."""
+    length = descriptors['length']
+    rg = descriptors['rg']
+    len_ratio = np.minimum(length[ind_query], length[ind_targets]) / \
+        np.maximum(np.maximum(length[ind_query], length[ind_targets]), 1)
+    rg_ratio = np.minimum(rg[ind_query], rg[ind_targets]) / \
+        np.maximum(np.maximum(rg[ind_query], rg[ind_targets]), 1e-6)
+    ss_sim = 1 - np.abs(descriptors['ss'][ind_targets] - descriptors['ss'][ind_query]).sum(1) / 2
+    hist_sim = np.minimum(descriptors['hist'][ind_targets], descriptors['hist'][ind_query]).sum(1)
+    return (len_ratio + rg_ratio + ss_sim + hist_sim) / 4
+
+
+def get_candidate_lists(descriptors, min_similarity=0.5):
+    """For every structure, get the structures after it in the list with a descriptor similarity
+    not smaller than 'min_similarity'. This has the same layout as the sub-lists of 'generate_sub_lists'.
+    Returns:
+    ----------
+    candidates: list
+        For every structure, the indices of the candidate structures to align with.
+    num_skipped: int
+        Number of pairs removed by the prefilter."""
+    num_pro = descriptors['length'].size
+    candidates = []
+    num_skipped = 0
+    for ind_query in range(num_pro):
+        ind_targets = np.arange(ind_query + 1, num_pro)
+        sim = descriptor_similarity(descriptors, ind_query, ind_targets)
+        keep = sim >= min_similarity
+        candidates.append(ind_targets[keep])
+        num_skipped += int((~keep).sum())
+    return candidates, num_skipped
+
+
+def run_usalign_pairs(pdb_path, usalign_path, pairs, pdb_list, out_path):
+    """Run us-align for a few pairs one by one, returns the average of TM1 and TM2 for each pair."""
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    pdb_path = structure_files.stage_structures(pdb_path, list(pdb_list[0].iloc[np.unique(np.array(pairs))]))
+    for ind_i, ind_j in pairs:
+        usalign_cmd = usalign_path + ' ' + os.path.join(pdb_path, pdb_list[0].iloc[ind_i]) + ' ' + \
+                      os.path.join(pdb_path, pdb_list[0].iloc[ind_j]) + ' -outfmt 2 >> ' + out_path
+        os.system(usalign_cmd)
+    df_sample = pd.read_csv(out_path, sep='\t', header=None, comment='#')
+    return ((df_sample[2] + df_sample[3]) / 2).values
+
+
+def estimate_recall(pdb_path, usalign_path, pdb_list, candidates, tm_cutoff=0.5, sample_size=100,
+                    sample_path=None, seed=0):
+    """Estimate the recall of the prefilter on a random sample of pairs, i.e. the fraction of pairs with
+    TM-score >= 'tm_cutoff' that are kept by the prefilter. Kept and skipped pairs are sampled
+    separately and weighted by their numbers.
+    Returns:
+    ----------
+    recall: float
+        Estimated recall, nan if no similar pair is found in the sample."""
+    rng = np.random.default_rng(seed)
+    num_pro = len(candidates)
+    num_kept_row = np.array([len(i_candidates) for i_candidates in candidates])
+    num_kept = int(num_kept_row.sum())
+    num_skipped = num_pro * (num_pro - 1) // 2 - num_kept
+    # sample kept pairs directly from the candidate lists
+    kept = []
+    if num_kept > 0:
+        for ind_i in rng.choice(num_pro, size=min(sample_size, num_kept), p=num_kept_row / num_kept):
+            kept.append((ind_i, rng.choice(candidates[ind_i])))
+    # sample skipped pairs by drawing random pairs and rejecting the kept ones
+    skipped = []
+    count_draw = 0
+    while len(skipped) < min(sample_size, num_skipped) and count_draw < 100 * sample_size:
+        count_draw += 1
+        ind_i, ind_j = np.sort(rng.choice(num_pro, size=2, replace=False))
+        if ind_j not in candidates[ind_i]:
+            skipped.append((ind_i, ind_j))
+    if sample_path is None:
+        sample_path = os.path.join(os.path.dirname(pdb_path), 'prefilter_sample.txt')
+    # number of similar pairs estimated from the sample of kept and skipped pairs
+    positives = []
+    for pairs, num_pairs in [(kept, num_kept), (skipped, num_skipped)]:
+        if len(pairs) == 0:
+            positives.append(0.)
+            continue
+        tm_sample = run_usalign_pairs(pdb_path, usalign_path, pairs, pdb_list, sample_path)
+        positives.append((tm_sample >= tm_cutoff).mean() * num_pairs)
+    if sum(positives) == 0:
+        return np.nan
+    return positives[0] / sum(positives)
+
+
+def prefilter_sub_lists(pdb_path, sublist_path, pdb_list, min_similarity=0.5, descriptor_path=None,
+                        usalign_path=None, tm_cutoff=0.5, sample_size=100, store_path=None, par_num=None,
+                        batch_size=1):
+    """Prefilter the sub-lists generated by 'get_lists' (parallel=1), so that only the candidate pairs
+    with a descriptor similarity above 'min_similarity' are sent to us-align.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    sublist_path: string
+        Folder path of the sub-lists, the output of 'get_lists' with parallel=1.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names.
+    min_similarity: float
+        Pairs with a descriptor similarity lower than this value are skipped.
+    descriptor_path: string
+        If provided, the descriptors are saved in this path, so they can be reused.
+    usalign_path: string
+        If provided, the recall of the prefilter is estimated on a sample of pairs using us-align.
+    tm_cutoff: float
+        TM-score used to define a similar pair when estimating the recall.
+    sample_size: int
+        Number of kept and of skipped pairs to align when estimating the recall.
+    store_path: string
+        Folder of the structure store (optional), used instead of the .pdb files.
+    par_num: int
+        If provided, the rows are distributed again to this number of jobs according to the cost of the
+        remaining pairs, see 'get_lists.schedule_sub_lists'.
+    batch_size: int
+        If rescheduled, blocks of this number of rows are kept together for batched us-align calls.
+    Returns:
+    ----------
+    report: dict
+        Number of all pairs, kept pairs, skipped pairs and the estimated recall."""
+    if descriptor_path is None:
+        descriptor_path = os.path.join(os.path.dirname(pdb_path), 'descriptors.npz')
+    store = None
+    if store_path is not None:
+        store = structure_store.load_store(store_path)
+    descriptors = get_descriptors(pdb_path, pdb_list, descriptor_path=descriptor_path, store=store)
+    candidates, num_skipped = get_candidate_lists(descriptors, min_similarity=min_similarity)
+    # overwrite the sub-lists of each protein with its candidates only
+    for ind_query, pdb_file in enumerate(pdb_list[0]):
+        txt_name = 'list_' + pdb_file[:-4] + '.txt'
+        txt_path = os.path.join(sublist_path, txt_name)
+        pd.DataFrame(pdb_list[0].values[candidates[ind_query]]).to_csv(txt_path, header=None, index=None)
+    if par_num is not None:
+        length = descriptors['length']
+        row_costs = np.array([length[ind_query] * length[candidates[ind_query]].sum()
+                              for ind_query in range(length.size)])
+        get_lists.schedule_sub_lists(sublist_path, pdb_list, row_costs, par_num, batch_size=batch_size)
+    num_pro = pdb_list[0].size
+    num_all = num_pro * (num_pro - 1) // 2
+    recall = np.nan
+    if usalign_path is not None:
+        recall = estimate_recall(pdb_path, usalign_path, pdb_list, candidates, tm_cutoff=tm_cutoff,
+                                 sample_size=sample_size)
+    report = {'pairs_all': num_all, 'pairs_kept': num_all - num_skipped, 'pairs_skipped': num_skipped,
+              'min_similarity': min_similarity, 'tm_cutoff': tm_cutoff, 'recall': recall}
+    report_path = os.path.join(sublist_path, 'prefilter_report.txt')
+    pd.DataFrame([report]).to_csv(report_path, index=None, sep='\t')
+    print('Prefilter skipped', num_skipped, 'of', num_all, 'pairs, estimated recall:', recall)
+    print('The report of the prefilter is saved in: ', report_path)
+    return report
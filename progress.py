@@ -0,0 +1,71 @@
+import os
+import json
+import time
+
+
+# options of the progress reports, by default only printed every minute
+OPTIONS = {'progress_path': None, 'interval': 60, 'verbose': 1}
+
+
+def configure(progress_path=None, interval=60, verbose=1):
+    """Set where and how often the progress is reported.
+    Parameters:
+    ----------
+    progress_path: string
+        If provided, the latest progress is saved as a JSON file in this path, which can be polled by a
+        scheduler. The file is replaced atomically, so it is never read half-written.
+    interval: float
+        Smallest number of seconds between two reports.
+    verbose: bool
+        If the progress is printed as well."""
+    OPTIONS.update({'progress_path': progress_path, 'interval': interval, 'verbose': verbose})
+
+
+def merge_cost(len_matrix):
+    """Cost of all merges of the tree loop starting from a matrix with the size of len_matrix*len_matrix,
+    every merge scans and rebuilds the matrix, so the cost is the sum of m*m for m = 1 ... len_matrix."""
+    return len_matrix * (len_matrix + 1) * (2 * len_matrix + 1) / 6.
+
+
+class Progress:
+    """Progress of a stage with a known total cost, the ETA assumes the remaining cost is done at the same
+    rate as the cost done so far. 'update' only looks at the clock unless a report is due, so it can be
+    called in every step of a loop. If the stage continues earlier work (e.g. from a checkpoint), the cost
+    already done is given as 'done_start', it counts for the fraction but not for the rate."""
+    def __init__(self, stage, total, unit='pairs', done_start=0.):
+        self.stage = stage
+        self.total = float(total)
+        self.unit = unit
+        self.time_start = time.time()
+        self.time_report = self.time_start
+        self.done_start = float(done_start)
+        self.done = self.done_start
+
+    def update(self, done, force=0):
+        self.done = float(done)
+        now = time.time()
+        if force or now - self.time_report >= OPTIONS['interval']:
+            self.time_report = now
+            self.report(now)
+
+    def finish(self):
+        self.update(self.total, force=1)
+
+    def report(self, now):
+        elapsed = now - self.time_start
+        fraction = self.done / self.total if self.total > 0 else 1.
+        rate = (self.done - self.done_start) / elapsed if elapsed > 0 else 0.
+        eta = (self.total - self.done) / rate if rate > 0 else None
+        record = {'stage': self.stage, 'unit': self.unit, 'done': self.done, 'total': self.total,
+                  'fraction': fraction, 'elapsed_s': elapsed, 'eta_s': eta, 'rate': rate, 'pid': os.getpid(),
+                  'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))}
+        if OPTIONS['verbose']:
+            print('Progress of', self.stage, ':', round(100 * fraction, 1), '%, elapsed',
+                  round(elapsed), 's, ETA', 'unknown' if eta is None else str(round(eta)) + ' s')
+        if OPTIONS['progress_path'] is not None:
+            tmp_path = OPTIONS['progress_path'] + '.' + str(os.getpid()) + '.tmp'
+            tmp_file = open(tmp_path, 'w')
+            json.dump(record, tmp_file)
+            tmp_file.close()
+            os.replace(tmp_path, OPTIONS['progress_path'])
+        return record
@@ -0,0 +1,178 @@
+import os
+import shutil
+import asyncio
+import numpy as np
+import pandas as pd
+import prefilter
+import structure_store
+import structure_files
+import usalign_runner
+from clustering.sparse_clusters import get_tm
+
+
+def load_index(pdb_path, descriptor_path=None, store_path=None):
+    """Descriptors of all structures of an existing collection, used as the index of the queries. They are
+    loaded from 'descriptor_path' if it exists (e.g. saved by the prefilter of step 1), otherwise computed
+    once and saved there.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all structure files of the collection.
+    descriptor_path: string
+        Path of the .npz file of the descriptors, 'descriptors.npz' in the same path as the pdb folder if
+        not provided, the same as in 'prefilter.prefilter_sub_lists'.
+    store_path: string
+        Folder of the structure store, used instead of the structure files when the descriptors are computed.
+        The 'structure_store' folder in the same path as the pdb folder is used if it exists.
+    Returns:
+    ----------
+    descriptors: dict
+        See 'prefilter.get_descriptors'."""
+    if descriptor_path is None:
+        descriptor_path = os.path.join(os.path.dirname(pdb_path), 'descriptors.npz')
+    if os.path.exists(descriptor_path):
+        return prefilter.load_descriptors(descriptor_path)
+    if store_path is None:
+        store_path = os.path.join(os.path.dirname(pdb_path), 'structure_store')
+    store = None
+    if os.path.exists(os.path.join(store_path, 'structures_index.txt')):
+        store = structure_store.load_store(store_path)
+    pdb_list = pd.DataFrame(structure_files.list_structures(pdb_path))
+    descriptors = prefilter.get_descriptors(pdb_path, pdb_list, descriptor_path=descriptor_path, store=store)
+    print('The descriptors of', pdb_list[0].size, 'structures are saved in: ', descriptor_path)
+    return descriptors
+
+
+def query_id(query_path):
+    """Protein ID of a query structure, the file name without the suffix of the structure file."""
+    file = os.path.basename(query_path)
+    pro_id = structure_files.get_pro_id(file)
+    return pro_id if pro_id is not None else file
+
+
+def get_shortlists(descriptors_query, descriptors_index, shortlist_size=100, min_similarity=0.):
+    """For every query, the structures of the index with the highest descriptor similarity.
+    Returns:
+    ----------
+    shortlists: list
+        For every query, the indices of the index structures, in the order of decreasing similarity.
+    similarities: list
+        The descriptor similarities of the shortlists."""
+    num_query = descriptors_query['length'].size
+    num_index = descriptors_index['length'].size
+    descriptors = prefilter.join_descriptors(descriptors_query, descriptors_index)
+    ind_targets = np.arange(num_query, num_query + num_index)
+    shortlists = []
+    similarities = []
+    for ind_query in range(num_query):
+        sim = prefilter.descriptor_similarity(descriptors, ind_query, ind_targets)
+        order = np.argsort(-sim, kind='stable')[:shortlist_size]
+        order = order[sim[order] >= min_similarity]
+        shortlists.append(order)
+        similarities.append(sim[order])
+    return shortlists, similarities
+
+
+async def align_shortlists(runner, query_files, target_lists, chunk_size):
+    """Align every query against its shortlist, split into calls of at most 'chunk_size' targets, so the
+    calls of one query run on all workers at the same time."""
+    tasks = []
+    for ind_query, (query_file, targets) in enumerate(zip(query_files, target_lists)):
+        for ind_chunk, ind_start in enumerate(range(0, len(targets), chunk_size)):
+            tasks.append(runner.align_row(query_file, targets[ind_start:ind_start + chunk_size],
+                                          'query' + str(ind_query) + '_' + str(ind_chunk), runner.retries))
+    out_paths = await asyncio.gather(*tasks)
+    return [out_path for chunk_paths in out_paths for out_path in chunk_paths]
+
+
+def query_structures(query_paths, pdb_path, usalign_path, top_k=10, shortlist_size=100, min_similarity=0.,
+                     n_workers=4, tm_score='average', descriptor_path=None, store_path=None, hits_path=None,
+                     timeout=60, retries=2):
+    """Find the most similar structures of an existing collection for a few new structures, without the
+    all-vs-all alignment: the structures of the collection are ranked by the cheap descriptors of the
+    prefilter, and us-align only runs on the shortlist of every query, with 'n_workers' processes at the
+    same time.
+    Parameters:
+    ----------
+    query_paths: list
+        Paths of the query structure files (.pdb, .pdb.gz, .cif or .cif.gz).
+    pdb_path: string
+        Path of the folder containing all structure files of the collection.
+    usalign_path: string
+        Path of the US-align tool (e.g. PATH/USalign).
+    top_k: int
+        Number of hits kept for every query.
+    shortlist_size: int
+        Number of structures of the collection aligned with every query. The hits are exact for the
+        structures in the shortlist, a larger shortlist misses fewer hits with unusual descriptors.
+    min_similarity: float
+        Structures with a descriptor similarity lower than this value are never aligned.
+    n_workers: int
+        Number of us-align processes running at the same time.
+    tm_score: string
+        TM-score used to rank the hits, the same options as in 'align2mat' ('TM1' is normalized by the query).
+    descriptor_path, store_path: string
+        Descriptors and structure store of the collection, see 'load_index'.
+    hits_path: string
+        Path of the hits, 'query_hits.txt' in the same path as the pdb folder if not provided.
+    timeout, retries:
+        Same as in 'usalign_runner.AlignRunner'.
+    Returns:
+    ----------
+    df_hits: pandas dataframe
+        For every query the top_k hits with their rank, TM-scores and descriptor similarity."""
+    descriptors_index = load_index(pdb_path, descriptor_path=descriptor_path, store_path=store_path)
+    query_ids = [query_id(query_path) for query_path in query_paths]
+    xyz_query = [structure_store.read_ca_trace(query_path)[0] for query_path in query_paths]
+    descriptors_query = prefilter.describe_structures(query_ids, xyz_query)
+    shortlists, similarities = get_shortlists(descriptors_query, descriptors_index, shortlist_size=shortlist_size,
+                                              min_similarity=min_similarity)
+    index_files = pd.Series(descriptors_index['name']) + '.pdb'
+    target_lists = [list(index_files.values[shortlist]) for shortlist in shortlists]
+    if hits_path is None:
+        hits_path = os.path.join(os.path.dirname(pdb_path), 'query_hits.txt')
+    tmp_folder_path = hits_path[:-4] + '_tmp'
+    if not os.path.exists(tmp_folder_path):
+        os.makedirs(tmp_folder_path)
+    # us-align needs plain .pdb files, the compressed or mmCIF queries are converted in the temporary folder
+    query_files = []
+    for query_path, pro_id in zip(query_paths, query_ids):
+        if query_path.endswith('.pdb'):
+            query_files.append(os.path.abspath(query_path))
+        else:
+            query_files.append(os.path.join(os.path.abspath(tmp_folder_path), pro_id + '.pdb'))
+            structure_files.write_pdb(query_path, query_files[-1])
+    usalign_pdb_path = structure_files.stage_structures(pdb_path, list(pd.unique(pd.Series(
+        [target for targets in target_lists for target in targets], dtype=str))))
+    # every shortlist is split into 'n_workers' calls, so a single query uses all workers
+    chunk_size = max(int(np.ceil(max([len(targets) for targets in target_lists] + [1]) / float(n_workers))), 1)
+    runner = usalign_runner.AlignRunner(usalign_pdb_path, usalign_path, tmp_folder_path, n_workers=n_workers,
+                                        timeout=timeout, retries=retries)
+    # the semaphore of the runner is created in the event loop of 'asyncio.run', see 'AlignRunner.get_semaphore'
+    out_paths = asyncio.run(align_shortlists(runner, query_files, target_lists, chunk_size))
+    df_align = pd.concat([pd.read_csv(out_path, sep='\t', dtype={'#PDBchain1': str, 'PDBchain2': str})
+                          for out_path in out_paths] +
+                         [pd.DataFrame(columns=usalign_runner.RAW_HEADER[:-1].split('\t'))], ignore_index=True)
+    shutil.rmtree(tmp_folder_path)
+    df_align = df_align.rename(columns={'#PDBchain1': 'PDBchain1'})
+    # the query is given with its path, the targets relative to the folder
+    df_align['PDBchain1'] = df_align['PDBchain1'].str[:-2].map(
+        dict(zip(query_files, query_ids))).fillna(df_align['PDBchain1'])
+    df_align['PDBchain2'] = df_align['PDBchain2'].str.replace('/', '').str[:-6]
+    df_align['TM'] = get_tm(df_align, tm_score=tm_score)
+    similarity = {}
+    for pro_id, targets, sim in zip(query_ids, target_lists, similarities):
+        for target, target_sim in zip(targets, sim):
+            similarity[(pro_id, target[:-4])] = target_sim
+    df_align['descriptor_similarity'] = [similarity.get(pair, np.nan) for pair in
+                                         zip(df_align['PDBchain1'], df_align['PDBchain2'])]
+    df_hits = df_align.sort_values(['PDBchain1', 'TM'], ascending=[True, False], kind='stable')
+    df_hits = df_hits.groupby('PDBchain1', sort=False).head(top_k).copy()
+    df_hits.insert(2, 'rank', df_hits.groupby('PDBchain1').cumcount() + 1)
+    df_hits.to_csv(hits_path, index=None, sep='\t')
+    for pro_id, targets in zip(query_ids, target_lists):
+        print('Query', pro_id, ':', len(targets), 'structures aligned of', index_files.size)
+    if len(runner.quarantine) > 0:
+        print(len(runner.quarantine), 'pairs failed and are not in the hits.')
+    print('The top', top_k, 'hits of', len(query_ids), 'queries are saved in: ', hits_path)
+    return df_hits
@@ -11,7 +11,12 @@ setuptools.setup(
     url="https://github.com/BGI-Qingdao/stacpro",
     #long_description=Path('README.md').read_text('utf-8'),
     python_requires=">=3.7,<3.11",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_namespace_packages(include=['clustering']),
+    py_modules=[os.path.splitext(os.path.basename(path))[0] for path in glob.glob('*.py')
+                if os.path.basename(path) != 'setup.py' and not os.path.basename(path).startswith('main_')],
+    entry_points={
+        'console_scripts': ['stacpro = stacpro_cli:main'],
+    },
     install_requires=[
         "pandas",
         "matplotlib",
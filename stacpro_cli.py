@@ -0,0 +1,373 @@
+"""Command line interface of stacpro, installed as the 'stacpro' command:
+    stacpro plan -c stacpro.ini              estimated cost, number of jobs and walltime before step 1
+    stacpro list -c stacpro.ini              sub-lists of the parallel alignment (step 1)
+    stacpro align -c stacpro.ini --index 3   one job of the parallel alignment, e.g. one array task (step 2)
+    stacpro align -c stacpro.ini --worker    one worker of the work queue instead of a fixed job
+    stacpro concat -c stacpro.ini            concatenation and check of all alignments (step 3)
+    stacpro tree -c stacpro.ini              .nwk file of the tree (step 4)
+    stacpro cluster -c stacpro.ini           clusters from the tree or from the sparse similarity graph
+    stacpro score -c stacpro.ini             scores of the cuts of the tree, to choose the number of clusters
+    stacpro query -c stacpro.ini new.pdb     most similar structures of the collection, without all-vs-all
+All parameters are read from the config file (see 'stacpro_config.ini'), and can be changed on the command
+line with '--set section.key=value'. The modules of a subcommand are only imported when it runs, so the
+alignment jobs do not load matplotlib."""
+import os
+import sys
+import json
+import argparse
+import configparser
+
+# all parameters of the config file with their defaults, values are converted to the type of the default,
+# empty paths are replaced by the default paths of the project folder, see 'get_paths'
+DEFAULTS = {
+    'paths': {'pdb_folder_path': '', 'usalign_path': 'USalign', 'sublist_path': '', 'pdb_list_path': '',
+              'align_folder_path': '', 'align_all_path': '', 'duplicates_path': '', 'checkpoint_path': '',
+              'cache_path': '', 'descriptor_path': '', 'store_path': ''},
+    'list': {'par_num': 30, 'schedule': 1, 'batch_size': 1, 'ingest': 0, 'dedup': 0, 'min_similarity': -1.,
+             'num_tiles': 0},
+    'align': {'runner': 'os', 'n_workers': 4, 'timeout': 60, 'retries': 2, 'lease_time': 3600, 'report': 1,
+              'cache_gb': 50., 'stage_plain': 0},
+    'tree': {'method': 'nj', 'tm_score': 'average', 'plot': '0', 'clust_num': 3, 'checkpoint_interval': 3600,
+             'resume': 0, 'save_matrix': 1, 'n_threads': 0, 'nj_search': 'full', 'report': 1},
+    'cluster': {'mode': 'upward', 'node_number': 3, 'cluster_num': 10, 'tm_cutoff': 0.5,
+                'sparse_method': 'components', 'max_clusters': 50, 'sample_size': 2000},
+    'query': {'top_k': 10, 'shortlist_size': 100, 'min_similarity': 0., 'tm_score': 'average', 'hits_path': ''},
+    'plan': {'target_hours': 24., 'safety': 1.5, 'dtype': 'float64', 'calibration_path': ''},
+}
+# environment variables with the index of an array task, used by 'align' if '--index' is not given
+INDEX_VARIABLES = ['SLURM_ARRAY_TASK_ID', 'PBS_ARRAY_INDEX']
+
+
+def convert(section, key, value):
+    """Convert a value of the config file to the type of its default."""
+    if key not in DEFAULTS[section]:
+        sys.exit('Unknown parameter "' + key + '" in section [' + section + '] of the config file.')
+    default = DEFAULTS[section][key]
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value.strip()
+
+
+def read_config(config_path=None, settings=None):
+    """Read the config file and the '--set section.key=value' settings on top of the defaults.
+    Returns:
+    ----------
+    config: dict
+        All parameters, with the sections of 'DEFAULTS' as keys."""
+    config = {section: dict(values) for section, values in DEFAULTS.items()}
+    if config_path is not None:
+        parser = configparser.ConfigParser()
+        if len(parser.read(config_path)) == 0:
+            sys.exit('The config file is not found: ' + config_path)
+        for section in parser.sections():
+            if section not in config:
+                sys.exit('Unknown section [' + section + '] in the config file.')
+            for key, value in parser.items(section):
+                config[section][key] = convert(section, key, value)
+    for setting in settings if settings is not None else []:
+        name, _, value = setting.partition('=')
+        section, _, key = name.partition('.')
+        if section not in config:
+            sys.exit('Unknown section in --set ' + setting + ', use section.key=value.')
+        config[section][key] = convert(section, key, value)
+    return config
+
+
+def get_paths(config):
+    """All paths of the project, with the same defaults as the functions of stacpro: the sub-lists, the list
+    and the alignments are in the folder containing the .pdb folder."""
+    paths = dict(config['paths'])
+    if paths['pdb_folder_path'] == '':
+        sys.exit('Please provide "pdb_folder_path" in the [paths] section of the config file.')
+    prj_path = os.path.dirname(os.path.abspath(paths['pdb_folder_path']))
+    defaults = {'sublist_path': os.path.join(prj_path, 'sublists'),
+                'pdb_list_path': os.path.join(prj_path, 'pdb_list.txt'),
+                'align_folder_path': os.path.join(prj_path, 'alignments'),
+                'checkpoint_path': os.path.join(prj_path, 'checkpoint')}
+    for key, value in defaults.items():
+        if paths[key] == '':
+            paths[key] = value
+    if paths['align_all_path'] == '':
+        paths['align_all_path'] = os.path.join(paths['align_folder_path'], 'alignment_all.txt')
+    if paths['usalign_path'] == '':
+        paths['usalign_path'] = DEFAULTS['paths']['usalign_path']
+    # the duplicates are saved next to the list by 'stacpro list', so the tree and the clusters get them back
+    if paths['duplicates_path'] == '' and config['list']['dedup']:
+        paths['duplicates_path'] = os.path.join(os.path.dirname(paths['pdb_list_path']), 'duplicates.txt')
+    for key in ['duplicates_path', 'descriptor_path', 'store_path']:
+        if paths[key] == '':
+            paths[key] = None
+    return paths
+
+
+def read_pdb_list(pdb_list_path):
+    import pandas as pd
+    return pd.read_csv(pdb_list_path, sep='\t', header=None)
+
+
+def run_plan(config, args):
+    """Estimate the cost of the alignment, the number of jobs and their walltime, and the memory of the tree."""
+    import planner
+    paths = get_paths(config)
+    options = config['plan']
+    calibration_path = options['calibration_path'] if options['calibration_path'] != '' else None
+    if args.calibrate > 0:
+        if calibration_path is None:
+            calibration_path = os.path.join(os.path.dirname(paths['pdb_list_path']), 'calibration.json')
+        planner.calibrate_cost(paths['pdb_folder_path'], paths['usalign_path'], num_pairs=args.calibrate,
+                               calibration_path=calibration_path)
+    # the 'os' runner computes one pair at a time
+    n_workers = config['align']['n_workers'] if config['align']['runner'] == 'async' else 1
+    planner.plan_run(paths['pdb_folder_path'], target_hours=options['target_hours'], n_workers=n_workers,
+                     batch_size=config['list']['batch_size'], safety=options['safety'],
+                     method=config['tree']['method'], dtype=options['dtype'], calibration_path=calibration_path,
+                     plan_path=os.path.join(os.path.dirname(paths['pdb_list_path']), 'plan.json'))
+
+
+def run_list(config, args):
+    """Generate the sub-lists of the parallel alignment (step 1)."""
+    import get_lists
+    paths = get_paths(config)
+    options = config['list']
+    store_path = None
+    if options['ingest']:
+        import structure_store
+        pdb_list_all, _ = get_lists.get_pdblist_all(paths['pdb_folder_path'], pdb_list_path=paths['pdb_list_path'])
+        store_path = structure_store.ingest_structures(paths['pdb_folder_path'], pdb_list_all)
+    pdb_list, sublist_path = get_lists.get_lists(paths['pdb_folder_path'], pdb_list_path=paths['pdb_list_path'],
+                                                 list_folder_path=paths['sublist_path'], parallel=1,
+                                                 par_num=options['par_num'], dedup=options['dedup'],
+                                                 store_path=store_path, schedule=options['schedule'],
+                                                 batch_size=options['batch_size'])
+    if options['min_similarity'] >= 0:
+        import prefilter
+        usalign_path = paths['usalign_path'] if args.recall else None
+        prefilter.prefilter_sub_lists(paths['pdb_folder_path'], sublist_path, pdb_list,
+                                      min_similarity=options['min_similarity'],
+                                      descriptor_path=paths['descriptor_path'], usalign_path=usalign_path,
+                                      store_path=store_path,
+                                      par_num=options['par_num'] if options['schedule'] else None,
+                                      batch_size=options['batch_size'])
+    if options['num_tiles'] > 0:
+        import work_queue
+        work_queue.init_queue(sublist_path, pdb_list, num_tiles=options['num_tiles'])
+    print('Please submit', options['par_num'], 'jobs of "stacpro align --index <0 ~', options['par_num'] - 1,
+          '>", or any number of "stacpro align --worker" jobs if num_tiles is set.')
+
+
+def get_index(args):
+    """Index of the parallel job, from '--index' or from the array task of the scheduler."""
+    if args.index is not None:
+        return args.index
+    for variable in INDEX_VARIABLES:
+        if os.environ.get(variable, '') != '':
+            return int(os.environ[variable])
+    sys.exit('Please provide the index of the job with --index, or run it as an array task.')
+
+
+def run_align(config, args):
+    """Compute one job of the parallel alignment, or tiles of the work queue (step 2)."""
+    import instrumentation
+    import progress
+    paths = get_paths(config)
+    options = config['align']
+    batch_size = config['list']['batch_size']
+    pdb_list = read_pdb_list(paths['pdb_list_path'])
+    if args.worker:
+        import work_queue
+        queue_path = os.path.join(paths['sublist_path'], 'queue')
+        work_queue.run_worker(paths['pdb_folder_path'], paths['usalign_path'], queue_path, pdb_list,
+                              paths['sublist_path'], paths['align_folder_path'], lease_time=options['lease_time'],
+                              batch_size=batch_size, runner=options['runner'], n_workers=options['n_workers'],
+                              timeout=options['timeout'], retries=options['retries'])
+        work_queue.queue_status(queue_path)
+        return
+    import get_alignments
+    par_index = get_index(args)
+    progress.configure(progress_path=os.path.join(paths['sublist_path'], 'progress_' + str(par_index) + '.json'),
+                       interval=60)
+    get_alignments.compute_similarity(paths['pdb_folder_path'], paths['usalign_path'], parallel=1,
+                                      par_index=par_index, par_num=config['list']['par_num'], pdb_list=pdb_list,
+                                      sublist_path=paths['sublist_path'], align_folder_path=paths['align_folder_path'],
+                                      batch_size=batch_size, runner=options['runner'], n_workers=options['n_workers'],
+                                      timeout=options['timeout'], retries=options['retries'])
+    if options['report']:
+        instrumentation.write_report(os.path.join(paths['align_folder_path'],
+                                                  'run_report_' + str(par_index) + '.json'))
+
+
+def run_concat(config, args):
+    """Concatenate and check all alignments (step 3)."""
+    import get_alignments
+    import verify_pairs
+    paths = get_paths(config)
+    pdb_list = read_pdb_list(paths['pdb_list_path'])
+    align_all_path = get_alignments.cat_align(pdb_list, align_folder_path=paths['align_folder_path'],
+                                              align_file=os.path.basename(paths['align_all_path']),
+                                              batch=config['list']['batch_size'] > 1)
+    # only the pairs of the sub-lists are expected if the prefilter was used
+    sublist_path = paths['sublist_path'] if config['list']['min_similarity'] >= 0 else None
+    rerun_path = os.path.join(os.path.dirname(paths['pdb_list_path']), 'rerun')
+    report = verify_pairs.verify_pairs(align_all_path, pdb_list, sublist_path=sublist_path, rerun_path=rerun_path)
+    if len(report['missing']) > 0:
+        # the rerun has its own alignment folder, otherwise it would overwrite the alignment files of the full rows
+        rerun_align_path = os.path.join(rerun_path, 'alignments')
+        print('Please compute the missing pairs with "stacpro align --index 0 --set paths.sublist_path=' + rerun_path
+              + ' --set paths.align_folder_path=' + rerun_align_path + '", then add them with '
+              'verify_pairs.repair_alignment(' + align_all_path + ', ' + rerun_align_path + ', pdb_list).')
+    print('All alignments are saved in: ', align_all_path)
+
+
+def labels_path(path_tree_folder, method):
+    return os.path.join(path_tree_folder, 'labels_' + method + '.json')
+
+
+def tree_path(path_tree_folder, method):
+    return os.path.join(path_tree_folder, 'tree_' + method + '.nwk')
+
+
+def matrix_path(path_tree_folder, method):
+    return os.path.join(path_tree_folder, 'distance_matrix_' + method + '.npy')
+
+
+def run_tree(config, args):
+    """Build the tree and save it as a .nwk file (step 4)."""
+    import instrumentation
+    import progress
+    import clustering.get_clusters
+    paths = get_paths(config)
+    options = config['tree']
+    instrumentation.enable(merges=1, profile=0)
+    progress.configure(progress_path=os.path.join(os.path.dirname(paths['pdb_list_path']), 'progress.json'),
+                       interval=60)
+    plot = options['plot']
+    if plot in ['0', '1']:
+        plot = int(plot)
+    # the default folder of 'get_tree_file', the distance matrix is saved there for 'stacpro cluster'
+    path_tree_folder = os.path.join(os.path.dirname(paths['align_all_path']), 'trees')
+    save_matrix_path = matrix_path(path_tree_folder, options['method']) if options['save_matrix'] else None
+    # the pairs skipped by the prefilter are missing in the alignments, the proteins are taken from the pdb list
+    pdb_list = read_pdb_list(paths['pdb_list_path']) if config['list']['min_similarity'] >= 0 else None
+    labels, path_tree_folder = clustering.get_clusters.get_tree_file(
+        paths['align_all_path'], method=options['method'], tm_score=options['tm_score'], plot=plot,
+        clust_num=options['clust_num'], pdb_list=pdb_list, duplicates_path=paths['duplicates_path'],
+        checkpoint_path=paths['checkpoint_path'], checkpoint_interval=options['checkpoint_interval'],
+        resume=options['resume'], matrix_path=save_matrix_path, n_threads=options['n_threads'],
+        nj_search=options['nj_search'])
+    # the labels of the tree are needed by 'stacpro cluster'
+    labels_file = open(labels_path(path_tree_folder, options['method']), 'w')
+    json.dump(labels, labels_file)
+    labels_file.close()
+    if options['report']:
+        instrumentation.write_report(os.path.join(path_tree_folder, 'run_report.json'))
+
+
+def run_cluster(config, args):
+    """Cluster the proteins from the tree or from the sparse similarity graph."""
+    import clustering.get_clusters
+    paths = get_paths(config)
+    options = config['cluster']
+    if options['mode'] == 'sparse':
+        clustering.get_clusters.clustering_sparse(paths['align_all_path'], tm_cutoff=options['tm_cutoff'],
+                                                  method=options['sparse_method'],
+                                                  tm_score=config['tree']['tm_score'],
+                                                  duplicates_path=paths['duplicates_path'])
+        return
+    path_tree_folder = os.path.join(os.path.dirname(paths['align_all_path']), 'trees')
+    if options['mode'] == 'cut':
+        path_matrix = matrix_path(path_tree_folder, config['tree']['method'])
+        clustering.get_clusters.clustering_cut(tree_path(path_tree_folder, config['tree']['method']),
+                                               options['cluster_num'],
+                                               matrix_path=path_matrix if os.path.exists(path_matrix) else None)
+        return
+    path_labels = labels_path(path_tree_folder, config['tree']['method'])
+    if not os.path.exists(path_labels):
+        sys.exit('The labels of the tree are not found in: ' + path_labels + ', please run "stacpro tree" first.')
+    labels_file = open(path_labels, 'r')
+    labels = json.load(labels_file)
+    labels_file.close()
+    # statistics of the clusters if the distance matrix was saved by 'stacpro tree'
+    path_matrix = matrix_path(path_tree_folder, config['tree']['method'])
+    if not os.path.exists(path_matrix):
+        path_matrix = None
+    if options['mode'] == 'upward':
+        clustering.get_clusters.clustering_upward(labels, options['node_number'], path_tree_folder,
+                                                  duplicates_path=paths['duplicates_path'], matrix_path=path_matrix)
+    elif options['mode'] == 'downward':
+        clustering.get_clusters.clustering_downward(labels, options['node_number'], path_tree_folder,
+                                                    duplicates_path=paths['duplicates_path'],
+                                                    matrix_path=path_matrix)
+    else:
+        sys.exit('Unknown clustering mode "' + options['mode'] + '", use upward, downward, cut or sparse.')
+
+
+def run_score(config, args):
+    """Score the cuts of the tree against the distance matrix, to choose cluster.cluster_num for mode = cut."""
+    import clustering.get_clusters
+    paths = get_paths(config)
+    options = config['cluster']
+    path_tree_folder = os.path.join(os.path.dirname(paths['align_all_path']), 'trees')
+    path_matrix = matrix_path(path_tree_folder, config['tree']['method'])
+    if not os.path.exists(path_matrix):
+        sys.exit('The distance matrix is not found in: ' + path_matrix + ', please run "stacpro tree" with '
+                 'tree.save_matrix = 1 first.')
+    clustering.get_clusters.score_tree_cuts(tree_path(path_tree_folder, config['tree']['method']), path_matrix,
+                                            max_clusters=options['max_clusters'],
+                                            sample_size=options['sample_size'] if options['sample_size'] > 0 else None)
+
+
+def run_query(config, args):
+    """Find the most similar structures of the collection for new structures."""
+    import query
+    paths = get_paths(config)
+    options = config['query']
+    top_k = args.top_k if args.top_k is not None else options['top_k']
+    query.query_structures(args.structures, paths['pdb_folder_path'], paths['usalign_path'], top_k=top_k,
+                           shortlist_size=options['shortlist_size'], min_similarity=options['min_similarity'],
+                           n_workers=config['align']['n_workers'], tm_score=options['tm_score'],
+                           descriptor_path=paths['descriptor_path'], store_path=paths['store_path'],
+                           hits_path=options['hits_path'] if options['hits_path'] != '' else None,
+                           timeout=config['align']['timeout'], retries=config['align']['retries'])
+
+
+COMMANDS = {'plan': run_plan, 'list': run_list, 'align': run_align, 'concat': run_concat, 'tree': run_tree,
+            'cluster': run_cluster, 'score': run_score, 'query': run_query}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='stacpro', description='Structure based alignment and clustering of '
+                                                                 'proteins.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in COMMANDS:
+        subparser = subparsers.add_parser(command, help=COMMANDS[command].__doc__)
+        subparser.add_argument('-c', '--config', help='config file, see stacpro_config.ini')
+        subparser.add_argument('--set', action='append', metavar='SECTION.KEY=VALUE',
+                               help='change a parameter of the config file, can be repeated')
+        if command == 'plan':
+            subparser.add_argument('--calibrate', type=int, default=0, metavar='NUM_PAIRS',
+                                   help='first fit the cost model by aligning this number of pairs')
+        if command == 'list':
+            subparser.add_argument('--recall', action='store_true',
+                                   help='estimate the recall of the prefilter with us-align')
+        if command == 'align':
+            subparser.add_argument('--index', type=int, help='index of the job, 0 ~ par_num-1 (default: '
+                                                             'from ' + ' or '.join(INDEX_VARIABLES) + ')')
+            subparser.add_argument('--worker', action='store_true', help='compute tiles of the work queue')
+        if command == 'query':
+            subparser.add_argument('structures', nargs='+', help='query structure files (.pdb, .pdb.gz, .cif, '
+                                                                 '.cif.gz)')
+            subparser.add_argument('--top-k', type=int, help='number of hits of every query (default: query.top_k)')
+    args = parser.parse_args(argv)
+    config = read_config(args.config, args.set)
+    # node-local cache of the compressed and mmCIF structures
+    import structure_files
+    cache_path = config['paths']['cache_path'] if config['paths']['cache_path'] != '' else None
+    structure_files.configure(cache_path=cache_path, max_gb=config['align']['cache_gb'],
+                              stage_plain=config['align']['stage_plain'])
+    COMMANDS[args.command](config, args)
+
+
+if __name__ == '__main__':
+    main()
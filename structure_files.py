@@ -0,0 +1,297 @@
+import os
+import re
+import gzip
+import time
+import shutil
+import hashlib
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, then the cache is not locked against other processes
+    fcntl = None
+
+
+# supported structure files, in the order of preference if a protein ID has several files
+SUFFIXES = ['.pdb', '.pdb.gz', '.cif', '.cif.gz']
+# options of the node-local cache, see 'configure'
+OPTIONS = {'cache_path': None, 'max_gb': 50., 'stage_plain': 0, 'min_age': 600}
+# folder of the cache with one file per process listing the structures it staged, see 'files_in_use'
+JOBS_FOLDER = '.jobs'
+_SOURCES = {}
+# structures staged by this process, they are kept in the cache until the process ends
+_IN_USE = set()
+
+
+def configure(cache_path=None, max_gb=50., stage_plain=0, min_age=600):
+    """Set the node-local cache of the staged structures.
+    Parameters:
+    ----------
+    cache_path: string
+        Folder on the local disk of the node, shared by all jobs on the node, '$TMPDIR/stacpro_cache' (or
+        '/tmp/stacpro_cache') if not provided.
+    max_gb: float
+        Size limit of the cache, the least recently used structures are removed above this size.
+    stage_plain: bool
+        If the plain .pdb files are copied to the cache too, so us-align does not read them from the
+        shared file system again in every call. Compressed and mmCIF files are always staged.
+    min_age: float
+        Structures used in the last 'min_age' seconds are never removed, nor the structures staged by a job
+        still running on the node, see 'files_in_use'."""
+    OPTIONS.update({'cache_path': cache_path, 'max_gb': max_gb, 'stage_plain': stage_plain, 'min_age': min_age})
+
+
+def get_pro_id(file):
+    """Protein ID of a structure file, None if it is not a supported structure file."""
+    for suffix in SUFFIXES[::-1]:
+        if file.endswith(suffix):
+            return file[:-len(suffix)]
+    return None
+
+
+def source_files(pdb_path):
+    """Structure file of every protein ID in the folder, the folder is listed only once per process."""
+    if pdb_path not in _SOURCES:
+        sources = {}
+        for file in os.listdir(pdb_path):
+            pro_id = get_pro_id(file)
+            if pro_id is None:
+                continue
+            if pro_id not in sources or SUFFIXES.index(file[len(pro_id):]) < \
+                    SUFFIXES.index(sources[pro_id][len(pro_id):]):
+                sources[pro_id] = file
+        _SOURCES[pdb_path] = sources
+    return _SOURCES[pdb_path]
+
+
+def list_structures(pdb_path):
+    """Names of all structures in the folder as they are used in the lists, '<protein ID>.pdb', in the order
+    of 'os.listdir'. For compressed and mmCIF files, this is the name of the staged copy."""
+    pdb_files = []
+    found = set()
+    for file in os.listdir(pdb_path):
+        pro_id = get_pro_id(file)
+        if pro_id is not None and pro_id not in found:
+            found.add(pro_id)
+            pdb_files.append(pro_id + '.pdb')
+    return pdb_files
+
+
+def get_source_path(pdb_path, pdb_file):
+    """Path of the structure file of '<protein ID>.pdb', which may be compressed or mmCIF."""
+    if os.path.exists(os.path.join(pdb_path, pdb_file)):
+        return os.path.join(pdb_path, pdb_file)
+    source = source_files(pdb_path).get(pdb_file[:-4])
+    if source is None:
+        return os.path.join(pdb_path, pdb_file)
+    return os.path.join(pdb_path, source)
+
+
+def split_cif_line(line):
+    """Values of one line of a mmCIF loop, values with spaces are quoted."""
+    return [value[1:-1] if value[0] in '\'"' else value
+            for value in re.findall(r"'(?:[^']|'(?!\s))*'(?=\s|$)|\"(?:[^\"]|\"(?!\s))*\"(?=\s|$)|\S+", line)]
+
+
+def cif_value(atom, *keys):
+    """First of the keys with a value in the atom, '?' and '.' mean no value."""
+    for key in keys:
+        if atom.get(key, '?') not in ('?', '.'):
+            return atom[key]
+    return ''
+
+
+def cif2pdb_lines(cif_lines):
+    """Convert the atoms of the first model in a mmCIF file to lines of a .pdb file, as needed by us-align
+    and 'structure_store.read_ca_trace'. The author chain ID and residue number are used if available,
+    chain IDs longer than one character are cut to the first character."""
+    columns = []
+    in_atoms = False
+    model = None
+    for line in cif_lines:
+        if line.startswith('_atom_site.'):
+            columns.append(line.strip()[len('_atom_site.'):])
+            in_atoms = True
+            continue
+        if not in_atoms or len(columns) == 0:
+            continue
+        if line.startswith('#') or line.startswith('loop_') or line.startswith('_'):
+            break
+        values = split_cif_line(line)
+        if len(values) != len(columns):
+            continue
+        atom = dict(zip(columns, values))
+        if model is None:
+            model = atom.get('pdbx_PDB_model_num')
+        elif atom.get('pdbx_PDB_model_num') != model:
+            break
+        name = cif_value(atom, 'auth_atom_id', 'label_atom_id')
+        element = cif_value(atom, 'type_symbol')
+        # atom names shorter than 4 characters start in the second column, as in the .pdb files
+        if len(name) < 4 and len(element) == 1:
+            name = ' ' + name
+        yield '%-6s%5d %-4s%1s%3s %1s%4d%1s   %8.3f%8.3f%8.3f%6.2f%6.2f          %2s\n' % (
+            cif_value(atom, 'group_PDB') or 'ATOM', int(cif_value(atom, 'id') or 0) % 100000, name[:4],
+            cif_value(atom, 'label_alt_id')[:1], cif_value(atom, 'auth_comp_id', 'label_comp_id')[:3],
+            cif_value(atom, 'auth_asym_id', 'label_asym_id')[:1],
+            int(cif_value(atom, 'auth_seq_id', 'label_seq_id') or 0) % 10000,
+            cif_value(atom, 'pdbx_PDB_ins_code')[:1], float(cif_value(atom, 'Cartn_x')),
+            float(cif_value(atom, 'Cartn_y')), float(cif_value(atom, 'Cartn_z')),
+            float(cif_value(atom, 'occupancy') or 1), float(cif_value(atom, 'B_iso_or_equiv') or 0), element[:2])
+    yield 'END\n'
+
+
+def open_structure(source_path):
+    """Lines of a structure file in the .pdb format, decompressed and converted from mmCIF if needed."""
+    if source_path.endswith('.gz'):
+        structure_file = gzip.open(source_path, 'rt')
+    else:
+        structure_file = open(source_path, 'r')
+    with structure_file:
+        if source_path.endswith('.cif') or source_path.endswith('.cif.gz'):
+            for line in cif2pdb_lines(structure_file):
+                yield line
+        else:
+            for line in structure_file:
+                yield line
+
+
+def write_pdb(source_path, pdb_file_path):
+    """Write a structure file as a plain .pdb file."""
+    if source_path.endswith('.pdb'):
+        shutil.copyfile(source_path, pdb_file_path)
+        return
+    pdb_file = open(pdb_file_path, 'w')
+    pdb_file.writelines(open_structure(source_path))
+    pdb_file.close()
+
+
+def get_cache_path():
+    if OPTIONS['cache_path'] is not None:
+        return OPTIONS['cache_path']
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'), 'stacpro_cache')
+
+
+def stage_structures(pdb_path, pdb_files):
+    """Make sure us-align can read the structures as plain .pdb files. If all of them are plain .pdb files
+    (and 'stage_plain' is not set), 'pdb_path' is returned. Otherwise the missing ones are decompressed or
+    converted once into the node-local cache, see 'configure', and the folder of the cache is returned.
+    The cache is locked while staging, so the jobs on the same node do not stage the same files twice,
+    and every copy is written to a temporary file first, so no job sees a half-written structure. The
+    structures are kept in the cache as long as the process is running, so no other job removes them.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all structure files.
+    pdb_files: list
+        Names of the needed structures, '<protein ID>.pdb'.
+    Returns:
+    ----------
+    pdb_path: string
+        Folder of the structures to be used by us-align."""
+    sources = source_files(pdb_path)
+    if not OPTIONS['stage_plain'] and all(sources.get(pdb_file[:-4]) == pdb_file for pdb_file in pdb_files):
+        return pdb_path
+    cache_path = get_cache_path()
+    # one folder per source folder, so proteins with the same ID in different projects do not collide
+    folder_path = os.path.join(cache_path, hashlib.md5(os.path.abspath(pdb_path).encode()).hexdigest()[:12])
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path, exist_ok=True)
+    lock_file = open(os.path.join(cache_path, '.lock'), 'w')
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        now = time.time()
+        num_staged = 0
+        for pdb_file in pdb_files:
+            staged_path = os.path.join(folder_path, pdb_file)
+            if os.path.exists(staged_path):
+                # the modification time is the last use, for the eviction
+                os.utime(staged_path, (now, now))
+                continue
+            tmp_path = staged_path + '.' + str(os.getpid()) + '.tmp'
+            write_pdb(get_source_path(pdb_path, pdb_file), tmp_path)
+            os.replace(tmp_path, staged_path)
+            num_staged += 1
+        add_in_use(cache_path, [os.path.join(folder_path, pdb_file) for pdb_file in pdb_files])
+        evict(cache_path)
+    finally:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+    if num_staged > 0:
+        print(num_staged, 'structures staged in: ', folder_path)
+    return folder_path
+
+
+def add_in_use(cache_path, staged_paths):
+    """Add the structures to the file of this process in the jobs folder of the cache."""
+    new_paths = [staged_path for staged_path in staged_paths if staged_path not in _IN_USE]
+    if len(new_paths) == 0:
+        return
+    jobs_path = os.path.join(cache_path, JOBS_FOLDER)
+    if not os.path.exists(jobs_path):
+        os.makedirs(jobs_path, exist_ok=True)
+    jobs_file = open(os.path.join(jobs_path, str(os.getpid()) + '.txt'), 'a')
+    jobs_file.writelines(staged_path + '\n' for staged_path in new_paths)
+    jobs_file.close()
+    _IN_USE.update(new_paths)
+
+
+def process_running(pid):
+    # on Windows, os.kill would stop the process, so all processes are taken as running
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def files_in_use(cache_path):
+    """Structures staged by the processes still running on the node, the files of the finished (or killed)
+    processes are removed from the jobs folder."""
+    in_use = set()
+    jobs_path = os.path.join(cache_path, JOBS_FOLDER)
+    if not os.path.exists(jobs_path):
+        return in_use
+    for entry in os.scandir(jobs_path):
+        if not process_running(int(entry.name[:-4])):
+            os.remove(entry.path)
+            continue
+        jobs_file = open(entry.path, 'r')
+        in_use.update(line.strip() for line in jobs_file)
+        jobs_file.close()
+    return in_use
+
+
+def evict(cache_path):
+    """Remove the least recently used structures until the cache is smaller than 'max_gb', structures used
+    in the last 'min_age' seconds and structures staged by running jobs are kept. Called by 'stage_structures'
+    with the cache locked."""
+    entries = []
+    total_size = 0
+    for folder in os.scandir(cache_path):
+        if not folder.is_dir() or folder.name == JOBS_FOLDER:
+            continue
+        for entry in os.scandir(folder.path):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+    max_size = OPTIONS['max_gb'] * 1024. ** 3
+    if total_size <= max_size:
+        return
+    in_use = files_in_use(cache_path)
+    now = time.time()
+    for mtime, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        if now - mtime < OPTIONS['min_age'] or path in in_use:
+            continue
+        os.remove(path)
+        total_size -= size
+    if total_size > max_size:
+        print('Warning: the structures in use are larger than the cache of', OPTIONS['max_gb'], 'GB in: ',
+              cache_path)
@@ -0,0 +1,145 @@
+import os
+import numpy as np
+import pandas as pd
+import structure_files
+
+
+# one-letter codes of the residues, unknown residues are 'X'
+THREE2ONE = {'ALA': 'A', 'ARG': 'R', 'ASN': 'N', 'ASP': 'D', 'CYS': 'C', 'GLN': 'Q', 'GLU': 'E', 'GLY': 'G',
+             'HIS': 'H', 'ILE': 'I', 'LEU': 'L', 'LYS': 'K', 'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S',
+             'THR': 'T', 'TRP': 'W', 'TYR': 'Y', 'VAL': 'V', 'MSE': 'M', 'SEC': 'U', 'PYL': 'O'}
+
+
+def read_ca_trace(pdb_file_path):
+    """Read the CA trace of the first chain of the first model in a .pdb file.
+    Parameters:
+    ----------
+    pdb_file_path: string
+        Path of the .pdb file, which may also be compressed (.pdb.gz) or mmCIF (.cif, .cif.gz).
+    Returns:
+    ----------
+    xyz: ndarray
+        CA coordinates with the size of L*3, with L the number of residues.
+    res_names: list
+        Three-letter residue names in the order of 'xyz'."""
+    xyz = []
+    res_names = []
+    chain = None
+    pdb_file = structure_files.open_structure(pdb_file_path)
+    for line in pdb_file:
+        if line.startswith('ENDMDL'):
+            break
+        if not line.startswith('ATOM') or line[12:16].strip() != 'CA':
+            continue
+        # us-align uses the first chain by default, so do we
+        if chain is None:
+            chain = line[21]
+        elif line[21] != chain:
+            break
+        # skip alternative locations of the same atom
+        if line[16] not in (' ', 'A'):
+            continue
+        xyz.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+        res_names.append(line[17:20])
+    pdb_file.close()
+    return np.array(xyz, dtype=float).reshape(-1, 3), res_names
+
+
+def res_names2seq(res_names):
+    """Reform the three-letter residue names to a one-letter sequence."""
+    return ''.join([THREE2ONE.get(res_name, 'X') for res_name in res_names])
+
+
+def ingest_structures(pdb_path, pdb_list, store_path=None):
+    """Parse every structure once and save the sequence, number of residues and CA coordinates of all
+    structures in one compact store, so the later stages do not need to read thousands of small .pdb files.
+    The store is a folder with two files:
+    'structures_index.txt': protein ID, .pdb file name, sequence, number of residues and offset of
+    the first residue in the coordinate array;
+    'structures_ca.f32': CA coordinates of all structures as one float32 array with the size of
+    (number of all residues)*3, which is memory-mapped when loaded.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names.
+    store_path: string
+        Folder of the store, if not provided, it is the 'structure_store' folder in the same path as the
+        pdb folder.
+    Returns:
+    ----------
+    store_path: string
+        Folder of the store."""
+    if store_path is None:
+        store_path = os.path.join(os.path.dirname(pdb_path), 'structure_store')
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+        print('Folder for the structure store does not exist, created!')
+    list_seq = []
+    list_length = []
+    list_offset = []
+    offset = 0
+    # the coordinates are appended to the file one structure after another
+    ca_file = open(os.path.join(store_path, 'structures_ca.f32'), 'wb')
+    for pdb_file in pdb_list[0]:
+        xyz, res_names = read_ca_trace(structure_files.get_source_path(pdb_path, pdb_file))
+        ca_file.write(xyz.astype(np.float32).tobytes())
+        list_seq.append(res_names2seq(res_names))
+        list_length.append(len(xyz))
+        list_offset.append(offset)
+        offset += len(xyz)
+    ca_file.close()
+    df_index = pd.DataFrame({'protein_ID': pdb_list[0].str[:-4], 'pdb_file': pdb_list[0], 'sequence': list_seq,
+                             'length': list_length, 'offset': list_offset})
+    df_index.to_csv(os.path.join(store_path, 'structures_index.txt'), index=None, sep='\t')
+    print(len(df_index), 'structures with', offset, 'residues saved in the structure store: ', store_path)
+    return store_path
+
+
+def load_store(store_path):
+    """Load the structure store saved by 'ingest_structures', the coordinates are memory-mapped.
+    Returns:
+    ----------
+    store: dict
+        'index': the index dataframe; 'ca': the coordinate array; 'row': row of each protein ID in the index."""
+    df_index = pd.read_csv(os.path.join(store_path, 'structures_index.txt'), sep='\t',
+                           dtype={'protein_ID': str, 'pdb_file': str, 'sequence': str}, keep_default_na=False)
+    ca_path = os.path.join(store_path, 'structures_ca.f32')
+    if os.path.getsize(ca_path) == 0:
+        ca = np.zeros([0, 3], dtype=np.float32)
+    else:
+        ca = np.memmap(ca_path, dtype=np.float32, mode='r').reshape(-1, 3)
+    row = dict(zip(df_index['protein_ID'], range(len(df_index))))
+    return {'index': df_index, 'ca': ca, 'row': row}
+
+
+def read_structure(pdb_path, pdb_file, store=None):
+    """Get the CA coordinates and the sequence of one structure, from the store if provided,
+    otherwise by parsing the .pdb file.
+    Returns:
+    ----------
+    xyz: ndarray
+        CA coordinates with the size of L*3.
+    seq: string
+        One-letter sequence."""
+    if store is not None and pdb_file[:-4] in store['row']:
+        row = store['row'][pdb_file[:-4]]
+        offset = store['index']['offset'].iloc[row]
+        length = store['index']['length'].iloc[row]
+        return np.array(store['ca'][offset:offset + length], dtype=float), store['index']['sequence'].iloc[row]
+    xyz, res_names = read_ca_trace(structure_files.get_source_path(pdb_path, pdb_file))
+    return xyz, res_names2seq(res_names)
+
+
+def get_lengths(pdb_path, pdb_list, store=None):
+    """Get the number of residues of every structure in the list, from the store if provided."""
+    if store is not None:
+        rows = [store['row'].get(pdb_file[:-4]) for pdb_file in pdb_list[0]]
+        if None not in rows:
+            return store['index']['length'].values[rows]
+    lengths = []
+    for pdb_file in pdb_list[0]:
+        xyz, _ = read_structure(pdb_path, pdb_file, store=store)
+        lengths.append(len(xyz))
+    return np.array(lengths)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_PATH))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_PATH), 'benchmarks'))
@@ -0,0 +1,106 @@
+"""The block-wise cluster statistics and the incremental scores of the cuts against a brute-force computation
+on the full distance matrix."""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import synthetic
+import clustering.cluster_stats as cluster_stats
+import clustering.get_clusters as get_clusters
+import clustering.tree_functions as tree_functions
+
+
+def full_distances(mat):
+    """Symmetric n*n distances of the (n-1)*(n-1) matrix of 'align2mat'."""
+    num_pro = mat.shape[0] + 1
+    dis = np.zeros([num_pro, num_pro])
+    dis[:-1, 1:] = np.triu(mat)
+    return dis + dis.T
+
+
+def build_tree(tmp_path, num_pro, seed):
+    align_all_path = synthetic.write_alignment(synthetic.random_tree(num_pro, seed=seed),
+                                               os.path.join(str(tmp_path), 'alignment_all.txt'), noise=0.02,
+                                               seed=seed)
+    tree_folder_path = os.path.join(str(tmp_path), 'trees')
+    os.makedirs(tree_folder_path)
+    get_clusters.get_tree_file(align_all_path, path_tree_folder=tree_folder_path)
+    tree_file = open(os.path.join(tree_folder_path, 'tree_nj.nwk'), 'r')
+    tree_nwk = tree_file.read()
+    tree_file.close()
+    mat, df_pro_uni = tree_functions.align2mat(align_all_path)
+    return mat, df_pro_uni, tree_nwk
+
+
+@pytest.mark.parametrize('block_cells', [10000000, 50])
+def test_cluster_statistics(monkeypatch, block_cells):
+    monkeypatch.setattr(cluster_stats, 'BLOCK_CELLS', block_cells)
+    rng = np.random.default_rng(0)
+    num_pro = 60
+    mat = synthetic.distance_matrix(synthetic.random_tree(num_pro, seed=1))
+    df_pro_uni = np.array(synthetic.get_names(num_pro), dtype=object)
+    labels = rng.integers(0, 7, size=num_pro)
+    # one protein alone in its cluster, and a duplicate which is not in the matrix
+    labels[5] = 7
+    df_clusters = pd.DataFrame({'protein_ID': list(df_pro_uni) + ['duplicate'],
+                                'cluster_number': list(labels) + [labels[0]]})
+    df_stats = cluster_stats.cluster_statistics(mat, df_pro_uni, df_clusters)
+    dis = full_distances(mat)
+    clusters = np.unique(labels)
+    assert list(df_stats['cluster_number']) == list(clusters)
+    for ind_cluster, cluster in enumerate(clusters):
+        stats = df_stats.iloc[ind_cluster]
+        members = np.flatnonzero(labels == cluster)
+        others = np.flatnonzero(labels != cluster)
+        assert stats['size'] == members.size + (cluster == labels[0])
+        dis_own = dis[np.ix_(members, members)]
+        sums = dis_own.sum(axis=1)
+        assert stats['medoid'] == df_pro_uni[members[np.argmin(sums)]]
+        mean_other = [dis[np.ix_(members, np.flatnonzero(labels == other))].mean() for other in clusters
+                      if other != cluster]
+        assert stats['nearest_cluster'] == [other for other in clusters if other != cluster][np.argmin(mean_other)]
+        assert stats['nearest_cluster_distance'] == pytest.approx(min(mean_other))
+        assert stats['nearest_protein_distance'] == pytest.approx(dis[np.ix_(members, others)].min())
+        if members.size == 1:
+            assert np.isnan(stats['mean_similarity']) and np.isnan(stats['min_similarity'])
+            assert np.isnan(stats['medoid_similarity'])
+            continue
+        num_pairs = members.size * (members.size - 1)
+        assert stats['medoid_similarity'] == pytest.approx(1 - sums.min() / (members.size - 1))
+        assert stats['mean_similarity'] == pytest.approx(1 - dis_own.sum() / num_pairs)
+        assert stats['min_similarity'] == pytest.approx(1 - dis_own.max())
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_score_cuts(tmp_path, monkeypatch, seed):
+    monkeypatch.setattr(cluster_stats, 'BLOCK_CELLS', 200)
+    mat, df_pro_uni, tree_nwk = build_tree(tmp_path, 50, seed)
+    df_scores = cluster_stats.score_cuts(mat, df_pro_uni, tree_nwk, max_clusters=20)
+    assert len(df_scores) > 0
+    dis = full_distances(mat)
+    pro_index = pd.Series(np.arange(df_pro_uni.size), index=df_pro_uni)
+    parent, length, names = tree_functions.nwk2arrays(tree_nwk)
+    layout = tree_functions.tree_layout(parent, length)
+    is_leaf = layout['is_leaf']
+    leaf_rows = pro_index[np.array(names, dtype=object)[is_leaf]].values
+    for _, scores in df_scores.iterrows():
+        cluster = tree_functions.get_cut_clusters(parent, layout, int(scores['cluster_num']))
+        label = np.empty(df_pro_uni.size, dtype=int)
+        label[leaf_rows] = cluster[is_leaf]
+        sizes = np.bincount(label)
+        assert np.unique(label).size == scores['cluster_num']
+        assert scores['singletons'] == (sizes == 1).sum()
+        assert scores['size_min'] == sizes.min() and scores['size_max'] == sizes.max()
+        assert scores['size_median'] == np.median(sizes)
+        same = label[:, None] == label[None, :]
+        count_own = sizes[label]
+        sum_own = (dis * same).sum(axis=1)
+        mean_cluster = np.stack([dis[:, label == ind].mean(axis=1) for ind in range(sizes.size)], axis=1)
+        mean_cluster[np.arange(label.size), label] = np.inf
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dis_a = sum_own / (count_own - 1)
+        dis_b = mean_cluster.min(axis=1)
+        silhouette = np.where(count_own > 1, (dis_b - dis_a) / np.maximum(dis_a, dis_b), 0.)
+        assert scores['silhouette'] == pytest.approx(silhouette.mean())
+        assert scores['within'] == pytest.approx(sum_own.sum() / (count_own - 1).sum())
+        assert scores['between'] == pytest.approx((dis * ~same).sum() / (label.size - count_own).sum())
@@ -0,0 +1,61 @@
+"""The parallel NJ step and the bounded RapidNJ search give the same merges as 'update_mat_nj', to the last bit."""
+import numpy as np
+import pytest
+import synthetic
+import clustering.rapid_nj as rapid_nj
+import clustering.tree_functions as tree_functions
+
+
+def random_matrix(num_pro, seed, decimals=None, offset=0.):
+    """(n-1)*(n-1) matrix in the format of 'align2mat' with random distances in [offset, offset + 1], rounded to
+    'decimals' to get many tied Q-values."""
+    values = offset + np.random.default_rng(seed).random([num_pro - 1, num_pro - 1])
+    if decimals is not None:
+        values = np.round(values, decimals)
+    mat = np.ones([num_pro - 1, num_pro - 1]) + 0.0001
+    ind_i, ind_j = np.triu_indices(num_pro - 1)
+    mat[ind_i, ind_j] = values[ind_i, ind_j]
+    return mat
+
+
+def merges_full(mat):
+    merges = []
+    for len_matrix in range(mat.shape[0], 0, -1):
+        mat, row, col, min_dis1, min_dis2 = tree_functions.update_mat_nj(mat, len_matrix)
+        merges.append((row, col, min_dis1, min_dis2))
+    return merges
+
+
+def merges_parallel(mat):
+    merges = []
+    for len_matrix in range(mat.shape[0], 0, -1):
+        mat, row, col, min_dis1, min_dis2 = tree_functions.update_mat_nj_parallel(mat, len_matrix, n_threads=3)
+        merges.append((row, col, min_dis1, min_dis2))
+    return merges
+
+
+def merges_rapid(mat):
+    search = rapid_nj.RapidNJ(mat)
+    return [search.update(len_matrix) for len_matrix in range(mat.shape[0], 0, -1)]
+
+
+MATRICES = [('random', lambda seed: random_matrix(40, seed)),
+            ('tied', lambda seed: random_matrix(40, seed, decimals=1)),
+            ('two_values', lambda seed: random_matrix(30, seed, decimals=0)),
+            # negative distances give Q-values above the cells below the diagonal, where 'update_mat_nj' ends
+            ('negative', lambda seed: random_matrix(30, seed, offset=-3.)),
+            ('equal', lambda seed: np.triu(np.full([25, 25], 0.5)) + np.tril(np.full([25, 25], 1.0001), k=-1)),
+            ('additive', lambda seed: synthetic.distance_matrix(synthetic.random_tree(40, seed=seed)))]
+
+
+@pytest.mark.parametrize('name, make_matrix', MATRICES, ids=[name for name, _ in MATRICES])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_same_merges(monkeypatch, name, make_matrix, seed):
+    # small blocks, so the chunks of the parallel step, the sorting and the scan blocks are all used
+    monkeypatch.setattr(tree_functions, 'NJ_CHUNK_ROWS', 4)
+    monkeypatch.setattr(rapid_nj, 'SORT_CHUNK_ROWS', 4)
+    monkeypatch.setattr(rapid_nj, 'SCAN_COLUMNS', 2)
+    mat = make_matrix(seed)
+    expected = merges_full(mat.copy())
+    assert merges_parallel(mat.copy()) == expected
+    assert merges_rapid(mat.copy()) == expected
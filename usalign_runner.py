@@ -0,0 +1,299 @@
+import os
+import shutil
+import asyncio
+import pandas as pd
+import get_alignments
+import instrumentation
+
+
+# header of the us-align output with '-outfmt 2', used when all pairs of a row failed
+RAW_HEADER = '#PDBchain1\tPDBchain2\tTM1\tTM2\tRMSD\tID1\tID2\tIDali\tL1\tL2\tLali\n'
+
+
+def count_align_rows(out_path):
+    """Number of alignment rows in a us-align output file, the header lines start with '#'."""
+    num_rows = 0
+    out_file = open(out_path, 'r')
+    for line in out_file:
+        if line.strip() != '' and not line.startswith('#'):
+            num_rows += 1
+    out_file.close()
+    return num_rows
+
+
+async def run_cmd(cmd, out_path, timeout):
+    """Run one us-align call without a shell, the output is written to 'out_path'. The process is killed
+    if it runs longer than 'timeout' seconds.
+    Returns:
+    ----------
+    error: string
+        None if the call finished with return code 0, otherwise the reason of the failure."""
+    out_file = open(out_path, 'w')
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=out_file, stderr=asyncio.subprocess.DEVNULL)
+    except OSError as err:
+        out_file.close()
+        return 'start failed: ' + str(err)
+    try:
+        returncode = await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        out_file.close()
+        return 'timeout'
+    out_file.close()
+    if returncode != 0:
+        return 'return code ' + str(returncode)
+    return None
+
+
+async def run_with_retries(cmd, out_path, num_pairs, semaphore, timeout, retries, backoff):
+    """Run one us-align call with at most 'retries' retries, waiting backoff*2^attempt seconds between
+    them. A call only succeeds if it writes one row for every pair, since a crashed us-align can still
+    return 0 with a truncated output. A call of several pairs that times out is not retried, a hanging
+    structure is found faster by splitting the call."""
+    error = None
+    for attempt in range(retries + 1):
+        async with semaphore:
+            error = await run_cmd(cmd, out_path, timeout)
+        if error is None:
+            if count_align_rows(out_path) == num_pairs:
+                return None
+            error = 'incomplete output'
+        if error == 'timeout' and num_pairs > 1:
+            return error
+        if attempt < retries:
+            await asyncio.sleep(backoff * 2 ** attempt)
+    return error
+
+
+class AlignRunner:
+    """Run the rows of one job concurrently with asyncio, with at most 'n_workers' us-align processes at
+    the same time. A row (or batch of rows) that still fails after the retries is split in two halves,
+    which are run again without retries, until the failing pairs are isolated. These pairs are written
+    to the quarantine report instead of stopping the job, all other pairs of the row are kept. The structure
+    of an isolated pair that most likely breaks us-align is quarantined as well and left out of all later
+    calls of the job, so a hanging structure is only searched once, see 'quarantine_structure'.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    usalign_path: string
+        Path of the US-align tool (e.g. PATH/USalign).
+    tmp_folder_path: string
+        Folder for the lists and raw outputs of the single calls.
+    n_workers: int
+        Number of us-align processes running at the same time.
+    timeout: float
+        Time limit in seconds of one call is 'timeout' + 'timeout_per_pair' * (number of pairs of the call).
+    max_timeout: float
+        Largest time limit of one call, a longer call is split instead.
+    retries: int
+        Number of retries of a failed row or batch before it is split, calls of several pairs that time out
+        are split without retries.
+    backoff: float
+        Waiting time in seconds before the first retry, doubled for every further retry.
+    job_progress: progress.Progress
+        If provided, updated with the number of pairs after every row or batch."""
+    def __init__(self, pdb_path, usalign_path, tmp_folder_path, n_workers=4, timeout=60, timeout_per_pair=10,
+                 max_timeout=3600, retries=2, backoff=1, job_progress=None):
+        self.pdb_path = pdb_path
+        self.usalign_path = usalign_path
+        self.tmp_folder_path = tmp_folder_path
+        self.timeout = timeout
+        self.timeout_per_pair = timeout_per_pair
+        self.max_timeout = max_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.n_workers = n_workers
+        # created in the running event loop by 'get_semaphore', before python 3.10 a semaphore is bound to the
+        # loop of its creation
+        self.semaphore = None
+        self.num_calls = 0
+        self.quarantine = []
+        # quarantined structures with the error of their isolated pair, and structures with a successful call
+        self.bad_structures = {}
+        self.good_structures = set()
+        self.job_progress = job_progress
+
+    def get_semaphore(self):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.n_workers)
+        return self.semaphore
+
+    def add_progress(self, num_pairs):
+        if self.job_progress is not None:
+            self.job_progress.update(self.job_progress.done + num_pairs)
+
+    def call_timeout(self, num_pairs):
+        return min(self.timeout + self.timeout_per_pair * num_pairs, self.max_timeout)
+
+    def quarantine_structure(self, pdb_file, target, error):
+        """Quarantine the structure of an isolated failing pair: the query if the target already aligned in
+        other calls and the query did not, the target if the query did, or if neither is known yet. If both
+        aligned in other calls, only the pair is quarantined."""
+        if target in self.good_structures and pdb_file not in self.good_structures:
+            bad_structure = pdb_file
+        elif target not in self.good_structures:
+            bad_structure = target
+        else:
+            return
+        if bad_structure not in self.bad_structures:
+            self.bad_structures[bad_structure] = error
+
+    def skip_quarantined(self, pdb_file, targets):
+        """Targets without the quarantined structures, their pairs are written to the quarantine report."""
+        if pdb_file in self.bad_structures:
+            skipped = targets
+        else:
+            skipped = [target for target in targets if target in self.bad_structures]
+        for target in skipped:
+            self.quarantine.append((pdb_file[:-4], target[:-4], 'structure quarantined'))
+        if len(skipped) == 0:
+            return targets
+        return [target for target in targets if target not in skipped]
+
+    async def align_row(self, pdb_file, targets, tag, retries):
+        """Align one protein against a list of proteins, split the list in halves if the call fails.
+        Returns:
+        ----------
+        out_paths: list
+            Raw outputs of the successful calls, in the order of 'targets'."""
+        targets = self.skip_quarantined(pdb_file, targets)
+        if len(targets) == 0:
+            return []
+        self.num_calls += 1
+        list_path = os.path.join(self.tmp_folder_path, tag + '_list.txt')
+        out_path = os.path.join(self.tmp_folder_path, tag + '.out')
+        pd.DataFrame(targets).to_csv(list_path, header=None, index=None)
+        cmd = [self.usalign_path, os.path.join(self.pdb_path, pdb_file), '-dir2', self.pdb_path, list_path,
+               '-outfmt', '2']
+        error = await run_with_retries(cmd, out_path, len(targets), self.get_semaphore(),
+                                       self.call_timeout(len(targets)), retries, self.backoff)
+        if error is None:
+            self.good_structures.add(pdb_file)
+            self.good_structures.update(targets)
+            return [out_path]
+        if len(targets) == 1:
+            self.quarantine.append((pdb_file[:-4], targets[0][:-4], error))
+            self.quarantine_structure(pdb_file, targets[0], error)
+            return []
+        half = len(targets) // 2
+        out_first, out_second = await asyncio.gather(self.align_row(pdb_file, targets[:half], tag + 'a', 0),
+                                                     self.align_row(pdb_file, targets[half:], tag + 'b', 0))
+        return out_first + out_second
+
+    async def run_row(self, pdb_file, sub_list_list_path, align_file_path):
+        """Compute one row and save it as 'align_<protein ID>.txt', the same as 'run_usalign'."""
+        if os.path.getsize(sub_list_list_path) == 0:
+            pd.DataFrame(columns=get_alignments.ALIGN_COLUMNS).to_csv(align_file_path, index=None, sep='\t')
+            return
+        targets = list(pd.read_csv(sub_list_list_path, sep='\t', header=None)[0])
+        out_paths = await self.align_row(pdb_file, targets, pdb_file[:-4], self.retries)
+        # join the outputs of the split calls, keeping one header
+        align_file = open(align_file_path, 'w')
+        align_file.write(RAW_HEADER)
+        for out_path in out_paths:
+            out_file = open(out_path, 'r')
+            for line in out_file:
+                if line.strip() != '' and not line.startswith('#'):
+                    align_file.write(line)
+            out_file.close()
+        align_file.close()
+        get_alignments.clean_pro_name_in_align(align_file_path, len(targets), pdb_file=pdb_file)
+        instrumentation.add_pairs(len(targets))
+        self.add_progress(len(targets))
+
+    async def run_batch(self, batch, sublist_path, align_folder_path):
+        """Compute a batch of rows with one call, the same as 'run_usalign_batch' (the batches of
+        'get_batches' only contain rows with overlapping sub-lists). If it fails, or if it
+        contains a quarantined structure, the rows of the batch are computed one by one and concatenated into
+        the batch file."""
+        list_pro1, list_pro2 = get_alignments.get_batch_pairs(batch, sublist_path)
+        align_file_path = os.path.join(align_folder_path, 'align_batch_' + batch[0][:-3] + 'txt')
+        if len(list_pro2) == 0:
+            pd.DataFrame(columns=get_alignments.ALIGN_COLUMNS).to_csv(align_file_path, index=None, sep='\t')
+            return
+        target_list = list(pd.unique(pd.Series(list_pro2)))
+        if any(pdb_file in self.bad_structures for pdb_file in batch + target_list):
+            await self.run_batch_rows(batch, sublist_path, align_file_path)
+            return
+        self.num_calls += 1
+        tag = 'batch_' + batch[0][:-4]
+        list1_path = os.path.join(self.tmp_folder_path, tag + '_list1.txt')
+        list2_path = os.path.join(self.tmp_folder_path, tag + '_list2.txt')
+        out_path = os.path.join(self.tmp_folder_path, tag + '.out')
+        pd.DataFrame(batch).to_csv(list1_path, header=None, index=None)
+        pd.DataFrame(target_list).to_csv(list2_path, header=None, index=None)
+        cmd = [self.usalign_path, '-dir1', self.pdb_path, list1_path, '-dir2', self.pdb_path, list2_path,
+               '-outfmt', '2']
+        num_pairs = len(batch) * len(target_list)
+        error = await run_with_retries(cmd, out_path, num_pairs, self.get_semaphore(), self.call_timeout(num_pairs),
+                                       self.retries, self.backoff)
+        if error is None:
+            self.good_structures.update(batch + target_list)
+            df_align = get_alignments.read_dir_align(out_path)
+            get_alignments.clean_batch_align(df_align, list_pro1, list_pro2, align_file_path)
+            instrumentation.add_pairs(len(list_pro1))
+            self.add_progress(len(list_pro1))
+            return
+        await self.run_batch_rows(batch, sublist_path, align_file_path)
+
+    async def run_batch_rows(self, batch, sublist_path, align_file_path):
+        """Compute the rows of a batch one by one and concatenate them into the batch file."""
+        row_paths = []
+        for pdb_file in batch:
+            row_path = os.path.join(self.tmp_folder_path, 'align_' + pdb_file[:-3] + 'txt')
+            row_paths.append(row_path)
+        await asyncio.gather(*[self.run_row(pdb_file, os.path.join(sublist_path, 'list_' + pdb_file[:-3] + 'txt'),
+                                            row_path) for pdb_file, row_path in zip(batch, row_paths)])
+        df_align = pd.concat([pd.read_csv(row_path, sep='\t', dtype={'PDBchain1': str, 'PDBchain2': str})
+                              for row_path in row_paths])
+        df_align[get_alignments.ALIGN_COLUMNS].to_csv(align_file_path, index=None, sep='\t')
+
+
+async def run_job_async(runner, df_sub_par, pdb_list, sublist_path, align_folder_path, batch_size):
+    """Schedule all rows or batches of one job, they start in the order of the job list since the
+    semaphore is first come, first served."""
+    if batch_size > 1:
+        tasks = [runner.run_batch(batch, sublist_path, align_folder_path)
+                 for batch in get_alignments.get_batches(df_sub_par, pdb_list, batch_size, sublist_path=sublist_path)]
+    else:
+        tasks = [runner.run_row(pdb_file, os.path.join(sublist_path, 'list_' + pdb_file[:-3] + 'txt'),
+                                os.path.join(align_folder_path, 'align_' + pdb_file[:-3] + 'txt'))
+                 for pdb_file in df_sub_par[0]]
+    await asyncio.gather(*tasks)
+
+
+def run_job(pdb_path, usalign_path, df_sub_par, pdb_list, sublist_path, align_folder_path, job_name='0',
+            batch_size=1, n_workers=4, timeout=60, timeout_per_pair=10, max_timeout=3600, retries=2, backoff=1,
+            job_progress=None):
+    """Compute all rows in 'df_sub_par' (e.g. the job list 'pdb_list<par_index>.txt') with the asyncio runner,
+    see 'AlignRunner'. The alignment files are the same as with 'run_usalign', the failing pairs are written
+    to 'quarantine_<job_name>.txt' in the folder of the alignments.
+    Returns:
+    ----------
+    df_quarantine: pandas dataframe
+        The failing pairs and the reason of the failure."""
+    tmp_folder_path = os.path.join(align_folder_path, 'tmp_' + job_name)
+    if not os.path.exists(tmp_folder_path):
+        os.makedirs(tmp_folder_path)
+    runner = AlignRunner(pdb_path, usalign_path, tmp_folder_path, n_workers=n_workers, timeout=timeout,
+                         timeout_per_pair=timeout_per_pair, max_timeout=max_timeout, retries=retries,
+                         backoff=backoff, job_progress=job_progress)
+    asyncio.run(run_job_async(runner, df_sub_par, pdb_list, sublist_path, align_folder_path, batch_size))
+    shutil.rmtree(tmp_folder_path)
+    df_quarantine = pd.DataFrame(runner.quarantine, columns=['PDBchain1', 'PDBchain2', 'error'])
+    quarantine_path = os.path.join(align_folder_path, 'quarantine_' + job_name + '.txt')
+    df_quarantine.to_csv(quarantine_path, index=None, sep='\t')
+    print('Job', job_name, 'finished with', runner.num_calls, 'us-align calls,', len(df_quarantine),
+          'failing pairs are saved in: ', quarantine_path)
+    if len(runner.bad_structures) > 0:
+        print('Structures left out of all later calls of the job:', ', '.join(
+            pdb_file[:-4] + ' (' + error + ')' for pdb_file, error in runner.bad_structures.items()))
+    if len(df_quarantine) > 0:
+        # structures in many failing pairs are most likely the broken ones
+        counts = pd.concat([df_quarantine['PDBchain1'], df_quarantine['PDBchain2']]).value_counts()
+        print('Structures with the most failing pairs:')
+        print(counts.head(10).to_string())
+    return df_quarantine
@@ -0,0 +1,158 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+def pair_index(ind_i, ind_j, num_pro):
+    """Position of the pair (i, j) with i < j in the upper triangle of an n*n matrix, read row by row,
+    so all n*(n-1)/2 pairs are numbered from 0 without gaps."""
+    return ind_i * (2 * num_pro - ind_i - 1) // 2 + ind_j - ind_i - 1
+
+
+def index2pair(index, num_pro):
+    """Inverse of 'pair_index'."""
+    ind_rows = np.arange(num_pro)
+    row_start = pair_index(ind_rows, ind_rows + 1, num_pro)
+    ind_i = np.searchsorted(row_start, index, side='right') - 1
+    ind_j = index - row_start[ind_i] + ind_i + 1
+    return ind_i, ind_j
+
+
+def set_bits(bitmap, index):
+    """Set the bits of 'index' in a bitmap of uint8, returns the indices whose bit was set already."""
+    byte = index >> 3
+    mask = (1 << (index & 7)).astype(np.uint8)
+    old = (bitmap[byte] & mask) != 0
+    np.bitwise_or.at(bitmap, byte, mask)
+    return index[old]
+
+
+def bitmap_indices(bitmap, block_size=1 << 24):
+    """Indices of all set bits of a bitmap, only the non-zero bytes are unpacked, block by block."""
+    list_index = []
+    for start in range(0, bitmap.size, block_size):
+        block = bitmap[start:start + block_size]
+        byte = np.flatnonzero(block)
+        if byte.size == 0:
+            continue
+        bits = np.unpackbits(block[byte][:, None], axis=1, bitorder='little')
+        ind_byte, ind_bit = np.nonzero(bits)
+        list_index.append((byte[ind_byte] + start) * 8 + ind_bit)
+    if len(list_index) == 0:
+        return np.array([], dtype=np.int64)
+    return np.concatenate(list_index)
+
+
+def expected_bitmap(pdb_list, sublist_path=None):
+    """Bitmap of the pairs which should be in the pair-wise similarity file: all pairs, or the pairs of the
+    sub-lists if 'sublist_path' is provided, e.g. after the prefilter."""
+    num_pro = pdb_list[0].size
+    num_pairs = num_pro * (num_pro - 1) // 2
+    if sublist_path is None:
+        bitmap = np.full((num_pairs + 7) // 8, 255, dtype=np.uint8)
+        # clear the bits after the last pair
+        if num_pairs % 8 != 0:
+            bitmap[-1] = (1 << (num_pairs % 8)) - 1
+        return bitmap
+    bitmap = np.zeros((num_pairs + 7) // 8, dtype=np.uint8)
+    position = pd.Series(np.arange(num_pro), index=pdb_list[0].values)
+    for ind_i, pdb_file in enumerate(pdb_list[0].values[:-1]):
+        sub_list_list_path = os.path.join(sublist_path, 'list_' + pdb_file[:-3] + 'txt')
+        if os.path.getsize(sub_list_list_path) == 0:
+            continue
+        ind_j = position[pd.read_csv(sub_list_list_path, sep='\t', header=None)[0].values].values
+        set_bits(bitmap, pair_index(ind_i, ind_j, num_pro))
+    return bitmap
+
+
+def verify_pairs(align_all_path, pdb_list, sublist_path=None, rerun_path=None, chunksize=1000000):
+    """Check that every pair is in the pair-wise similarity file exactly once. Every row is mapped to one bit
+    of a bitmap with n*(n-1)/2 bits, a pair in both orders counts as a duplicate. The file is read in chunks,
+    so the memory is n*n/16 bytes plus one chunk.
+    Parameters:
+    ----------
+    align_all_path: string
+        Path for the pair-wise similarity file (e.g. PATH/alignment_all.txt).
+    pdb_list: pandas dataframe
+        A list of all .pdb file names.
+    sublist_path: string
+        Folder path of the sub-lists (optional), if provided, only the pairs of the sub-lists are expected.
+    rerun_path: string
+        If provided and pairs are missing, sub-lists with only the missing pairs are saved in this folder,
+        see 'write_rerun_lists'.
+    Returns:
+    ----------
+    report: dict
+        'missing', 'duplicated', 'unexpected': dataframes of the protein IDs of these pairs;
+        'invalid': number of rows with unknown protein IDs or a protein aligned with itself."""
+    num_pro = pdb_list[0].size
+    num_pairs = num_pro * (num_pro - 1) // 2
+    position = pd.Series(np.arange(num_pro), index=pdb_list[0].str[:-4].values)
+    seen = np.zeros((num_pairs + 7) // 8, dtype=np.uint8)
+    list_dup = []
+    num_invalid = 0
+    for df in pd.read_csv(align_all_path, sep='\t', usecols=['PDBchain1', 'PDBchain2'], chunksize=chunksize,
+                          dtype=str):
+        ind_1 = df['PDBchain1'].map(position).values
+        ind_2 = df['PDBchain2'].map(position).values
+        valid = ~(np.isnan(ind_1) | np.isnan(ind_2))
+        valid[valid] = ind_1[valid] != ind_2[valid]
+        num_invalid += int((~valid).sum())
+        ind_i = np.minimum(ind_1[valid], ind_2[valid]).astype(np.int64)
+        ind_j = np.maximum(ind_1[valid], ind_2[valid]).astype(np.int64)
+        index = pair_index(ind_i, ind_j, num_pro)
+        # duplicates within the chunk, then against the earlier chunks
+        index_uni, counts = np.unique(index, return_counts=True)
+        list_dup.append(np.repeat(index_uni, counts - 1))
+        list_dup.append(set_bits(seen, index_uni))
+    expected = expected_bitmap(pdb_list, sublist_path=sublist_path)
+    names = position.index.values
+    report = {'invalid': num_invalid}
+    for key, index in [('missing', bitmap_indices(expected & ~seen)),
+                       ('duplicated', np.unique(np.concatenate(list_dup)) if len(list_dup) > 0 else []),
+                       ('unexpected', bitmap_indices(seen & ~expected))]:
+        ind_i, ind_j = index2pair(np.asarray(index, dtype=np.int64), num_pro)
+        report[key] = pd.DataFrame({'PDBchain1': names[ind_i], 'PDBchain2': names[ind_j]})
+    print('Pair check of', align_all_path, ': missing', len(report['missing']), ', duplicated',
+          len(report['duplicated']), ', unexpected', len(report['unexpected']), ', invalid rows', num_invalid)
+    if rerun_path is not None and len(report['missing']) > 0:
+        write_rerun_lists(report['missing'], pdb_list, rerun_path)
+    return report
+
+
+def write_rerun_lists(df_missing, pdb_list, rerun_path):
+    """Save the missing pairs in the same layout as the sub-lists of 'get_lists': 'list_<protein ID>.txt'
+    for every protein with missing pairs, and one job list 'pdb_list0.txt', so they can be computed with
+    'compute_similarity' (parallel=1, par_index=0, sublist_path=rerun_path) and added with 'repair_alignment'."""
+    if not os.path.exists(rerun_path):
+        os.makedirs(rerun_path)
+    df_missing.to_csv(os.path.join(rerun_path, 'rerun_pairs.txt'), index=None, sep='\t')
+    queries = []
+    for pro_id, df_row in df_missing.groupby('PDBchain1', sort=False):
+        (df_row['PDBchain2'] + '.pdb').to_frame().to_csv(os.path.join(rerun_path, 'list_' + pro_id + '.txt'),
+                                                         header=None, index=None)
+        queries.append(pro_id + '.pdb')
+    pd.DataFrame(queries).to_csv(os.path.join(rerun_path, 'pdb_list0.txt'), header=None, index=None)
+    print(len(df_missing), 'missing pairs of', len(queries), 'proteins saved for a rerun in: ', rerun_path)
+
+
+def repair_alignment(align_all_path, rerun_align_folder_path, pdb_list):
+    """Add the alignments computed for the rerun lists to the pair-wise similarity file, remove duplicated
+    and invalid pairs and sort the rows in the order of the list."""
+    list_df = [pd.read_csv(align_all_path, sep='\t', dtype=str)]
+    for align_file in sorted(os.listdir(rerun_align_folder_path)):
+        if align_file.startswith('align_'):
+            list_df.append(pd.read_csv(os.path.join(rerun_align_folder_path, align_file), sep='\t', dtype=str))
+    df_align_all = pd.concat(list_df)
+    position = dict(zip(pdb_list[0].str[:-4], range(pdb_list[0].size)))
+    position1 = df_align_all['PDBchain1'].map(position)
+    position2 = df_align_all['PDBchain2'].map(position)
+    df_align_all['pair_i'] = np.minimum(position1, position2)
+    df_align_all['pair_j'] = np.maximum(position1, position2)
+    # rows with unknown protein IDs or a protein aligned with itself are removed too
+    df_align_all = df_align_all[df_align_all['pair_i'] < df_align_all['pair_j']]
+    df_align_all = df_align_all.drop_duplicates(['pair_i', 'pair_j'])
+    df_align_all = df_align_all.sort_values(['pair_i', 'pair_j'], kind='stable').drop(columns=['pair_i', 'pair_j'])
+    df_align_all.to_csv(align_all_path, index=None, sep='\t')
+    print('Pair-wise similarity repaired, saved in: ', align_all_path)
+    return align_all_path
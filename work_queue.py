@@ -0,0 +1,222 @@
+import os
+import time
+import shutil
+import socket
+import threading
+import numpy as np
+import pandas as pd
+import get_alignments
+
+
+def init_queue(sublist_path, pdb_list, queue_path=None, num_tiles=100, row_costs=None):
+    """Split all rows into tiles of rows next to each other in the list with about the same cost, and
+    save them in a work queue on the shared filesystem. The queue is a folder with three sub-folders:
+    'todo': tiles not started yet, 'claimed': tiles being computed, named '<tile>.<worker ID>',
+    'done': finished tiles, each file is one line of the completion manifest.
+    A tile is claimed by renaming it from 'todo' to 'claimed', which is atomic on a shared filesystem,
+    so no lock server is needed.
+    Parameters:
+    ----------
+    sublist_path: string
+        Folder path of the sub-lists, the output of 'get_lists' with parallel=1.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names.
+    queue_path: string
+        Folder of the queue, if not provided, it is the 'queue' folder in 'sublist_path'.
+    num_tiles: int
+        Number of tiles, should be a few times the number of workers so the fast workers take more tiles.
+    row_costs: ndarray
+        Cost of every row in the order of 'pdb_list' (optional), the number of pairs of the row is used
+        if not provided.
+    Returns:
+    ----------
+    queue_path: string
+        Folder of the queue."""
+    if queue_path is None:
+        queue_path = os.path.join(sublist_path, 'queue')
+    if os.path.exists(queue_path):
+        shutil.rmtree(queue_path)
+    for sub_folder in ['todo', 'claimed', 'done']:
+        os.makedirs(os.path.join(queue_path, sub_folder))
+    # the last protein has no pairs left
+    pdb_files = pdb_list[0].values[:-1]
+    if row_costs is None:
+        row_costs = []
+        for pdb_file in pdb_files:
+            sub_list_list_path = os.path.join(sublist_path, 'list_' + pdb_file[:-3] + 'txt')
+            if os.path.getsize(sub_list_list_path) == 0:
+                row_costs.append(0)
+            else:
+                row_costs.append(pd.read_csv(sub_list_list_path, sep='\t', header=None).size)
+    row_costs = np.asarray(row_costs, dtype=float)[:pdb_files.size]
+    # close a tile when the cumulative cost reaches the next multiple of total/num_tiles
+    cum_costs = np.cumsum(row_costs)
+    tile_cost = max(cum_costs[-1] / num_tiles, 1e-12) if cum_costs.size > 0 else 1.
+    tile_of_row = np.minimum(np.ceil(cum_costs / tile_cost) - 1, num_tiles - 1).clip(0).astype(int)
+    num_tile = 0
+    for ind_tile in np.unique(tile_of_row):
+        tile_path = os.path.join(queue_path, 'todo', 'tile_' + str(num_tile).zfill(6))
+        pd.DataFrame(pdb_files[tile_of_row == ind_tile]).to_csv(tile_path, header=None, index=None)
+        num_tile += 1
+    print(num_tile, 'tiles saved in the work queue: ', queue_path)
+    return queue_path
+
+
+def get_worker_id():
+    """ID of a worker, unique on the cluster as long as the host names are."""
+    return socket.gethostname() + '_' + str(os.getpid())
+
+
+def claim_tile(queue_path, worker_id, lease_time=3600):
+    """Claim the next tile, first from 'todo', then the claimed tiles whose lease has expired, i.e. whose
+    claim file was not touched for 'lease_time' seconds because the worker died. If two workers try to
+    claim the same tile, only one rename succeeds.
+    Returns:
+    ----------
+    tile: string
+        Name of the claimed tile, None if no tile can be claimed now.
+    claim_path: string
+        Path of the claim file."""
+    claimed_folder_path = os.path.join(queue_path, 'claimed')
+    for tile in sorted(os.listdir(os.path.join(queue_path, 'todo'))):
+        claim_path = os.path.join(claimed_folder_path, tile + '.' + worker_id)
+        try:
+            os.rename(os.path.join(queue_path, 'todo', tile), claim_path)
+        except OSError:
+            continue
+        # rename keeps the modification time, so start the lease now
+        os.utime(claim_path, None)
+        return tile, claim_path
+    for claim_file in sorted(os.listdir(claimed_folder_path)):
+        old_claim_path = os.path.join(claimed_folder_path, claim_file)
+        try:
+            expired = time.time() - os.path.getmtime(old_claim_path) > lease_time
+        except OSError:
+            continue
+        if not expired:
+            continue
+        tile = claim_file.split('.')[0]
+        claim_path = os.path.join(claimed_folder_path, tile + '.' + worker_id)
+        try:
+            os.rename(old_claim_path, claim_path)
+        except OSError:
+            continue
+        os.utime(claim_path, None)
+        print('Lease of', claim_file, 'expired, tile claimed again by', worker_id)
+        return tile, claim_path
+    return None, None
+
+
+def renew_lease(claim_path, stop, interval):
+    """Touch the claim file every 'interval' seconds until 'stop' is set, run in a thread of the worker."""
+    while not stop.wait(interval):
+        try:
+            os.utime(claim_path, None)
+        except OSError:
+            # the tile was claimed by another worker after the lease expired
+            return
+
+
+def finish_tile(queue_path, tile, claim_path, worker_id, time_start, num_rows):
+    """Mark a tile as done: write its line of the manifest to a temporary file and rename it into 'done',
+    then remove the claim."""
+    record = pd.DataFrame([{'tile': tile, 'worker': worker_id, 'start': time_start, 'end': time.time(),
+                            'rows': num_rows}])
+    tmp_path = os.path.join(queue_path, tile + '.' + worker_id + '.tmp')
+    record.to_csv(tmp_path, index=None, sep='\t')
+    os.rename(tmp_path, os.path.join(queue_path, 'done', tile))
+    if os.path.exists(claim_path):
+        os.remove(claim_path)
+
+
+def run_worker(pdb_path, usalign_path, queue_path, pdb_list, sublist_path, align_folder_path, lease_time=3600,
+               poll_interval=60, batch_size=1, runner='os', n_workers=4, timeout=60, retries=2, worker_id=None):
+    """Claim and compute tiles of the work queue until all tiles are done. Any number of workers can run
+    on any nodes at the same time, and can be started or killed at any time: a tile of a killed worker is
+    claimed again after 'lease_time' seconds. The rows of a tile are computed in a folder of the worker
+    and moved to 'align_folder_path' when the tile is finished, so a tile computed twice never leaves a
+    half-written alignment file.
+    Parameters:
+    ----------
+    pdb_path: string
+        Path of the folder containing all .pdb files.
+    usalign_path: string
+        Path of the US-align tool (e.g. PATH/USalign).
+    queue_path: string
+        Folder of the queue created by 'init_queue'.
+    pdb_list: pandas dataframe
+        A list of all .pdb file names.
+    sublist_path: string
+        Folder path of the sub-lists.
+    align_folder_path: string
+        Folder of the alignment files, the same as for 'cat_align'.
+    lease_time: float
+        Seconds after the last renewal when a claimed tile is considered lost, the lease is renewed
+        every lease_time/4 seconds while the tile is computed. The clocks of the nodes should agree
+        to well below this time.
+    poll_interval: float
+        Seconds to wait before looking again, when all remaining tiles are claimed by other workers.
+    batch_size, runner, n_workers, timeout, retries:
+        Options of 'get_alignments.run_usalign_rows'.
+    Returns:
+    ----------
+    num_tiles: int
+        Number of tiles computed by this worker."""
+    if worker_id is None:
+        worker_id = get_worker_id()
+    if not os.path.exists(align_folder_path):
+        os.makedirs(align_folder_path)
+    worker_folder_path = os.path.join(align_folder_path, 'worker_' + worker_id)
+    num_tiles = 0
+    while True:
+        tile, claim_path = claim_tile(queue_path, worker_id, lease_time=lease_time)
+        if tile is None:
+            if len(os.listdir(os.path.join(queue_path, 'claimed'))) == 0:
+                break
+            # the last tiles are claimed by other workers, wait in case one of them dies
+            time.sleep(poll_interval)
+            continue
+        time_start = time.time()
+        stop = threading.Event()
+        renewer = threading.Thread(target=renew_lease, args=(claim_path, stop, lease_time / 4.), daemon=True)
+        renewer.start()
+        try:
+            if not os.path.exists(worker_folder_path):
+                os.makedirs(worker_folder_path)
+            df_tile = pd.read_csv(claim_path, sep='\t', header=None)
+            get_alignments.run_usalign_rows(pdb_path, usalign_path, df_tile, pdb_list, sublist_path,
+                                            worker_folder_path, batch_size=batch_size, runner=runner,
+                                            n_workers=n_workers, timeout=timeout, retries=retries, job_name=tile)
+            for align_file in os.listdir(worker_folder_path):
+                os.replace(os.path.join(worker_folder_path, align_file), os.path.join(align_folder_path, align_file))
+        finally:
+            stop.set()
+            renewer.join()
+        if not os.path.exists(claim_path):
+            print('Lease of', tile, 'was lost, the tile is finished by another worker.')
+            continue
+        finish_tile(queue_path, tile, claim_path, worker_id, time_start, len(df_tile))
+        num_tiles += 1
+        print('Tile', tile, 'finished by', worker_id, 'in', round(time.time() - time_start, 1), 'seconds.')
+    if os.path.exists(worker_folder_path):
+        shutil.rmtree(worker_folder_path)
+    print('No tile left, worker', worker_id, 'computed', num_tiles, 'tiles.')
+    return num_tiles
+
+
+def queue_status(queue_path, manifest=1):
+    """Count the tiles in the queue, and save the completion manifest 'manifest.txt' with one line for
+    every finished tile.
+    Returns:
+    ----------
+    complete: bool
+        If all tiles are done, then the alignments can be concatenated with 'cat_align'."""
+    num_todo = len(os.listdir(os.path.join(queue_path, 'todo')))
+    num_claimed = len(os.listdir(os.path.join(queue_path, 'claimed')))
+    done_files = sorted(os.listdir(os.path.join(queue_path, 'done')))
+    if manifest and len(done_files) > 0:
+        df_manifest = pd.concat([pd.read_csv(os.path.join(queue_path, 'done', tile), sep='\t', dtype={'tile': str})
+                                 for tile in done_files])
+        df_manifest.to_csv(os.path.join(queue_path, 'manifest.txt'), index=None, sep='\t')
+    print('Tiles to do:', num_todo, ', claimed:', num_claimed, ', done:', len(done_files))
+    return num_todo == 0 and num_claimed == 0